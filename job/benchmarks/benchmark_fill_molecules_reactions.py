@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Benchmark fill_molecules_reactions on a synthetic reaction network
+
+A results database is filled with molecules, each the product of a random earlier molecule
+by one of a set of reaction types. The reaction sequences are filled four times: initially,
+again without any changes, after changing the number of hits of part of the molecules and
+only for the reactants and products of new reactions.
+"""
+
+import argparse
+import random
+import sys
+import time
+import magma
+from magma.models import Molecule, Reaction, fill_molecules_reactions
+
+
+def fill_database(db_session, nmolecules, nreactions):
+    molecules = [{'molid': molid, 'mol': u'', 'inchikey14': unicode(molid), 'name': u'', 'nhits': 0,
+                  'mim': 100.0, 'natoms': 10, 'predicted': molid > nmolecules // 10, 'reactionsequence': {}}
+                 for molid in range(1, nmolecules + 1)]
+    db_session.execute(Molecule.__table__.insert(), molecules)
+    reactions = []
+    for reactid in range(1, nreactions + 1):
+        product = random.randint(2, nmolecules)
+        reactions.append({'reactid': reactid, 'reactant': random.randint(1, product - 1),
+                          'product': product, 'name': u'reaction%d' % random.randint(1, 20)})
+    db_session.execute(Reaction.__table__.insert(), reactions)
+    db_session.commit()
+
+
+def add_reactions(db_session, nmolecules, nreactions):
+    """Adds random reactions, returns molids of their reactants and products"""
+    start = db_session.query(Reaction).count() + 1
+    reactions = []
+    for reactid in range(start, start + nreactions):
+        product = random.randint(2, nmolecules)
+        reactions.append({'reactid': reactid, 'reactant': random.randint(1, product - 1),
+                          'product': product, 'name': u'reaction%d' % random.randint(1, 20)})
+    db_session.execute(Reaction.__table__.insert(), reactions)
+    db_session.commit()
+    return {reaction['reactant'] for reaction in reactions} | {reaction['product'] for reaction in reactions}
+
+
+def timed_fill(db_session, description, molids=None):
+    start_time = time.time()
+    fill_molecules_reactions(db_session, molids)
+    print '%s: %.2f s' % (description, time.time() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--molecules', help="Number of molecules (default: %(default)s)", default=100000, type=int)
+    parser.add_argument('--reactions', help="Number of reactions (default: %(default)s)", default=200000, type=int)
+    parser.add_argument('--hits', help="Number of molecules with hits (default: %(default)s)", default=1000, type=int)
+    parser.add_argument('--new_reactions', help="Number of reactions added (default: %(default)s)",
+                        default=1000, type=int)
+    args = parser.parse_args()
+
+    random.seed(1)
+    magma_session = magma.MagmaSession(None, loglevel='warn')
+    db_session = magma_session.db_session
+    fill_database(db_session, args.molecules, args.reactions)
+
+    timed_fill(db_session, 'initial fill')
+    timed_fill(db_session, 'fill without changes')
+    molids = random.sample(range(1, args.molecules + 1), args.hits)
+    for start in range(0, len(molids), 500):
+        db_session.query(Molecule).filter(Molecule.molid.in_(molids[start:start + 500])).update(
+            {'nhits': 1}, synchronize_session=False)
+    db_session.commit()
+    timed_fill(db_session, 'fill after %d molecules got hits' % args.hits)
+    molids = add_reactions(db_session, args.molecules, args.new_reactions)
+    timed_fill(db_session, 'fill of %d molecules of %d new reactions' % (len(molids), args.new_reactions), molids)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Benchmark reading a large mass or formula tree with MsDataEngine.store_manual_tree
+
+A synthetic tree is generated in which every peak with a subtree has a number of fragment peaks,
+the first of which is fragmented again, up to the given depth.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import magma
+
+
+def write_subtree(depth, npeaks, formula_tree, counter):
+    items = []
+    for i in range(npeaks):
+        counter[0] += 1
+        if formula_tree:
+            item = 'C%dH%dO%d: %d' % (depth + 1, i + 1, counter[0] % 9 + 1, 1000 + i)
+        else:
+            item = '%.6f: %d' % (100.0 + counter[0] * 0.001, 1000 + i)
+        if i < 2 and depth > 1:
+            item += ' (\n' + write_subtree(depth - 1, npeaks, formula_tree, counter) + '\n)'
+        items.append(item)
+    return ',\n'.join(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', help="Depth of the tree (default: %(default)s)", default=8, type=int)
+    parser.add_argument('--peaks', help="Number of peaks per scan (default: %(default)s)", default=20, type=int)
+    parser.add_argument('--formula', help="Write a formula tree instead of a mass tree", action='store_true')
+    args = parser.parse_args()
+
+    tree_file = tempfile.NamedTemporaryFile(suffix='.tree', delete=False)
+    counter = [0]
+    tree_file.write(write_subtree(args.depth, args.peaks, args.formula, counter) + '\n')
+    tree_file.close()
+    try:
+        magma_session = magma.MagmaSession(None, loglevel='warn')
+        ms_data_engine = magma_session.get_ms_data_engine(abs_peak_cutoff=0)
+        start_time = time.time()
+        ms_data_engine.store_manual_tree(tree_file.name, 1 if args.formula else 0)
+        elapsed_time = time.time() - start_time
+        print '%d peaks read in %.2f s (%.1f peaks/s)' % (counter[0], elapsed_time, counter[0] / elapsed_time)
+    finally:
+        os.remove(tree_file.name)
+
+if __name__ == "__main__":
+    sys.exit(main())
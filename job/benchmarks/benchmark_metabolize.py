@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Benchmark MetabolizeEngine.metabolize with and without the substructure prescreen
+
+Molecules are read from a file with one SMILES per line (for example an export of HMDB),
+or a small set of drug-like molecules is repeated to obtain the requested number of molecules.
+Each molecule is metabolized by all rules of the given metabolism type, first with the
+pattern fingerprint prescreen of the reaction templates and then without it.
+"""
+
+import argparse
+import sys
+import time
+import magma
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+default_smiles = [
+    'Clc1cccc(F)c1Nc2ccc(C)cc2CC(=O)O',
+    'Oc1cc(CC2OCCC2)cc(O)c1O',
+    'CC(=O)Nc1ccc(O)cc1',
+    'CN1C=NC2=C1C(=O)N(C(=O)N2C)C',
+    'OC(=O)CCCCC1SCC2NC(=O)NC12',
+    'CCCCCCCCCCCCCCCC(=O)OCC(COP(=O)(O)OCCN)OC(=O)CCCCCCCC=CCCCCCCCC',
+    'OCC1OC(Oc2ccc(O)cc2)C(O)C(O)C1O',
+]
+
+
+def read_molecules(smiles_file, nmolecules):
+    if smiles_file is None:
+        smiles = (default_smiles * (nmolecules // len(default_smiles) + 1))[:nmolecules]
+    else:
+        smiles = [line.split()[0] for line in open(smiles_file) if line.strip()][:nmolecules]
+    molecules = []
+    for s in smiles:
+        mol = Chem.MolFromSmiles(s)
+        if mol is not None:
+            AllChem.Compute2DCoords(mol)
+            molecules.append(mol)
+    return molecules
+
+
+def run(metabolize_engine, molecules, metabolism):
+    start_time = time.time()
+    nmetabolites = 0
+    for mol in molecules:
+        nmetabolites += len(metabolize_engine.metabolize(mol, metabolism))
+    return time.time() - start_time, nmetabolites
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('smiles_file', nargs='?', help="File with one SMILES per line (default: built-in molecules)")
+    parser.add_argument('-n', '--molecules', help="Number of molecules (default: %(default)s)", default=1000, type=int)
+    parser.add_argument('-m', '--metabolism', help="Metabolism type (default: %(default)s)", default='phase1')
+    args = parser.parse_args()
+
+    magma.MagmaSession(None, loglevel='warn')
+    molecules = read_molecules(args.smiles_file, args.molecules)
+    metabolize_engine = magma.MetabolizeEngine()
+    metabolize_engine.get_reactions(args.metabolism)
+
+    elapsed_time, nmetabolites = run(metabolize_engine, molecules, args.metabolism)
+    print 'prescreen:    %d molecules, %d metabolites in %.2f s, %d of %d rules skipped' % (
+        len(molecules), nmetabolites, elapsed_time, metabolize_engine.nskipped, metabolize_engine.nrules)
+
+    metabolize_engine.prescreen = False
+    elapsed_time, nmetabolites = run(metabolize_engine, molecules, args.metabolism)
+    print 'no prescreen: %d molecules, %d metabolites in %.2f s' % (len(molecules), nmetabolites, elapsed_time)
+
+if __name__ == "__main__":
+    sys.exit(main())
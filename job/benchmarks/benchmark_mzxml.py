@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Benchmark reading a large non-hierarchical mzXML file with MsDataEngine.store_mzxml_file
+
+A synthetic mzXML file is generated with a series of MS1 scans, each followed by a number of
+MS2 scans. The MS2 scans do not contain a precursorScanNum attribute, so their precursor scans
+have to be assigned based on retention time. Every precursor is fragmented twice to include
+the generation of composite spectra.
+"""
+
+import argparse
+import base64
+import os
+import struct
+import sys
+import tempfile
+import time
+import magma
+
+
+def peaks_element(npeaks, offset):
+    peaks = []
+    for i in range(npeaks):
+        peaks.extend([100.0 + i * 1.37 + offset, 1000.0 + 100 * i])
+    encoded = base64.b64encode(struct.pack('>%df' % len(peaks), *peaks))
+    return '<peaks precision="32" byteOrder="network" pairOrder="m/z-int">' + encoded + '</peaks>\n'
+
+
+def write_mzxml(f, nms1, nms2, npeaks):
+    f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n')
+    f.write('<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n<msRun>\n')
+    num = 0
+    rt = 0.0
+    for i in range(nms1):
+        num += 1
+        rt += 1.0
+        f.write('<scan num="%d" msLevel="1" peaksCount="%d" polarity="+" retentionTime="PT%.3fS" '
+                'lowMz="100" highMz="1000" basePeakMz="500" basePeakIntensity="1e6" totIonCurrent="1e7">\n' %
+                (num, npeaks, rt))
+        f.write(peaks_element(npeaks, 0.0))
+        f.write('</scan>\n')
+        for j in range(nms2):
+            # every precursor is fragmented twice, with different collision energies
+            precursormz = 150.0 + (j // 2) * 10.0
+            num += 1
+            rt += 0.1
+            f.write('<scan num="%d" msLevel="2" peaksCount="%d" polarity="+" retentionTime="PT%.3fS" '
+                    'lowMz="50" highMz="%f" basePeakMz="100" basePeakIntensity="1e5" totIonCurrent="1e6">\n' %
+                    (num, npeaks, rt, precursormz))
+            f.write('<precursorMz precursorIntensity="1e5">%f</precursorMz>\n' % precursormz)
+            f.write(peaks_element(npeaks, 0.0002 * (j % 2)))
+            f.write('</scan>\n')
+    f.write('</msRun>\n</mzXML>\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ms1', help="Number of MS1 scans (default: %(default)s)", default=1000, type=int)
+    parser.add_argument('--ms2', help="Number of MS2 scans per MS1 scan (default: %(default)s)", default=10, type=int)
+    parser.add_argument('--peaks', help="Number of peaks per scan (default: %(default)s)", default=200, type=int)
+    parser.add_argument('--ncpus', help="Number of parallel cpus to use for decoding peaks (default: %(default)s)", default=1, type=int)
+    args = parser.parse_args()
+
+    mzxml_file = tempfile.NamedTemporaryFile(suffix='.mzXML', delete=False)
+    write_mzxml(mzxml_file, args.ms1, args.ms2, args.peaks)
+    mzxml_file.close()
+    try:
+        magma_session = magma.MagmaSession(None, loglevel='warn')
+        ms_data_engine = magma_session.get_ms_data_engine(abs_peak_cutoff=0)
+        start_time = time.time()
+        ms_data_engine.store_mzxml_file(mzxml_file.name, ncpus=args.ncpus)
+        elapsed_time = time.time() - start_time
+        nscans = args.ms1 * (1 + args.ms2)
+        print '%d scans read in %.2f s (%.1f scans/s)' % (nscans, elapsed_time, nscans / elapsed_time)
+    finally:
+        os.remove(mzxml_file.name)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,18 +2,25 @@
 
 import sys
 import base64
+import bisect
+import collections
+import itertools
 import time
 import re
 import os
 import sqlite3
-import struct
 import zlib
-import copy
+import hashlib
+import tempfile
 import pkg_resources
 import logging
 import json
+import mmap
+import multiprocessing.pool
+import threading
+import numpy
 from lxml import etree
-from sqlalchemy import create_engine, desc
+from sqlalchemy import create_engine, desc, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 from models import Base, Molecule, Reaction, fill_molecules_reactions, Scan, Peak, Fragment, Run
@@ -31,9 +38,9 @@ config = ConfigParser.ConfigParser()
 # read config file from current working directory or users home dir
 config.read(['magma_job.ini', os.path.expanduser('~/magma_job.ini')])
 
-from rdkit import Chem, Geometry
+from rdkit import Chem, Geometry, DataStructs
 from rdkit.Chem import AllChem, rdMolTransforms, Descriptors
-from rdkit.rdBase import DisableLog
+from rdkit.rdBase import DisableLog, rdkitVersion
 DisableLog('rdApp.warning')
 
 logging.basicConfig(format='%(levelname)s: %(message)s')
@@ -103,8 +110,8 @@ class MagmaSession(object):
     def get_call_back_engine(self, id, key):
         return CallBackEngine(id, key)
 
-    def fill_molecules_reactions(self):
-        fill_molecules_reactions(self.db_session)
+    def fill_molecules_reactions(self, molids=None):
+        fill_molecules_reactions(self.db_session, molids)
 
     def commit(self):
         self.db_session.commit()
@@ -160,7 +167,7 @@ class MetabolizeEngine(object):
     """ Engine to perform in silico reactions on chemical structures """
 
     def __init__(self):
-        metabolism_files = {
+        self.metabolism_files = {
             "phase1": pkg_resources.resource_filename(  # @UndefinedVariable
                 'magma', "data/phase1.smirks"),
             "phase2": pkg_resources.resource_filename(  # @UndefinedVariable
@@ -174,27 +181,98 @@ class MetabolizeEngine(object):
             "glycosidase": pkg_resources.resource_filename(  # @UndefinedVariable
                 'magma', "data/glycosidase.smirks"),
         }
+        # reactions are compiled (or read from the cache) on first use of a metabolism type
         self.reactions = {}
-        for m in metabolism_files:
-            self.reactions[m] = []
-            f = open(metabolism_files[m])
-            for line in f:
-                if line[0] != "#" and len(line) > 1:
-                    splitline = line[:-1].split()
-                    self.reactions[m].append(
-                        (splitline[1], AllChem.ReactionFromSmarts(splitline[0])))
+        # pattern fingerprints of the reactant templates, per metabolism type
+        self.template_fps = {}
+        # prior likelihoods of the reaction rules, per metabolism type
+        self.priors = {}
+        # skip reactions whose template fingerprint bits are not all set in the reactant fingerprint
+        self.prescreen = True
+        # number of reaction rules considered and skipped by the prescreen
+        self.nrules = 0
+        self.nskipped = 0
+        # end products of intermediates of endpoints metabolism, {(metabolism, ikey): {ikey: [metabolism, product mol]}},
+        # least recently used entries are removed when it holds endproducts_size intermediates
+        self.endproducts = collections.OrderedDict()
+        self.endproducts_size = 10000
+        # intermediates being metabolized, and the number of times one of them was formed again by a cycle
+        self.intermediates = set()
+        self.ncycles = 0
+        try:
+            self.cache_dir = config.get('magma job', 'reaction_cache_dir')
+        except ConfigParser.Error:
+            self.cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'magma')
+
+    def get_reactions(self, metabolism):
+        """ Return list of (name, reaction) tuples of metabolism type """
+        if metabolism not in self.reactions:
+            self.reactions[metabolism] = self.read_reactions(self.metabolism_files[metabolism])
+            self.template_fps[metabolism] = [self.template_fingerprint(reaction)
+                                             for name, reaction in self.reactions[metabolism]]
+        return self.reactions[metabolism]
+
+    def get_priors(self, metabolism):
+        """ Return {rule name: prior likelihood} of metabolism type. The prior likelihood of a rule
+            is an optional number after the name in the smirks file, default 1 """
+        if metabolism not in self.priors:
+            priors = {}
+            for line in open(self.metabolism_files[metabolism]):
+                splitline = line.split()
+                if line[0] != "#" and len(splitline) > 2:
+                    try:
+                        priors[splitline[1]] = float(splitline[2])
+                    except ValueError:
+                        pass
+            self.priors[metabolism] = priors
+        return self.priors[metabolism]
+
+    def template_fingerprint(self, reaction):
+        """ Return pattern fingerprint of the reactant template of reaction, any molecule matching
+            the template has all bits of this fingerprint set in its own pattern fingerprint """
+        template = reaction.GetReactantTemplate(0)
+        template.UpdatePropertyCache(False)
+        Chem.FastFindRings(template)
+        return Chem.PatternFingerprint(template)
+
+    def read_reactions(self, smirks_file):
+        """ Read and compile reactions from smirks_file. Compiled reactions are stored in binary form
+            in the cache directory, in a file named after the hash of smirks_file and the RDKit version """
+        smirks = open(smirks_file).read()
+        cache_file = os.path.join(self.cache_dir, '%s.%s.pkl' % (
+            os.path.basename(smirks_file), hashlib.sha1(smirks + rdkitVersion).hexdigest()))
+        try:
+            return [(name, AllChem.ChemicalReaction(binary))
+                    for name, binary in pickle.load(open(cache_file, 'rb'))]
+        except Exception:
+            pass
+        reactions = []
+        for line in smirks.splitlines(True):
+            if line[0] != "#" and len(line) > 1:
+                splitline = line[:-1].split()
+                reactions.append(
+                    (splitline[1], AllChem.ReactionFromSmarts(splitline[0])))
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to temporary file first, other processes may read the cache at the same time
+            f = tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False)
+            pickle.dump([(name, reaction.ToBinary()) for name, reaction in reactions], f, -1)
+            f.close()
+            os.rename(f.name, cache_file)
+        except (IOError, OSError) as error:
+            logger.debug('Reaction cache not written: ' + str(error))
+        return reactions
 
     def react(self, reactant, reaction):
-        """ Apply reaction to reactant and return products """
+        """ Apply reaction to reactant and return sanitized products,
+            coordinates of new atoms are not calculated yet (see gen_coords) """
         ps = reaction.RunReactants([reactant])
         products = []
         for product in ps:
-            frags = (Chem.GetMolFrags(product[0], asMols=True))
-            for p in frags:
-                q = copy.copy(p)
-                Chem.SanitizeMol(q)
-                self.gen_coords(q)
-                products.append(q)
+            for p in Chem.GetMolFrags(product[0], asMols=True):
+                Chem.SanitizeMol(p)
+                products.append(p)
         return products
 
     def gen_coords(self, mol):
@@ -223,29 +301,191 @@ class MetabolizeEngine(object):
     def metabolize(self, mol, metabolism, endpoints=False):
         """ Metabolize a molecule based on a set of metabolism rules and return products"""
         metabolites = {}  # {ikey:[rulename,product mol]}
-        if metabolism not in self.reactions:
+        if metabolism not in self.metabolism_files:
             return metabolites
         # if endpoints, name refers to the metabolism type
         name = metabolism
-        for reaction in self.reactions[metabolism]:
+        reactions = self.get_reactions(metabolism)
+        mol_fp = Chem.PatternFingerprint(mol) if self.prescreen else None
+        seen = set()  # canonical smiles of products
+        for reaction, template_fp in zip(reactions, self.template_fps[metabolism]):
+            self.nrules += 1
+            if mol_fp is not None and not DataStructs.AllProbeBitsMatch(template_fp, mol_fp):
+                # substructure of the reactant template cannot be present in mol
+                self.nskipped += 1
+                continue
             if not endpoints:
                 # else name refers to the rule generating a product
                 name = reaction[0]
             products = self.react(mol, reaction[1])
             for p in products:
-                ikey = AllChem.InchiToInchiKey(AllChem.MolToInchi(p))[:14]
+                # most products are duplicates, skip them on canonical smiles before computing
+                # the inchikey and the coordinates
+                smiles = Chem.MolToSmiles(p, isomericSmiles=True)
+                if smiles in seen:
+                    continue
+                seen.add(smiles)
+                ikey = calculate_inchikey14(p, smiles)
                 if ikey not in metabolites:
                     if endpoints:
                         # Try further reactions, otherwise store end product
-                        endproducts = self.metabolize(p, metabolism, True)
+                        endproducts = self.metabolize_intermediate(p, ikey, metabolism)
                         if len(endproducts) > 0:
                             metabolites.update(endproducts)
-                        else:
-                            metabolites[ikey] = [name, p]
-                    else:
-                        metabolites[ikey] = [name, p]
+                            continue
+                    self.gen_coords(p)
+                    metabolites[ikey] = [name, p]
         return metabolites
 
+    def metabolize_intermediate(self, mol, ikey, metabolism):
+        """ Return end products of intermediate product mol with inchikey14 ikey,
+            each intermediate is metabolized only once and its end products are reused
+            for all pathways and parent molecules leading to it """
+        key = (metabolism, ikey)
+        if key in self.endproducts:
+            endproducts = self.endproducts.pop(key)
+            self.endproducts[key] = endproducts
+            return endproducts
+        if key in self.intermediates:
+            # an intermediate that is formed again from its own products is regarded as end product
+            self.ncycles += 1
+            return {}
+        ncycles = self.ncycles
+        self.intermediates.add(key)
+        try:
+            endproducts = self.metabolize(mol, metabolism, True)
+        finally:
+            self.intermediates.remove(key)
+        if self.ncycles == ncycles:
+            # end products reached through a cycle differ with the intermediate at which the cycle
+            # was entered, they are not reused
+            while len(self.endproducts) >= self.endproducts_size:
+                self.endproducts.popitem(last=False)
+            self.endproducts[key] = endproducts
+        return endproducts
+
+
+def read_sdf_records(sdf_file):
+    """ Yields the molblocks in sdf_file """
+    lines = []
+    for line in open(sdf_file):
+        if line.strip() == '$$$$':
+            yield ''.join(lines)
+            lines = []
+        else:
+            lines.append(line)
+    if ''.join(lines).strip() != '':
+        yield ''.join(lines)
+
+
+def read_smiles_records(smiles_file):
+    """ Yields (smiles, name) for the lines of smiles_file,
+        spaces in names are replaced by underscores """
+    for line in smiles_file:
+        splitline = line.split()
+        if len(splitline) > 0:
+            yield splitline[0], '_'.join(splitline[1:])
+
+
+def parse_structures(records, structure_format):
+    """ Parse structures (also used in parallel processes).
+        Records are (smiles, name) tuples for structure_format 'smiles' or molblocks for 'sdf'.
+        Returns for each record a tuple of molblock, name, inchikey14, smiles, mim, natoms,
+        formula and logp, or an error message if the record could not be read """
+    import magma
+    result = []
+    for record in records:
+        try:
+            if structure_format == 'smiles':
+                smiles, name = record
+                mol = magma.Chem.MolFromSmiles(smiles)
+                mol.SetProp('_Name', name)
+                magma.AllChem.Compute2DCoords(mol)
+            else:
+                mol = magma.Chem.MolFromMolBlock(record)
+                name = mol.GetProp('_Name')
+            molblock = magma.Chem.MolToMolBlock(mol)
+            result.append((molblock, name) + magma.calculate_properties(mol))
+        except Exception:
+            if structure_format == 'smiles':
+                result.append('Failed to read smiles: ' + smiles + ' (' + name + ')')
+            else:
+                result.append('Failed to read molblock: ' + record.split('\n', 1)[0])
+    return result
+
+
+process_metabolize_engine = None
+
+
+def metabolize_molecules(molblocks, metabolism, endpoints=False, metabolize_engine=None):
+    """ Metabolize molecules (also used in parallel processes).
+        Returns for each molblock a list of products, as tuples of the name of the reaction
+        (or metabolism type in case of endpoints) and molblock, inchikey14, smiles, mim, natoms,
+        formula and logp of the product, together with the number of reaction rules considered
+        and skipped by the substructure prescreen """
+    import magma
+    if metabolize_engine is None:
+        # the engine is kept by the (worker) process, to reuse the reactions
+        # and the end products of intermediates for the next molecules
+        if magma.process_metabolize_engine is None:
+            magma.process_metabolize_engine = magma.MetabolizeEngine()
+        metabolize_engine = magma.process_metabolize_engine
+    nrules = metabolize_engine.nrules
+    nskipped = metabolize_engine.nskipped
+    result = []
+    for molblock in molblocks:
+        products = []
+        parent = magma.Chem.MolFromMolBlock(molblock)
+        for ikey, (name, product) in metabolize_engine.metabolize(parent, metabolism, endpoints).iteritems():
+            products.append((name, magma.Chem.MolToMolBlock(product)) +
+                            magma.calculate_properties(product, inchikey14=ikey))
+        result.append(products)
+    return result, (metabolize_engine.nrules - nrules, metabolize_engine.nskipped - nskipped)
+
+
+# properties of molecules by canonical isomeric smiles, see calculate_properties,
+# ordered from least to most recently used
+properties_cache = collections.OrderedDict()
+properties_cache_size = 100000
+
+
+def calculate_inchikey14(mol, isomeric_smiles):
+    """ Returns inchikey14 of mol with canonical isomeric smiles, without calculating the other properties """
+    if isomeric_smiles in properties_cache:
+        return properties_cache[isomeric_smiles][0]
+    inchikey14 = Chem.MolToInchiKey(mol)[:14]
+    if inchikey14 == '':
+        raise ValueError('Failed to calculate InChIKey: ' + isomeric_smiles)
+    return inchikey14
+
+
+def calculate_properties(mol, isomeric_smiles=None, inchikey14=None):
+    """ Returns inchikey14, smiles, mim, natoms, formula and logp of mol.
+        Results are cached by canonical isomeric smiles, which can be given if already known,
+        the least recently used results are removed when the cache is full.
+        The inchikey14 can also be given if already known """
+    if isomeric_smiles is None:
+        isomeric_smiles = Chem.MolToSmiles(mol, isomericSmiles=True)
+    if isomeric_smiles in properties_cache:
+        properties = properties_cache.pop(isomeric_smiles)
+        properties_cache[isomeric_smiles] = properties
+        return properties
+    if inchikey14 is None:
+        inchikey14 = calculate_inchikey14(mol, isomeric_smiles)
+    smiles = Chem.MolToSmiles(mol)
+    # Calc mim
+    mim = 0.0
+    for atom in mol.GetAtoms():
+        mim += pars.mims[atom.GetSymbol()] + pars.Hmass * \
+            (atom.GetNumImplicitHs() + atom.GetNumExplicitHs())
+    molform = Chem.rdMolDescriptors.CalcMolFormula(mol)
+    natoms = mol.GetNumHeavyAtoms()
+    logp = Chem.Crippen.MolLogP(mol)
+    while len(properties_cache) >= properties_cache_size:
+        properties_cache.popitem(last=False)
+    properties_cache[isomeric_smiles] = (inchikey14, smiles, mim, natoms, molform, logp)
+    return properties_cache[isomeric_smiles]
+
 
 def get_molecule(molblock, name, refscore, predicted, mim=None, smiles=None, natoms=None,
                  inchikey14=None, molform=None, reference=None, logp=None, mass_filter=9999):
@@ -254,16 +494,7 @@ def get_molecule(molblock, name, refscore, predicted, mim=None, smiles=None, nat
         mol = Chem.MolFromMolBlock(molblock)
         if mol is None:
             return
-        inchikey14 = Chem.AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))[:14]
-        smiles = Chem.MolToSmiles(mol)
-        # Calc mim
-        mim = 0.0
-        for atom in mol.GetAtoms():
-            mim += pars.mims[atom.GetSymbol()] + pars.Hmass * \
-                (atom.GetNumImplicitHs() + atom.GetNumExplicitHs())
-        molform = Chem.rdMolDescriptors.CalcMolFormula(mol)
-        natoms = mol.GetNumHeavyAtoms()
-        logp = Chem.Crippen.MolLogP(mol)
+        inchikey14, smiles, mim, natoms, molform, logp = calculate_properties(mol)
     if mim > mass_filter:
         return
     return Molecule(
@@ -282,6 +513,14 @@ def get_molecule(molblock, name, refscore, predicted, mim=None, smiles=None, nat
         reactionsequence={})
 
 
+def clear_structure_indexes(session, transaction):
+    """ Drop the molecule and reaction indexes of the structure engines of session
+        at the end of its outermost transaction """
+    if transaction.parent is None:
+        session.info.pop('molids', None)
+        session.info.pop('reactions', None)
+
+
 class StructureEngine(object):
 
     """Engine to add and query MAGMa candidate molecules"""
@@ -292,20 +531,34 @@ class StructureEngine(object):
         if pubchem_names:
             self.pubchem_engine = PubChemEngine('pubchem', incl_halo=True)
         self.metabolize_engine = None
+        # number of reaction rules considered and skipped by the substructure prescreen
+        self.prescreen_counts = [0, 0]
+        # {inchikey14: molid} and {(reactant, product, name)} of the stored molecules and reactions are
+        # loaded on first use and updated on insert, to check for duplicates without querying the database.
+        # They are kept in the session, shared by its structure engines, and dropped at the end of each
+        # transaction, as a rollback discards the inserts and other connections may write in between
+        if not event.contains(db_session, 'after_transaction_end', clear_structure_indexes):
+            event.listen(db_session, 'after_transaction_end', clear_structure_indexes)
+        # reactants and products of the added reactions, of which the reaction sequence has to be filled again
+        self.reacted_molids = set()
+        # in beam mode only the beam_width most probable new metabolites are kept in each reaction step,
+        # per parent or overall, probabilities are the product of the prior likelihoods of the rules
+        self.beam_width = None
+        self.beam_per_parent = False
+        self.probabilities = {}
+        # time after which no more metabolites are generated in beam mode, see run_scenario
+        self.deadline = None
         if call_back_url is not None:
             self.call_back_engine = CallBackEngine(call_back_url)
         else:
             self.call_back_engine = None
 
-    def read_sdf(self, file_name, mass_filter):
+    def read_sdf(self, file_name, mass_filter=9999, ncpus=1):
+        """ Read sdf file """
         logger.info('READING SDF (Structure Data File)')
-        molids = set([])
-        for mol in Chem.SDMolSupplier(file_name):
-            molids.add(self.add_structure(Chem.MolToMolBlock(mol), mol.GetProp(
-                '_Name'), None, predicted=0, mass_filter=mass_filter))
-        logger.info(str(len(molids)) + ' molecules added to library\n')
+        self.read_structures(read_sdf_records(file_name), 'sdf', mass_filter, ncpus)
 
-    def read_smiles(self, smiles, mass_filter=9999):
+    def read_smiles(self, smiles, mass_filter=9999, ncpus=1):
         """ Read smiles file,
             each line consists of a smiles string
             optionally followed by a name in which spaces a replaced by underscores """
@@ -314,27 +567,88 @@ class StructureEngine(object):
             smiles_file = open(smiles)
         except:
             smiles_file = [smiles]
-        molids = set([])
-        for line in smiles_file:
-            line = line.strip()
-            if line == "":
-                continue
-            splitline = line.split()
-            smiles = splitline[0]
-            if len(splitline) > 1:
-                name = '_'.join(splitline[1:])
-            else:
-                name = ''
-            try:
-                mol = Chem.MolFromSmiles(smiles)
-                mol.SetProp('_Name', name)
-                AllChem.Compute2DCoords(mol)
-                molids.add(self.add_structure(
-                    Chem.MolToMolBlock(mol), name, None, predicted=0, mass_filter=mass_filter))
-            except:
-                logger.warn(
-                    'Failed to read smiles: ' + smiles + ' (' + name + ')')
+        self.read_structures(read_smiles_records(smiles_file), 'smiles', mass_filter, ncpus)
+
+    def read_structures(self, records, structure_format, mass_filter=9999, ncpus=1, batch_size=1000):
+        """ Add structures from records (see parse_structures) to the database,
+            with ncpus > 1 the records are parsed in parallel processes.
+            Returns molids of the added molecules and list of (record number, error message) of
+            records which could not be read """
+        molids = set()
+        errors = []
+        nrecords = 0
+        start_time = time.time()
+        job_server = self.get_job_server(ncpus)
+        try:
+            for batch, structures in self.parse_batches(records, structure_format, job_server, batch_size):
+                for structure in structures:
+                    nrecords += 1
+                    if isinstance(structure, basestring):
+                        logger.warn(structure)
+                        errors.append((nrecords, structure))
+                molids |= self.store_structures(
+                    [structure for structure in structures if not isinstance(structure, basestring)], mass_filter)
+                elapsed_time = time.time() - start_time
+                logger.info('%d structures read in %.0f s', nrecords, elapsed_time)
+                if self.call_back_engine is not None:
+                    self.call_back_engine.update_callback_url(
+                        'Reading structures: %d<br>Molecules added: %d' % (nrecords, len(molids)), elapsed_time)
+        finally:
+            if job_server is not None:
+                job_server.destroy()
+        if len(errors) > 0:
+            logger.warn(str(len(errors)) + ' structures could not be read')
         logger.info(str(len(molids)) + ' molecules added to library\n')
+        return molids, errors
+
+    def parse_batches(self, records, structure_format, job_server, batch_size):
+        """ Parse records in batches, yields (batch, structures) in the order of records """
+        records = iter(records)
+        batches = iter(lambda: list(itertools.islice(records, batch_size)), [])
+        if job_server is None:
+            for batch in batches:
+                yield batch, parse_structures(batch, structure_format)
+            return
+        jobs = collections.deque()
+        for batch in batches:
+            jobs.append((batch, job_server.submit(parse_structures, (batch, structure_format), (), ("magma",))))
+            # keep two batches per cpu in progress
+            while len(jobs) > 2 * job_server.get_ncpus():
+                yield self.collect_structures(*jobs.popleft())
+        while len(jobs) > 0:
+            yield self.collect_structures(*jobs.popleft())
+
+    def collect_structures(self, batch, job):
+        structures = job()
+        if structures is None:
+            raise DataProcessingError('Failed to parse structures')
+        return batch, structures
+
+    def store_structures(self, structures, mass_filter=9999):
+        """ Store structures (see parse_structures) in molecules table with a single insert,
+            structures already in the database are skipped
+            Returns molids """
+        known_molids = self.get_molids()
+        molid = self.db_session.query(func.max(Molecule.molid)).scalar() or 0
+        rows = []
+        for molblock, name, inchikey14, smiles, mim, natoms, molform, logp in structures:
+            if mim > mass_filter:
+                continue
+            if inchikey14 in known_molids:
+                logger.info('Duplicate structure, kept first one: ' + name)
+                continue
+            molid += 1
+            molecule = get_molecule(molblock, name, None, 0, mim, smiles, natoms, inchikey14, molform, None, logp)
+            self.add_pubchem_name(molecule)
+            rows.append({'molid': molid, 'mol': molecule.mol, 'refscore': molecule.refscore,
+                         'inchikey14': molecule.inchikey14, 'smiles': molecule.smiles, 'formula': molecule.formula,
+                         'predicted': molecule.predicted, 'name': molecule.name, 'nhits': molecule.nhits,
+                         'mim': molecule.mim, 'natoms': molecule.natoms, 'reference': molecule.reference,
+                         'logp': molecule.logp, 'reactionsequence': molecule.reactionsequence})
+            known_molids[molecule.inchikey14] = molid
+        if len(rows) > 0:
+            self.db_session.execute(Molecule.__table__.insert(), rows)
+        return set(row['molid'] for row in rows)
 
     def add_structure(self, molblock, name, refscore, predicted,
                       mim=None, smiles=None, natoms=None, inchi=None, molform=None, reference=None, logp=None, mass_filter=9999):
@@ -348,11 +662,12 @@ class StructureEngine(object):
         """ Add molecule to database
             Optionally lookup name in pubchem
             Return molid """
-        # Checking duplicates is slow, option to turn off should only be used
-        # when candidates from a single chemical db query are added
+        # Option to turn off checking duplicates should only be used
+        # when the molecule is known not to be in the database
         if check_duplicates:
-            dup = self.db_session.query(Molecule).filter_by(
-                inchikey14=newmol.inchikey14).first()
+            dup = None
+            if newmol.inchikey14 in self.get_molids():
+                dup = self.db_session.query(Molecule).get(self.molids[newmol.inchikey14])
             if dup is not None:
                 if merge:
                     if dup.name == "" and newmol.name != "":
@@ -372,21 +687,48 @@ class StructureEngine(object):
                         logger.info(
                             'Duplicate structure, kept new one: ' + newmol.name)
                         return
-        if self.pubchem_names:
-            in_pubchem = self.pubchem_engine.check_inchi(newmol.mim, newmol.inchikey14)
-            if in_pubchem != False:
-                name, reference, refscore = in_pubchem
-                if newmol.name == '':
-                    newmol.name = unicode(str(name), 'utf-8', 'xmlcharrefreplace')
-                if newmol.reference == "None":
-                    newmol.reference = unicode(reference)
-                if newmol.refscore is None:
-                    newmol.refscore = refscore
+        self.add_pubchem_name(newmol)
         self.db_session.add(newmol)
         logger.debug('Added molecule: ' + newmol.name)
         self.db_session.flush()
+        if self.molids is not None:
+            self.molids[newmol.inchikey14] = newmol.molid
         return newmol.molid
 
+    def add_pubchem_name(self, molecule):
+        """ Optionally lookup name, reference and refscore of molecule in pubchem """
+        if self.pubchem_names:
+            in_pubchem = self.pubchem_engine.check_inchi(molecule.mim, molecule.inchikey14)
+            if in_pubchem != False:
+                name, reference, refscore = in_pubchem
+                if molecule.name == '':
+                    molecule.name = unicode(str(name), 'utf-8', 'xmlcharrefreplace')
+                if molecule.reference == "None":
+                    molecule.reference = unicode(reference)
+                if molecule.refscore is None:
+                    molecule.refscore = refscore
+
+    @property
+    def molids(self):
+        return self.db_session.info.get('molids')
+
+    @property
+    def reactions(self):
+        return self.db_session.info.get('reactions')
+
+    def get_molids(self):
+        """ Return {inchikey14: molid} of all molecules in the database """
+        if self.molids is None:
+            self.db_session.info['molids'] = dict(self.db_session.query(Molecule.inchikey14, Molecule.molid))
+        return self.molids
+
+    def get_reactions(self):
+        """ Return set of (reactant, product, name) of all reactions in the database """
+        if self.reactions is None:
+            self.db_session.info['reactions'] = set(
+                self.db_session.query(Reaction.reactant, Reaction.product, Reaction.name))
+        return self.reactions
+
     def metabolize(self, molid, metabolism, endpoints=False):
         """ Metabolize a molecule based on a set of metabolism rules and store
             reactions and products in reactions and molecules tables
@@ -396,43 +738,196 @@ class StructureEngine(object):
         except:
             logger.warn('Molecule record %s does not exist.', molid)
             return
-        parent = Chem.MolFromMolBlock(p.mol)
         if self.metabolize_engine is None:
             self.metabolize_engine = MetabolizeEngine()
+        products, prescreen_counts = metabolize_molecules([p.mol], metabolism, endpoints, self.metabolize_engine)
+        self.count_prescreen(prescreen_counts)
+        return self.store_metabolites(molid, products[0], endpoints)
+
+    def count_prescreen(self, prescreen_counts):
+        nrules, nskipped = prescreen_counts
+        self.prescreen_counts[0] += nrules
+        self.prescreen_counts[1] += nskipped
+
+    def log_prescreen(self):
+        nrules, nskipped = self.prescreen_counts
+        if nrules > 0:
+            logger.info('    prescreen skipped %d of %d reaction rules (%.1f%%)',
+                        nskipped, nrules, 100.0 * nskipped / nrules)
+        self.prescreen_counts = [0, 0]
+
+    def store_metabolites(self, molid, products, endpoints=False):
+        """ Store products (see metabolize_molecules) of molecule molid and the reactions
+            generating them in molecules and reactions tables
+            Return molids """
         molids = set()
-        products = self.metabolize_engine.metabolize(parent, metabolism, endpoints)
-        for product in products.values():
-            molecule = get_molecule(Chem.MolToMolBlock(product[1]), "", None, 1)
+        for name, molblock, inchikey14, smiles, mim, natoms, molform, logp in products:
+            molecule = get_molecule(molblock, "", None, 1, mim, smiles, natoms, inchikey14, molform, None, logp)
             new_molid = self.add_molecule(molecule, merge=True)
             molids.add(new_molid)
-            reactid = self.db_session.query(Reaction.reactid).filter(
-                            Reaction.reactant == molid,
-                            Reaction.product == new_molid,
-                            Reaction.name == unicode(product[0])).all()
-            if len(reactid) == 0:
+            if (molid, new_molid, unicode(name)) not in self.get_reactions():
                 react = Reaction(
                     reactant=molid,
                     product=new_molid,
-                    name=unicode(product[0])
+                    name=unicode(name)
                 )
                 self.db_session.add(react)
-                self.db_session.flush()
+                self.reactions.add((molid, new_molid, unicode(name)))
+                self.reacted_molids.update((molid, new_molid))
         if endpoints and len(molids) == 0:  # molid itself is endpoint
             molids.add(molid)
         return molids
 
-    def metabolize_all(self, metabolism, endpoints=False):
+    def metabolize_molids(self, molids, metabolism, endpoints=False, job_server=None, batch_size=20):
+        """ Metabolize molecules, yields the molids generated from each molecule, in the order of molids.
+            With a pp job_server, the reactions are applied in parallel processes,
+            while the products are stored by the main process """
+        if self.beam_width is not None:
+            for new_molids in self.metabolize_beam(molids, metabolism, endpoints, job_server, batch_size):
+                yield new_molids
+        elif job_server is None:
+            for molid in molids:
+                yield self.metabolize(molid, metabolism, endpoints)
+        else:
+            for molid, products in self.generate_metabolites(molids, metabolism, endpoints, job_server, batch_size):
+                yield self.store_metabolites(molid, products, endpoints)
+
+    def generate_metabolites(self, molids, metabolism, endpoints=False, job_server=None, batch_size=20):
+        """ Yields (molid, products) (see metabolize_molecules) in the order of molids,
+            without storing the products """
+        if self.metabolize_engine is None:
+            self.metabolize_engine = MetabolizeEngine()
+        molids = list(molids)
+        jobs = collections.deque()
+        for start in range(0, len(molids), batch_size):
+            batch = molids[start:start + batch_size]
+            molblocks = dict(self.db_session.query(Molecule.molid, Molecule.mol).filter(Molecule.molid.in_(batch)))
+            for molid in batch:
+                if molid not in molblocks:
+                    logger.warn('Molecule record %s does not exist.', molid)
+            batch = [molid for molid in batch if molid in molblocks]
+            if job_server is None:
+                for molid_products in self.collect_metabolites(batch, metabolize_molecules(
+                        [molblocks[molid] for molid in batch], metabolism, endpoints, self.metabolize_engine)):
+                    yield molid_products
+                continue
+            jobs.append((batch, job_server.submit(metabolize_molecules,
+                                                  ([molblocks[molid] for molid in batch], metabolism, endpoints),
+                                                  (), ("magma",))))
+            # keep two batches per cpu in progress
+            while len(jobs) > 2 * job_server.get_ncpus():
+                batch, job = jobs.popleft()
+                for molid_products in self.collect_metabolites(batch, job()):
+                    yield molid_products
+        while len(jobs) > 0:
+            batch, job = jobs.popleft()
+            for molid_products in self.collect_metabolites(batch, job()):
+                yield molid_products
+
+    def collect_metabolites(self, batch, result):
+        if result is None:
+            raise DataProcessingError('Metabolism failed for molecules: ' + str(batch))
+        products, prescreen_counts = result
+        self.count_prescreen(prescreen_counts)
+        return zip(batch, products)
+
+    def metabolize_beam(self, molids, metabolism, endpoints=False, job_server=None, batch_size=20):
+        """ Metabolize molecules, storing only the beam_width most probable new metabolites,
+            per parent or of all molids together. Yields the molids generated from each molecule """
+        if self.metabolize_engine is None:
+            self.metabolize_engine = MetabolizeEngine()
+        priors = self.metabolize_engine.get_priors(metabolism)
+        known_molids = self.get_molids()
+        generated = []
+        candidates = []  # (-probability, index in generated, inchikey14) of new metabolites
+        for molid, products in self.generate_metabolites(molids, metabolism, endpoints, job_server, batch_size):
+            parent_candidates = sorted(
+                (-self.probabilities.get(molid, 1.0) * priors.get(product[0], 1.0), len(generated), product[2])
+                for product in products if product[2] not in known_molids)
+            if self.beam_per_parent:
+                parent_candidates = parent_candidates[:self.beam_width]
+            candidates.extend(parent_candidates)
+            generated.append((molid, products))
+            if self.deadline is not None and time.time() > self.deadline:
+                logger.info('Time limit reached, beam is selected from metabolites of %d molecules', len(generated))
+                break
+        selected = {}  # {inchikey14: probability}
+        kept = set()  # (index in generated, inchikey14)
+        for probability, index, inchikey14 in sorted(candidates):
+            if not self.beam_per_parent and inchikey14 not in selected and len(selected) >= self.beam_width:
+                continue
+            kept.add((index, inchikey14))
+            selected[inchikey14] = max(selected.get(inchikey14, 0.0), -probability)
+        logger.debug('beam kept %d of %d new metabolites', len(selected), len(set(c[2] for c in candidates)))
+        stored_molids = []
+        for index, (molid, products) in enumerate(generated):
+            # products already in the database are always kept
+            products = [product for product in products
+                        if product[2] in known_molids or (index, product[2]) in kept]
+            stored_molids.append(self.store_metabolites(molid, products, endpoints))
+        # probabilities are recorded before yielding, the caller may stop early
+        for inchikey14, probability in selected.iteritems():
+            molid = known_molids[inchikey14]
+            self.probabilities[molid] = max(self.probabilities.get(molid, 0.0), probability)
+        for new_molids in stored_molids:
+            yield new_molids
+
+    def get_job_server(self, ncpus):
+        """ Return pp job server for parallel processing, or None for ncpus = 1 """
+        if ncpus > 1:
+            logger.info('calculating on ' + str(ncpus) + ' cpus')
+            return pp.Server(ncpus, ppservers=())
+
+    def metabolize_all(self, metabolism, endpoints=False, ncpus=1):
         """ Metabolize all current molecules based on a set of metabolism rules """
         logger.info('Metabolize all')
-        parentids = self.db_session.query(Molecule.molid).all()
+        parentids = [x[0] for x in self.db_session.query(Molecule.molid).all()]
         molids = set([])
-        for parentid, in parentids:
-            molids |= self.metabolize(parentid, metabolism, endpoints)
+        job_server = self.get_job_server(ncpus)
+        try:
+            for new_molids in self.metabolize_molids(parentids, metabolism, endpoints, job_server):
+                molids |= new_molids
+        finally:
+            if job_server is not None:
+                job_server.destroy()
+        self.log_prescreen()
         return molids
 
-    def run_scenario(self, scenario, time_limit=None):
-        """ Metabolize according to scenario """
+    def run_scenario(self, scenario, time_limit=None, ncpus=1, beam_width=None, beam_per_parent=False):
+        """ Metabolize according to scenario,
+            with ncpus > 1 reactions are applied in parallel processes,
+            with beam_width only the most probable new metabolites of each reaction step are kept,
+            of each parent molecule if beam_per_parent or else of all molecules in the step """
         logger.info('RUNNING METABOLIC SCENARIO')
+        if beam_width is not None:
+            self.check_priors(scenario)
+        job_server = self.get_job_server(ncpus)
+        self.beam_width = beam_width
+        self.beam_per_parent = beam_per_parent
+        if time_limit:
+            self.deadline = time.time() + time_limit * 60
+        try:
+            self.run_scenario_steps(scenario, time_limit, job_server)
+        finally:
+            self.beam_width = None
+            self.beam_per_parent = False
+            self.deadline = None
+            if job_server is not None:
+                job_server.destroy()
+        logger.info(str(self.db_session.query(Molecule).count()) + ' molecules in library\n')
+
+    def check_priors(self, scenario):
+        """ Raise DataProcessingError if the rules of a metabolism type in scenario have no prior likelihoods,
+            the new metabolites of a reaction step can then not be ranked for a beam """
+        if self.metabolize_engine is None:
+            self.metabolize_engine = MetabolizeEngine()
+        for action, value in scenario:
+            if action in self.metabolize_engine.metabolism_files and \
+                    len(self.metabolize_engine.get_priors(action)) == 0:
+                raise DataProcessingError('Rules of metabolism type ' + action +
+                                          ' have no prior likelihoods, beam width can not be applied')
+
+    def run_scenario_steps(self, scenario, time_limit, job_server):
         if time_limit is None:
             result = self.db_session.query(Molecule.molid).all()
             molids = {x[0] for x in result}
@@ -456,8 +951,8 @@ class StructureEngine(object):
                     endpoints = True
                     value = 1
                 new_molids = set()
-                for molid in molids:
-                    new_molids |= self.metabolize(molid, action, endpoints)
+                for metabolites in self.metabolize_molids(molids, action, endpoints, job_server):
+                    new_molids |= metabolites
                     elapsed_time = time.time() - start_time
                     if self.call_back_engine is not None:
                         status = 'Transformation: %s, step 1<br>Metabolites generated: %d' % (
@@ -470,8 +965,8 @@ class StructureEngine(object):
                     molids = new_molids
                     for i in range(1, int(value)):
                         new_molids = set()
-                        for molid in active_molids:
-                            new_molids |= self.metabolize(molid, action, endpoints)
+                        for metabolites in self.metabolize_molids(active_molids, action, endpoints, job_server):
+                            new_molids |= metabolites
                             elapsed_time = time.time() - start_time
                             if self.call_back_engine is not None:
                                 status = 'Transformation: %s, step %d<br>Metabolites generated: %d' % (
@@ -486,6 +981,7 @@ class StructureEngine(object):
                 logger.info('    ' + str(len(prev_molids)) + ' compounds were metabolized according to ' + \
                             str(action) + ' rules (' + str(int(value)) + ' steps)')
                 logger.info('    yielding ' + str(len(molids)) + ' metabolites')
+                self.log_prescreen()
                 if not endpoints:
                     molids |= prev_molids
             if time_limit and time.time() - start_time > time_limit * 60:
@@ -497,13 +993,18 @@ class StructureEngine(object):
         else:
             if self.call_back_engine is not None:
                 self.call_back_engine.update_callback_url('Transformations completed', force=True)
-        logger.info(str(self.db_session.query(Molecule).count()) + ' molecules in library\n')
 
 
 class MsDataEngine(object):
 
     """ Engine to read MS/MS data """
 
+    # separators of peaks and subtrees in mass and formula trees
+    tree_separators = re.compile(r'([\,\(\)])')
+    # element (two letter symbols are tried first) and count in formula trees
+    formula_element = re.compile(
+        '(' + '|'.join(sorted(pars.mims, key=len, reverse=True)) + r')(\d*)')
+
     def __init__(self, db_session, ionisation_mode, abs_peak_cutoff, mz_precision, mz_precision_abs,
                  precursor_mz_precision, max_ms_level, call_back_url=None):
         self.db_session = db_session
@@ -542,13 +1043,21 @@ class MsDataEngine(object):
         self.precision = 1 + 2 * rundata.mz_precision / 1e6
         self.mz_precision_abs = rundata.mz_precision_abs * 2
         self.precursor_mz_precision = rundata.precursor_mz_precision
+        # peak lists of composite spectra, {scanid: [(mz, intensity), ...]}
+        self.composite_spectra = {}
+        # in memory indices of stored scans, used to resolve precursor scans during reading:
+        # {mslevel: ([rt, ...], [scanid, ...])} sorted on rt
+        self.scan_rts = {}
+        # {(precursorscanid, precursormz, precursorintensity): Scan}
+        self.precursor_scans = {}
         if call_back_url is not None:
             self.call_back_engine = CallBackEngine(call_back_url)
         else:
             self.call_back_engine = None
 
-    def store_mzxml_file(self, mzxml_file, scan_filter=None, time_limit=None):
-        """ Read mzxml_file and store scans and peaks in the scans and peaks tables """
+    def store_mzxml_file(self, mzxml_file, scan_filter=None, time_limit=None, ncpus=1):
+        """ Read mzxml_file and store scans and peaks in the scans and peaks tables.
+            With ncpus > 1, the peaks are decoded in parallel processes """
         logger.info('READING MZXML FILE')
         rundata = self.db_session.query(Run).one()
         if rundata.ms_filename is not None:
@@ -556,24 +1065,27 @@ class MsDataEngine(object):
         rundata.ms_filename = unicode(mzxml_file)
         self.db_session.add(rundata)
         self.ms_filename = mzxml_file
-        tree = etree.parse(mzxml_file)
-        root = tree.getroot()
-        namespace = '{' + root.nsmap[None] + '}'
-        mzxml_query = namespace + "msRun/" + namespace + "scan"
-        prec_scans = [] # in case of non-hierarchical mzXML, also find child scans of scan_filter
+        mzxml_scans = None
+        if scan_filter is not None:
+            # try to read only the requested spectral tree, using the scan index of the file
+            mzxml_scans = self.read_indexed_mzxml_scans(mzxml_file, scan_filter)
+        if mzxml_scans is None:
+            tree = etree.parse(mzxml_file)
+            root = tree.getroot()
+            namespace = '{' + root.nsmap[None] + '}'
+            mzxml_query = namespace + "msRun/" + namespace + "scan"
+            mzxml_scans = root.findall(mzxml_query)
+        else:
+            # scan elements read as fragments are not in the mzXML namespace
+            namespace = ''
         start_time = time.time()
-        for mzxmlScan in root.findall(mzxml_query):
+        selected_scans = self.select_mzxml_scans(mzxml_scans, scan_filter, namespace)
+        for mzxmlScan, peak_lists in self.decode_spectra(selected_scans, ncpus):
+            self.store_mzxml_scan(mzxmlScan, 0, namespace, iter(peak_lists))
             elapsed_time = time.time() - start_time
-            if mzxmlScan.attrib['polarity'] == self.polarity and \
-                    (scan_filter is None or \
-                     mzxmlScan.attrib['num'] == scan_filter or \
-                     (int(mzxmlScan.attrib['msLevel'])>1 and mzxmlScan.find(namespace+'precursorMz').attrib['precursorScanNum'] in prec_scans)
-                     ):
-                self.store_mzxml_scan(mzxmlScan, 0, namespace)
-                prec_scans.append(mzxmlScan.attrib['num']) # in case of non-hierarchical mzXML, also find child scans
-                if self.call_back_engine is not None:
-                    status = 'Reading mzXML, scan: %s' % (prec_scans[-1],)
-                    self.call_back_engine.update_callback_url(status, elapsed_time, time_limit)
+            if self.call_back_engine is not None:
+                status = 'Reading mzXML, scan: %s' % (mzxmlScan.attrib['num'],)
+                self.call_back_engine.update_callback_url(status, elapsed_time, time_limit)
             if time_limit and elapsed_time > time_limit * 60:
                 if self.call_back_engine is not None:
                     self.call_back_engine.update_callback_url('Reading mzXML stopped: time limit exceeded', force=True)
@@ -582,11 +1094,175 @@ class MsDataEngine(object):
         else:
             if self.call_back_engine is not None:
                 self.call_back_engine.update_callback_url('Reading mzXML completed', force=True)
+        self.store_composite_spectra()
         self.db_session.commit()
         logger.info(str(self.db_session.query(Scan).count()) + ' spectra read from file\n')
 
-    def store_mzxml_scan(self, mzxmlScan, precScan, namespace):
+    def select_mzxml_scans(self, mzxml_scans, scan_filter, namespace):
+        """ Generator of the (top level) scan elements to be stored, each with the encoded peak lists
+            of the scan and its nested scans """
+        prec_scans = set() # in case of non-hierarchical mzXML, also find child scans of scan_filter
+        for mzxmlScan in mzxml_scans:
+            if mzxmlScan.attrib['polarity'] == self.polarity and \
+                    (scan_filter is None or \
+                     mzxmlScan.attrib['num'] == scan_filter or \
+                     (int(mzxmlScan.attrib['msLevel'])>1 and mzxmlScan.find(namespace+'precursorMz').attrib['precursorScanNum'] in prec_scans)
+                     ):
+                prec_scans.add(mzxmlScan.attrib['num']) # in case of non-hierarchical mzXML, also find child scans
+                yield mzxmlScan, self.read_mzxml_encoded_peaks(mzxmlScan, namespace, [])
+
+    def read_mzxml_encoded_peaks(self, mzxmlScan, namespace, encoded_peak_lists):
+        """ Append the encoded peak lists of mzxmlScan and its nested scans to encoded_peak_lists,
+            in the order in which they are used by store_mzxml_scan """
+        empty = mzxmlScan.attrib['peaksCount'] == '0'
+        for child in mzxmlScan:
+            if child.tag == namespace + 'peaks' and not empty:
+                if child.attrib.get('precision') == '64':
+                    dtype = '>f8'
+                else:
+                    dtype = '>f4'
+                encoded_peak_lists.append(
+                    ((child.text, child.attrib.get('compressionType') == 'zlib', dtype), None))
+            if child.tag == namespace + 'scan' and int(child.attrib['msLevel']) <= self.max_ms_level:
+                self.read_mzxml_encoded_peaks(child, namespace, encoded_peak_lists)
+        return encoded_peak_lists
+
+    def decode_spectra(self, spectra, ncpus=1, batch_size=100):
+        """ Decode the peak lists of spectra, an iterable of (item, encoded peak lists) tuples
+            (see decode_peak_lists), yields (item, decoded peak lists) in the same order.
+            With ncpus > 1, batches of batch_size spectra are decoded in parallel processes,
+            while the decoded spectra are stored by the main process """
+        if ncpus <= 1:
+            for item, encoded_peak_lists in spectra:
+                yield item, decode_peak_lists(encoded_peak_lists, self.abs_peak_cutoff)
+            return
+        logger.info('decoding spectra on ' + str(ncpus) + ' cpus')
+        job_server = pp.Server(ncpus, ppservers=())
+        try:
+            jobs = collections.deque()
+            batch = []
+            for spectrum in spectra:
+                batch.append(spectrum)
+                if len(batch) == batch_size:
+                    jobs.append(self.submit_batch(job_server, batch))
+                    batch = []
+                # keep two batches per cpu in progress
+                while len(jobs) > 2 * ncpus:
+                    for decoded_spectrum in self.collect_batch(*jobs.popleft()):
+                        yield decoded_spectrum
+            if len(batch) > 0:
+                jobs.append(self.submit_batch(job_server, batch))
+            while len(jobs) > 0:
+                for decoded_spectrum in self.collect_batch(*jobs.popleft()):
+                    yield decoded_spectrum
+        finally:
+            job_server.destroy()
+
+    def submit_batch(self, job_server, batch):
+        encoded_peak_lists = []
+        for item, spectrum_peak_lists in batch:
+            encoded_peak_lists.extend(spectrum_peak_lists)
+        return batch, job_server.submit(decode_peak_lists, (encoded_peak_lists, self.abs_peak_cutoff),
+                                        (), ("base64", "zlib", "numpy"))
+
+    def collect_batch(self, batch, job):
+        decoded_peak_lists = job()
+        if decoded_peak_lists is None:
+            raise DataProcessingError('Decoding of peak lists failed')
+        i = 0
+        for item, spectrum_peak_lists in batch:
+            yield item, decoded_peak_lists[i:i + len(spectrum_peak_lists)]
+            i += len(spectrum_peak_lists)
+
+    def read_indexed_mzxml_scans(self, mzxml_file, scan_filter):
+        """ Read the spectral tree of MS1 scan scan_filter by seeking to the byte offsets in the
+            scan index of an indexed mzXML file. Returns a list with the scan element of scan_filter,
+            followed by the (non-hierarchical) scan elements up to the next MS1 scan.
+            Returns None if the file does not have a valid index. """
+        mzxml = open(mzxml_file, 'rb')
+        try:
+            offsets = self.read_mzxml_index(mzxml)
+            if offsets is None or scan_filter not in offsets:
+                return None
+            mzxml_scan, end = self.read_mzxml_scan_element(mzxml, offsets[scan_filter])
+            if mzxml_scan is None or mzxml_scan.attrib.get('num') != scan_filter:
+                logger.info('Invalid mzXML index, reading complete file')
+                return None
+            logger.info('Reading scan ' + scan_filter + ' using mzXML index')
+            mzxml_scans = [mzxml_scan]
+            for offset in sorted(offsets.itervalues()):
+                # skip offsets of preceding scans and of scans nested in the previous scan element
+                if offset < end:
+                    continue
+                mzxml_scan, end = self.read_mzxml_scan_element(mzxml, offset)
+                if mzxml_scan is None or mzxml_scan.attrib.get('msLevel') == '1':
+                    break
+                mzxml_scans.append(mzxml_scan)
+            return mzxml_scans
+        finally:
+            mzxml.close()
+
+    def read_mzxml_index(self, mzxml):
+        """ Return {scan number: byte offset} from the scan index of an open mzXML file,
+            or None if the file has no index """
+        mzxml.seek(0, os.SEEK_END)
+        size = mzxml.tell()
+        mzxml.seek(max(0, size - 4096))
+        match = re.search(r'<indexOffset>\s*(\d+)\s*</indexOffset>', mzxml.read())
+        if match is None or int(match.group(1)) >= size:
+            return None
+        mzxml.seek(int(match.group(1)))
+        index = mzxml.read()
+        start = index.find('<index name="scan"')
+        if start < 0:
+            return None
+        index = index[start:index.find('</index>', start)]
+        offsets = {}
+        for scan_num, offset in re.findall(r'<offset\s+id="(\d+)"\s*>\s*(\d+)\s*</offset>', index):
+            offsets[scan_num] = int(offset)
+        return offsets
+
+    def read_mzxml_scan_element(self, mzxml, offset):
+        """ Parse the scan element, including nested scans, starting at offset in an open mzXML file.
+            Returns the element and the offset of the end of the element,
+            or (None, None) if no scan element starts at offset """
+        scan_tag = re.compile(r'<(/?)scan\b[^>]*?(/?)>')
+        mzxml.seek(offset)
+        fragment = ''
+        pos = 0
+        depth = 0
+        while True:
+            block = mzxml.read(1048576)
+            if block == '':
+                return None, None
+            if fragment == '':
+                # tolerate offsets pointing at whitespace before the scan element
+                stripped = block.lstrip()
+                offset += len(block) - len(stripped)
+                block = stripped
+                if not block.startswith('<scan'):
+                    return None, None
+            fragment += block
+            for match in scan_tag.finditer(fragment, pos):
+                pos = match.end()
+                if match.group(1) == '/':
+                    depth -= 1
+                elif match.group(2) != '/':
+                    depth += 1
+                if depth == 0:
+                    try:
+                        return etree.fromstring(fragment[:pos]), offset + pos
+                    except etree.XMLSyntaxError:
+                        return None, None
+
+    def store_mzxml_scan(self, mzxmlScan, precScan, namespace, peak_lists):
+        """ Store scan element and its nested scans, peak_lists is an iterator over the
+            decoded peak lists, as read by read_mzxml_encoded_peaks """
         if mzxmlScan.attrib['peaksCount'] == '0':
+            # empty scans are not stored, their nested scans keep the empty scan as precursor scan
+            for child in mzxmlScan:
+                if child.tag == namespace + 'scan' and int(child.attrib['msLevel']) <= self.max_ms_level:
+                    self.store_mzxml_scan(child, int(mzxmlScan.attrib['num']), namespace, peak_lists)
             return
         try:
             lowmz = float(mzxmlScan.attrib['lowMz'])
@@ -621,38 +1297,45 @@ class MsDataEngine(object):
                 if scan.precursorscanid == 0:
                     # MS>1 scan is not in a hierarchy and does not contain precursor scan information
                     # assume that the preceding (based on retention time) scan at the precursor MS level is the precursor scan
-                    scan.precursorscanid = self.db_session.query(Scan.scanid).filter(
-                        Scan.mslevel == scan.mslevel - 1).filter(Scan.rt < scan.rt).order_by(desc(Scan.rt)).first()[0]
+                    scan.precursorscanid = self.find_preceding_scan(scan.mslevel - 1, scan.rt)
                     logger.info('Assigning precursor scanid ' + str(scan.precursorscanid) + ' to scan ' + str(scan.scanid) + '\n')
                 # check for existing scan with the same precursor
-                comp = self.db_session.query(Scan).filter(Scan.precursorscanid == scan.precursorscanid,
-                                                          Scan.precursormz == scan.precursormz,
-                                                          Scan.precursorintensity == scan.precursorintensity).all()
+                comp = self.precursor_scans.get(
+                    (scan.precursorscanid, scan.precursormz, scan.precursorintensity))
             if child.tag == namespace + 'peaks':
-                decoded = base64.decodestring(child.text)
-                try:
-                    if child.attrib['compressionType'] == 'zlib':
-                        decoded = zlib.decompress(decoded)
-                except:
-                    pass
-                double_precision = False
-                try:
-                    if child.attrib['precision'] == '64':
-                        double_precision = True
-                except:
-                    pass
-                if comp is None or len(comp) == 0:
-                    self.store_mzxml_peaks(scan, decoded, double_precision)
+                peaks = next(peak_lists)[0]
+                if comp is None:
+                    self.store_peaks(scan.scanid, peaks)
                 else:
                     # generate composite spectrum with the existing scan of the same precursor
-                    self.merge_spectrum(comp[0], scan, decoded, double_precision)
+                    self.merge_spectrum(comp, scan, peaks)
             if child.tag == namespace + 'scan' and int(child.attrib['msLevel']) <= self.max_ms_level:
-                self.store_mzxml_scan(child, scan.scanid, namespace)
-        if comp is None or len(comp) == 0:
+                self.store_mzxml_scan(child, scan.scanid, namespace, peak_lists)
+        if comp is None:
             self.db_session.add(scan)
+            self.index_scan(scan)
         self.db_session.flush()
 
-    def merge_spectrum(self, existing_scan, newscan, decoded, double_precision):
+    def index_scan(self, scan):
+        """ Add stored scan to the in memory retention time and precursor indices """
+        rts, scanids = self.scan_rts.setdefault(scan.mslevel, ([], []))
+        # scans are mostly read in order of retention time, so this is usually an append
+        i = bisect.bisect_right(rts, scan.rt)
+        rts.insert(i, scan.rt)
+        scanids.insert(i, scan.scanid)
+        if scan.precursormz is not None:
+            self.precursor_scans[(scan.precursorscanid, scan.precursormz, scan.precursorintensity)] = scan
+
+    def find_preceding_scan(self, mslevel, rt):
+        """ Return scanid of the last stored scan at mslevel with retention time before rt """
+        rts, scanids = self.scan_rts.get(mslevel, ([], []))
+        i = bisect.bisect_left(rts, rt)
+        if i == 0:
+            raise DataProcessingError('No precursor scan found at MS level ' + str(mslevel) +
+                                      ' before retention time ' + str(rt))
+        return scanids[i - 1]
+
+    def merge_spectrum(self, existing_scan, newscan, peaks):
         """ Generate composite spectrum: in case of matching m/z values, keep the peak with
             highest intensity """
         logger.info('Merging scans ' + str(existing_scan.scanid) + ' and ' + str(newscan.scanid))
@@ -664,72 +1347,410 @@ class MsDataEngine(object):
             existing_scan.basepeakintensity = newscan.basepeakintensity
             existing_scan.basepeakmz = newscan.basepeakmz
         self.db_session.add(existing_scan)
-        if double_precision:
-            tmp_size = len(decoded) / 8
-            unpack_format1 = ">%dd" % tmp_size
-        else:
-            tmp_size = len(decoded) / 4
-            unpack_format1 = ">%df" % tmp_size
-        unpacked = struct.unpack(unpack_format1, decoded)
-        for mz, intensity in zip(unpacked[::2], unpacked[1::2]):
-            if intensity > self.abs_peak_cutoff:
-                matching_peaks = self.db_session.query(Peak).filter(Peak.scanid == existing_scan.scanid,
-                                       Peak.mz.between(min(mz / self.precision, mz - self.mz_precision_abs),
-                                                       max(mz * self.precision, mz + self.mz_precision_abs)
-                                                       )).all()
-                if len(matching_peaks) == 0:
-                    self.db_session.add(Peak(scanid=existing_scan.scanid, mz=mz, intensity=intensity))
-                else:
-                    replace = True
-                    # Compare intensity of peak with all matching peaks. Of all those,
-                    # keep only the one with highest intensity
-                    for p in matching_peaks:
-                        if intensity > p.intensity:
-                            self.db_session.delete(p)
-                        else:
-                            replace = False
-                            intensity = p.intensity
-                    if replace:
-                        self.db_session.add(Peak(scanid=existing_scan.scanid, mz=mz, intensity=intensity))
-
-    def store_mzxml_peaks(self, scan, decoded, double_precision):
-        if double_precision:
-            tmp_size = len(decoded) / 8
-            unpack_format1 = ">%dd" % tmp_size
+        new_peaks = sorted(peaks)
+        scanid = existing_scan.scanid
+        if scanid not in self.composite_spectra:
+            # first merge into this scan: move its peaks from the database into memory,
+            # the composite spectrum is written once by store_composite_spectra
+            self.db_session.flush()
+            self.composite_spectra[scanid] = [(mz, intensity) for mz, intensity in self.db_session.query(
+                Peak.mz, Peak.intensity).filter(Peak.scanid == scanid).order_by(Peak.mz)]
+            self.db_session.query(Peak).filter(Peak.scanid == scanid).delete(synchronize_session='evaluate')
+        self.composite_spectra[scanid] = self.merge_peak_lists(self.composite_spectra[scanid], new_peaks)
+
+    def merge_peak_lists(self, existing_peaks, new_peaks):
+        """ Merge two lists of (mz, intensity) tuples, both sorted on m/z, in a single sweep.
+            A new peak is compared with all peaks within the m/z tolerance (including
+            new peaks merged before), of those only the one with highest intensity is kept.
+            Returns the merged list, sorted on m/z """
+        merged = []
+        i = 0
+        for mz, intensity in new_peaks:
+            lowmz = min(mz / self.precision, mz - self.mz_precision_abs)
+            highmz = max(mz * self.precision, mz + self.mz_precision_abs)
+            # existing peaks below the tolerance window can not match any of the next new peaks
+            while i < len(existing_peaks) and existing_peaks[i][0] < lowmz:
+                merged.append(existing_peaks[i])
+                i += 1
+            matching_peaks = []
+            while len(merged) > 0 and merged[-1][0] >= lowmz:
+                matching_peaks.append(merged.pop())
+            while i < len(existing_peaks) and existing_peaks[i][0] <= highmz:
+                matching_peaks.append(existing_peaks[i])
+                i += 1
+            matching_peaks.sort()
+            replace = True
+            kept_peaks = []
+            # Compare intensity of peak with all matching peaks. Of all those,
+            # keep only the one with highest intensity
+            for p in matching_peaks:
+                if intensity > p[1]:
+                    continue
+                replace = False
+                intensity = p[1]
+                kept_peaks.append(p)
+            if replace:
+                kept_peaks.append((mz, intensity))
+                kept_peaks.sort()
+            merged.extend(kept_peaks)
+        merged.extend(existing_peaks[i:])
+        return merged
+
+    def store_composite_spectra(self):
+        """ Write the peaks of composite spectra, generated by merge_spectrum, to the peaks table """
+        for scanid, peaks in self.composite_spectra.iteritems():
+            self.store_peaks(scanid, peaks)
+        self.composite_spectra = {}
+        self.db_session.flush()
+
+    def store_peaks(self, scanid, peaks):
+        if len(peaks) > 0:
+            self.db_session.execute(Peak.__table__.insert(),
+                                    [dict(scanid=scanid, mz=mz, intensity=intensity) for mz, intensity in peaks])
+
+    def store_scan(self, scan, peaks):
+        """ Store scan and its peaks, or merge the peaks into the composite spectrum
+            of an existing scan with the same precursor """
+        comp = None
+        if scan.precursormz is not None:
+            comp = self.precursor_scans.get(
+                (scan.precursorscanid, scan.precursormz, scan.precursorintensity))
+        if comp is None:
+            self.store_peaks(scan.scanid, peaks)
+            self.db_session.add(scan)
+            self.index_scan(scan)
         else:
-            tmp_size = len(decoded) / 4
-            unpack_format1 = ">%df" % tmp_size
-        unpacked = struct.unpack(unpack_format1, decoded)
-        for mz, intensity in zip(unpacked[::2], unpacked[1::2]):
-            if intensity > self.abs_peak_cutoff:
-                self.db_session.add(
-                    Peak(scanid=scan.scanid, mz=mz, intensity=intensity))
-
-    def store_mgf(self, mgf_file):
-        mgf = open(mgf_file, 'r')
-        line = mgf.readline()
-        while line:
-            if line[:10] == 'BEGIN IONS':
+            self.merge_spectrum(comp, scan, peaks)
+        self.db_session.flush()
+
+    def store_mzml_file(self, mzml_file, scan_filter=None, time_limit=None, ncpus=1):
+        """ Read mzml_file and store spectra and peaks in the scans and peaks tables.
+            With ncpus > 1, the peaks are decoded in parallel processes """
+        logger.info('READING MZML FILE')
+        rundata = self.db_session.query(Run).one()
+        if rundata.ms_filename is not None:
+            raise DataProcessingError('Attempt to read MS data twice')
+        rundata.ms_filename = unicode(mzml_file)
+        self.db_session.add(rundata)
+        self.ms_filename = mzml_file
+        param_groups = self.read_mzml_param_groups(mzml_file)
+        spectra = None
+        if scan_filter is not None:
+            # try to read only the requested spectral tree, using the index of an indexed mzML file
+            spectra = self.read_indexed_mzml_spectra(mzml_file, scan_filter, param_groups)
+        if spectra is None:
+            spectra = self.iter_mzml_spectra(mzml_file, param_groups)
+        start_time = time.time()
+        selected_spectra = self.select_mzml_spectra(spectra, scan_filter)
+        for scan, peak_lists in self.decode_spectra(selected_spectra, ncpus):
+            peaks, peaks_summary = peak_lists[0]
+            if peaks_summary is not None:
+                # use the m/z range and base peak from the peak list if not given in the mzML file
+                lowmz, highmz, basepeakmz, basepeakintensity = peaks_summary
+                if scan.lowmz is None:
+                    scan.lowmz = lowmz
+                if scan.highmz is None:
+                    scan.highmz = highmz
+                if scan.basepeakmz is None:
+                    scan.basepeakmz = basepeakmz
+                if scan.basepeakintensity is None:
+                    scan.basepeakintensity = basepeakintensity
+            self.store_scan(scan, peaks)
+            elapsed_time = time.time() - start_time
+            if self.call_back_engine is not None:
+                status = 'Reading mzML, scan: %d' % (scan.scanid,)
+                self.call_back_engine.update_callback_url(status, elapsed_time, time_limit)
+            if time_limit and elapsed_time > time_limit * 60:
+                if self.call_back_engine is not None:
+                    self.call_back_engine.update_callback_url('Reading mzML stopped: time limit exceeded', force=True)
+                logger.warn('Reading mzML stopped: time limit exceeded\n')
                 break
-            line = mgf.readline()
         else:
-            logger.info('Error in MGF file: no "BEGIN IONS"')
-            return
-        peaklist = []
-        rt=0.0
-        precursormz = None
-        while line:
-            line = mgf.readline()
+            if self.call_back_engine is not None:
+                self.call_back_engine.update_callback_url('Reading mzML completed', force=True)
+        self.store_composite_spectra()
+        self.db_session.commit()
+        logger.info(str(self.db_session.query(Scan).count()) + ' spectra read from file\n')
+
+    def select_mzml_spectra(self, spectra, scan_filter):
+        """ Resolve the precursor spectra of parsed spectra (see read_mzml_spectrum),
+            yields Scan and list of encoded peak lists of the spectra to be stored.
+            Like in mzXML, empty spectra are not stored, but spectra referring to them keep them as precursor """
+        prec_scans = set()  # also find child spectra of scan_filter
+        mzml_scanids = {}  # {spectrum id: scanid}
+        last_scanids = {}  # {mslevel: scanid of last spectrum read at this level}
+        for spectrum_id, polarity, scan, encoded_peaks, precursor_ref in spectra:
+            mzml_scanids[spectrum_id] = scan.scanid
+            if polarity is None or polarity == self.polarity:
+                if scan.mslevel > 1:
+                    if precursor_ref is not None:
+                        scan.precursorscanid = mzml_scanids.get(precursor_ref)
+                        if scan.precursorscanid is None:
+                            scan.precursorscanid = self.mzml_scanid(precursor_ref)
+                    if scan.precursorscanid is None and scan.mslevel - 1 in last_scanids:
+                        # spectrum without reference to its precursor spectrum, assume that the preceding
+                        # spectrum at the precursor MS level is the precursor spectrum
+                        scan.precursorscanid = last_scanids[scan.mslevel - 1]
+                        logger.info('Assigning precursor scanid ' + str(scan.precursorscanid) +
+                                    ' to scan ' + str(scan.scanid) + '\n')
+                last_scanids[scan.mslevel] = scan.scanid
+                if scan.mslevel <= self.max_ms_level and \
+                        (scan.mslevel == 1 or (scan.precursorscanid is not None and scan.precursormz is not None)) and \
+                        (scan_filter is None or
+                         str(scan.scanid) == scan_filter or
+                         scan.precursorscanid in prec_scans):
+                    prec_scans.add(scan.scanid)
+                    if encoded_peaks is not None:
+                        yield scan, [encoded_peaks]
+
+    def iter_mzml_spectra(self, mzml_file, param_groups):
+        """ Stream all spectra from mzml_file, yields parsed spectra (see read_mzml_spectrum) """
+        namespace = '{http://psi.hupo.org/ms/mzml}'
+        for event, spectrum in etree.iterparse(mzml_file, events=('end',), tag=namespace + 'spectrum', huge_tree=True):
+            yield self.read_mzml_spectrum(spectrum, namespace, param_groups)
+            # free memory of processed spectra
+            spectrum.clear()
+            while spectrum.getprevious() is not None:
+                del spectrum.getparent()[0]
+
+    def read_mzml_param_groups(self, mzml_file):
+        """ Return {id: cvParams} of the referenceableParamGroups in the header of mzml_file """
+        namespace = '{http://psi.hupo.org/ms/mzml}'
+        param_groups = {}
+        for event, elem in etree.iterparse(mzml_file, events=('start', 'end'), huge_tree=True):
+            if event == 'start' and elem.tag == namespace + 'run':
+                break
+            if event == 'end' and elem.tag == namespace + 'referenceableParamGroup':
+                param_groups[elem.attrib['id']] = self.read_mzml_cvparams(elem, namespace, {})
+        return param_groups
+
+    def read_mzml_cvparams(self, elem, namespace, param_groups):
+        """ Return {accession: attributes} of the cvParams of elem, including referenced param groups """
+        cvparams = {}
+        for ref in elem.iterfind(namespace + 'referenceableParamGroupRef'):
+            cvparams.update(param_groups.get(ref.attrib['ref'], {}))
+        for cvparam in elem.iterfind(namespace + 'cvParam'):
+            cvparams[cvparam.attrib['accession']] = dict(cvparam.attrib)
+        return cvparams
+
+    def mzml_scanid(self, spectrum_id, index=None):
+        """ Return scan number from a native spectrum id (e.g. 'controllerType=0 controllerNumber=1 scan=5'),
+            or index + 1 if the id does not contain a scan number """
+        match = re.search(r'\bscan=(\d+)', spectrum_id)
+        if match is not None:
+            return int(match.group(1))
+        if index is not None:
+            return index + 1
+
+    def read_mzml_spectrum(self, spectrum, namespace, param_groups):
+        """ Parse mzML spectrum element.
+            Returns spectrum id, polarity ('+', '-' or None), Scan, encoded peak list (see decode_peak_lists,
+            None for an empty spectrum) and the id of the precursor spectrum """
+        cvparams = self.read_mzml_cvparams(spectrum, namespace, param_groups)
+        spectrum_id = spectrum.attrib['id']
+        polarity = None
+        if 'MS:1000130' in cvparams:
+            polarity = '+'
+        elif 'MS:1000129' in cvparams:
+            polarity = '-'
+        mslevel = 1
+        if 'MS:1000511' in cvparams:
+            mslevel = int(cvparams['MS:1000511']['value'])
+        rt = 0.0
+        scan_elem = spectrum.find(namespace + 'scanList/' + namespace + 'scan')
+        if scan_elem is not None:
+            scan_params = self.read_mzml_cvparams(scan_elem, namespace, param_groups)
+            if 'MS:1000016' in scan_params:  # scan start time
+                rt = float(scan_params['MS:1000016']['value'])
+                if scan_params['MS:1000016'].get('unitAccession') == 'UO:0000010':  # seconds
+                    rt /= 60
+        arrays = {}
+        for data_array in spectrum.iterfind(namespace + 'binaryDataArrayList/' + namespace + 'binaryDataArray'):
+            array_params = self.read_mzml_cvparams(data_array, namespace, param_groups)
+            compressed = 'MS:1000574' in array_params  # zlib compression
+            if 'MS:1000523' in array_params:  # 64-bit float
+                dtype = '<f8'
+            else:
+                dtype = '<f4'
+            if 'MS:1000514' in array_params:
+                arrays['mz'] = (data_array.findtext(namespace + 'binary'), compressed, dtype)
+            elif 'MS:1000515' in array_params:
+                arrays['intensity'] = (data_array.findtext(namespace + 'binary'), compressed, dtype)
+        encoded_peaks = None
+        if 'mz' in arrays and 'intensity' in arrays and spectrum.attrib.get('defaultArrayLength') != '0':
+            encoded_peaks = (arrays['mz'], arrays['intensity'])
+        scan = Scan(
+            scanid=self.mzml_scanid(spectrum_id, int(spectrum.attrib.get('index', 0))),
+            mslevel=mslevel,
+            rt=rt,
+            precursorscanid=(0 if mslevel == 1 else None)
+        )
+        if 'MS:1000528' in cvparams:
+            scan.lowmz = float(cvparams['MS:1000528']['value'])
+        if 'MS:1000527' in cvparams:
+            scan.highmz = float(cvparams['MS:1000527']['value'])
+        if 'MS:1000504' in cvparams:
+            scan.basepeakmz = float(cvparams['MS:1000504']['value'])
+        if 'MS:1000505' in cvparams:
+            scan.basepeakintensity = float(cvparams['MS:1000505']['value'])
+        if 'MS:1000285' in cvparams:
+            scan.totioncurrent = float(cvparams['MS:1000285']['value'])
+        precursor_ref = None
+        precursor = spectrum.find(namespace + 'precursorList/' + namespace + 'precursor')
+        if precursor is not None:
+            precursor_ref = precursor.attrib.get('spectrumRef')
+            ion_params = {}
+            selected_ion = precursor.find(namespace + 'selectedIonList/' + namespace + 'selectedIon')
+            if selected_ion is not None:
+                ion_params = self.read_mzml_cvparams(selected_ion, namespace, param_groups)
+            isolation_window = precursor.find(namespace + 'isolationWindow')
+            if 'MS:1000744' not in ion_params and isolation_window is not None:
+                # no selected ion m/z, use isolation window target m/z
+                window_params = self.read_mzml_cvparams(isolation_window, namespace, param_groups)
+                if 'MS:1000827' in window_params:
+                    ion_params['MS:1000744'] = window_params['MS:1000827']
+            if 'MS:1000744' in ion_params:
+                scan.precursormz = float(ion_params['MS:1000744']['value'])
+                scan.precursorintensity = float(ion_params.get('MS:1000042', {}).get('value', 0.0))
+        return spectrum_id, polarity, scan, encoded_peaks, precursor_ref
+
+    def read_indexed_mzml_spectra(self, mzml_file, scan_filter, param_groups):
+        """ Read the spectral tree of MS1 scan scan_filter by seeking to the byte offsets in the
+            spectrum index of an indexed mzML file. Returns a list with the parsed spectrum of scan_filter,
+            followed by the parsed spectra up to the next MS1 spectrum.
+            Returns None if the file does not have a valid index. """
+        mzml = open(mzml_file, 'rb')
+        try:
+            offsets = self.read_mzml_index(mzml)
+            if offsets is None:
+                return None
+            for i, (spectrum_id, offset) in enumerate(offsets):
+                if str(self.mzml_scanid(spectrum_id, i)) == scan_filter:
+                    break
+            else:
+                return None
+            spectra = []
+            for spectrum_id, offset in offsets[i:]:
+                spectrum = self.read_mzml_spectrum_element(mzml, offset)
+                if spectrum is None or spectrum.attrib.get('id') != spectrum_id:
+                    if len(spectra) == 0:
+                        logger.info('Invalid mzML index, reading complete file')
+                        return None
+                    break
+                # spectrum elements read as fragments are not in the mzML namespace
+                parsed_spectrum = self.read_mzml_spectrum(spectrum, '', param_groups)
+                if len(spectra) > 0 and parsed_spectrum[2].mslevel == 1:
+                    break
+                spectra.append(parsed_spectrum)
+            logger.info('Reading scan ' + scan_filter + ' using mzML index')
+            return spectra
+        finally:
+            mzml.close()
+
+    def read_mzml_index(self, mzml):
+        """ Return list of (spectrum id, byte offset) from the spectrum index of an open
+            indexed mzML file, or None if the file has no index """
+        mzml.seek(0, os.SEEK_END)
+        size = mzml.tell()
+        mzml.seek(max(0, size - 4096))
+        match = re.search(r'<indexListOffset>\s*(\d+)\s*</indexListOffset>', mzml.read())
+        if match is None or int(match.group(1)) >= size:
+            return None
+        mzml.seek(int(match.group(1)))
+        index = mzml.read()
+        start = index.find('<index name="spectrum"')
+        if start < 0:
+            return None
+        index = index[start:index.find('</index>', start)]
+        return [(spectrum_id, int(offset)) for spectrum_id, offset in
+                re.findall(r'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>', index)]
+
+    def read_mzml_spectrum_element(self, mzml, offset):
+        """ Parse the spectrum element starting at offset in an open mzML file,
+            returns None if no spectrum element starts at offset """
+        mzml.seek(offset)
+        fragment = ''
+        while True:
+            block = mzml.read(1048576)
+            if block == '':
+                return None
+            fragment += block
+            if not fragment.lstrip().startswith('<spectrum'):
+                return None
+            end = fragment.find('</spectrum>', max(0, len(fragment) - len(block) - 11))
+            if end >= 0:
+                try:
+                    return etree.fromstring(fragment[:end + 11].lstrip())
+                except etree.XMLSyntaxError:
+                    return None
+
+    def store_mgf(self, mgf_file, batch_size=1000):
+        """ Read all spectra from mgf_file and store each of them as a MS1 scan with a single
+            precursor peak and a MS2 scan with the fragment peaks.
+            Scans and peaks are written to the database in batches of batch_size spectra """
+        scanid = self.db_session.query(func.max(Scan.scanid)).scalar()
+        if scanid is None:
+            scanid = 0
+        scans = []
+        peaks = []
+        nspectra = 0
+        for rt, precursormz, precursorintensity, peaklist in self.read_mgf_spectra(mgf_file):
+            scanid += 2
+            mzs = [mz for mz, intensity in peaklist]
+            scans.append(dict(scanid=scanid - 1, mslevel=1, rt=rt,
+                              lowmz=precursormz, highmz=precursormz,
+                              basepeakmz=precursormz, basepeakintensity=precursorintensity,
+                              precursormz=None, precursorintensity=None,
+                              precursorscanid=0))
+            peaks.append(dict(scanid=scanid - 1, mz=precursormz, intensity=precursorintensity))
+            scans.append(dict(scanid=scanid, mslevel=2, rt=rt,
+                              lowmz=min(mzs), highmz=max(mzs),
+                              basepeakmz=precursormz, basepeakintensity=precursorintensity,
+                              precursormz=precursormz, precursorintensity=precursorintensity,
+                              precursorscanid=scanid - 1))
+            peaks.extend(dict(scanid=scanid, mz=mz, intensity=intensity) for mz, intensity in peaklist)
+            nspectra += 1
+            if nspectra % batch_size == 0:
+                self.insert_scans(scans, peaks)
+                scans = []
+                peaks = []
+        self.insert_scans(scans, peaks)
+        self.db_session.commit()
+        logger.info(str(nspectra) + ' spectra read from MGF file')
+
+    def insert_scans(self, scans, peaks):
+        # executemany inserts; all rows must have the same columns
+        if len(scans) > 0:
+            self.db_session.execute(Scan.__table__.insert(), scans)
+            self.db_session.execute(Peak.__table__.insert(), peaks)
+
+    def read_mgf_spectra(self, mgf_file):
+        """ Generator of (rt, precursormz, precursorintensity, peaklist) tuples,
+            one for each BEGIN IONS ... END IONS block in mgf_file """
+        mgf = open(mgf_file, 'r')
+        nblocks = 0
+        in_block = False
+        for line in mgf:
+            if not in_block:
+                if line[:10] == 'BEGIN IONS':
+                    in_block = True
+                    nblocks += 1
+                    peaklist = []
+                    rt = 0.0
+                    precursormz = None
+                    precursorintensity = 100.0
+                continue
             if line[:8] == "PEPMASS=":
                 precursormz = float(line.split()[0][8:])
                 if len(line.split()) > 1:
                     precursorintensity = float(line.split()[1])
-                else:
-                    precursorintensity = 100.0
             elif line[:12] == "RTINSECONDS=":
                 rt = float(line[12:])/60
             elif line[:8] == 'END IONS':
-                break
+                in_block = False
+                spectrum = self.check_mgf_spectrum(nblocks, rt, precursormz, precursorintensity, peaklist)
+                if spectrum is not None:
+                    yield spectrum
             else:
                 try:
                     mz = float(line.split()[0])
@@ -737,38 +1758,23 @@ class MsDataEngine(object):
                     peaklist.append([mz,intensity])
                 except:
                     pass
-        if not precursormz:
-            logger.info('Error in MGF file: no precursor mass defined with "PEPMASS=..."')
-            return
-        self.store_peak_list(1, rt, precursormz, [precursormz,precursorintensity], peaklist)
+        mgf.close()
+        if in_block:
+            # last block without END IONS
+            spectrum = self.check_mgf_spectrum(nblocks, rt, precursormz, precursorintensity, peaklist)
+            if spectrum is not None:
+                yield spectrum
+        if nblocks == 0:
+            logger.info('Error in MGF file: no "BEGIN IONS"')
 
-    def store_peak_list(self, scanid, rt, precursormz, basepeak, peaklist):
-        self.db_session.add(Scan(
-            scanid=scanid,
-            mslevel=1,
-            rt=rt,
-            lowmz=precursormz,
-            highmz=precursormz,
-            basepeakmz=precursormz,
-            basepeakintensity=basepeak[1],
-            precursorscanid=0
-        ))
-        self.db_session.add(Peak(scanid=scanid, mz=precursormz, intensity=basepeak[1]))
-        self.db_session.add(Scan(
-            scanid=scanid + 1,
-            mslevel=2,
-            rt=rt,
-            lowmz=peaklist[0][0],
-            highmz=peaklist[-1][0],
-            basepeakmz=basepeak[0],
-            basepeakintensity=basepeak[1],
-            precursormz=precursormz,
-            precursorintensity=basepeak[1],
-            precursorscanid=scanid
-        ))
-        for peak in peaklist:
-            self.db_session.add(Peak(scanid=scanid + 1, mz=peak[0], intensity=peak[1]))
-        self.db_session.commit()
+    def check_mgf_spectrum(self, nblock, rt, precursormz, precursorintensity, peaklist):
+        if not precursormz:
+            logger.info('Error in MGF file: no precursor mass defined with "PEPMASS=..." in spectrum ' + str(nblock))
+            return None
+        if len(peaklist) == 0:
+            logger.warn('Skipped spectrum ' + str(nblock) + ' in MGF file: no peaks')
+            return None
+        return rt, precursormz, precursorintensity, peaklist
 
     def store_manual_tree(self, manual_tree, tree_type):
         """ Store scans and peaks from mass tree formatted data in scans and peaks tables """
@@ -781,76 +1787,80 @@ class MsDataEngine(object):
                                 replace(',\n', ',').\
                                 replace('\n)', ')').\
                                 replace('\n', ',')
-        tree_list = re.split('([\,\(\)])',tree_string)
-        self.global_scanid = 1
-        self.store_manual_subtree(tree_list, 0, 0, 0, 1, tree_type)
-
-    def store_manual_subtree(self, tree_list, precursor_scanid, precursor_mz, precursor_intensity, mslevel, tree_type):
-        lowmz = None
-        highmz = None
-        basepeakmz = None
-        basepeakintensity = None
-        scanid = self.global_scanid
-        npeaks = 0
-        while len(tree_list) > 0 and tree_list[0] != ')':
-            tree_item = tree_list.pop(0)
+        tree_list = self.tree_separators.split(tree_string)
+        scanid = 1
+        # stack of scans which are being read, the last one is the current (sub)tree
+        # [scanid, precursor_scanid, precursor_mz, precursor_intensity, mslevel, peaks]
+        stack = [[1, 0, 0, 0, 1, []]]
+        scans = []
+        peaks = []
+        mz = None
+        intensity = None
+        for tree_item in tree_list:
             if tree_item.find(':') >= 0:
                 try:
                     mz, intensity = tree_item.split(':')
-                except:
+                    intensity = float(intensity)
+                    if tree_type == 0:
+                        mz = float(mz)
+                except ValueError:
                     raise FileFormatError('Corrupt Tree format ...')
                 if tree_type != 0:
                     mz = self.mass_from_formula(mz) - tree_type * pars.elmass
-                self.db_session.add(Peak(scanid=scanid, mz=mz, intensity=intensity))
-                npeaks += 1
-                if lowmz is None or mz < lowmz:
-                    lowmz = mz
-                if highmz is None or mz > highmz:
-                    highmz = mz
-                if basepeakintensity is None or intensity > basepeakintensity:
-                    basepeakmz = mz
-                    basepeakintensity = intensity
+                stack[-1][5].append((mz, intensity))
             elif tree_item == '(':
-                self.global_scanid += 1
-                self.store_manual_subtree(tree_list, scanid, mz, intensity, mslevel + 1, tree_type)
+                if mz is None:
+                    raise FileFormatError('Corrupt Tree format ...')
+                scanid += 1
+                stack.append([scanid, stack[-1][0], mz, intensity, stack[-1][4] + 1, []])
+            elif tree_item == ')':
+                self.add_manual_scan(scans, peaks, *stack.pop())
+                if len(stack) == 0:
+                    break
             elif tree_item != ',' and tree_item != '':
                 raise FileFormatError('Corrupt Tree format ...')
-        if npeaks > 0:
-            self.db_session.add(Scan(
-                scanid=scanid,
-                mslevel=mslevel,
-                lowmz=lowmz,
-                highmz=highmz,
-                basepeakmz=basepeakmz,
-                basepeakintensity=basepeakintensity,
-                precursorscanid=precursor_scanid,
-                precursormz=precursor_mz,
-                precursorintensity=precursor_intensity
-            ))
+        while len(stack) > 0:
+            self.add_manual_scan(scans, peaks, *stack.pop())
+        self.insert_scans(scans, peaks)
         self.db_session.commit()
-        if len(tree_list) > 0:
-            tree_list.pop(0)
+
+    def add_manual_scan(self, scans, peaks, scanid, precursor_scanid, precursor_mz, precursor_intensity,
+                        mslevel, scan_peaks):
+        """ Append rows for a scan of a mass tree and its peaks to scans and peaks """
+        if len(scan_peaks) == 0:
+            return
+        basepeakmz = None
+        basepeakintensity = None
+        for mz, intensity in scan_peaks:
+            peaks.append(dict(scanid=scanid, mz=mz, intensity=intensity))
+            if basepeakintensity is None or intensity > basepeakintensity:
+                basepeakmz = mz
+                basepeakintensity = intensity
+        scans.append(dict(
+            scanid=scanid,
+            mslevel=mslevel,
+            lowmz=min(scan_peaks)[0],
+            highmz=max(scan_peaks)[0],
+            basepeakmz=basepeakmz,
+            basepeakintensity=basepeakintensity,
+            precursorscanid=precursor_scanid,
+            precursormz=precursor_mz,
+            precursorintensity=precursor_intensity
+        ))
 
     def mass_from_formula(self, form):
         mass = 0.0
-        while len(form) > 0:
-            if form[:2] in pars.mims:
-                m = pars.mims[form[:2]]
-                form = form[2:]
-            elif form[:1] in pars.mims:
-                m = pars.mims[form[:1]]
-                form = form[1:]
-            else:
-                raise FileFormatError('Element not allowed in formula tree: ' + form)
-            x = 0
-            while len(form) > x and form[x] in '0123456789':
-                x += 1
-            if x > 0:
-                n = int(form[:x])
+        pos = 0
+        while pos < len(form):
+            match = self.formula_element.match(form, pos)
+            if match is None:
+                raise FileFormatError('Element not allowed in formula tree: ' + form[pos:])
+            element, count = match.groups()
+            if count == '':
+                mass += pars.mims[element]
             else:
-                n = 1
-            mass += m * n
-            form = form[x:]
+                mass += pars.mims[element] * int(count)
+            pos = match.end()
         return mass
 
 
@@ -1030,7 +2040,31 @@ class AnnotateEngine(object):
             peak_string += ')'
         return peak_string
 
-    def get_db_candidates(self, query_engine, max_mim=""):
+    def get_mim_ranges(self, mzs):
+        """ Returns {charge: sorted list of disjoint (low, high) mass limits} to retrieve candidate
+            molecules for the given m/z values from a structure database """
+        ranges = {}
+        for mz in mzs:
+            for charge in range(1, len(self.ions)):
+                # neutral candidates and singly charged candidates from database
+                for db_charge, ions in ((0, self.ions[charge]), (self.ionisation_mode, self.ions[charge - 1])):
+                    for ionmass in ions:
+                        ql = int(1e6 * ((min(mz / self.precision, mz - self.mz_precision_abs) - ionmass) *
+                                        charge + self.ionisation_mode * pars.elmass))
+                        qh = int(1e6 * ((max(mz * self.precision, mz + self.mz_precision_abs) - ionmass) *
+                                        charge + self.ionisation_mode * pars.elmass))
+                        ranges.setdefault(db_charge, []).append((ql, qh))
+        for db_charge in ranges:
+            merged = []
+            for ql, qh in sorted(ranges[db_charge]):
+                if len(merged) > 0 and ql <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], qh))
+                else:
+                    merged.append((ql, qh))
+            ranges[db_charge] = merged
+        return ranges
+
+    def get_db_candidates(self, query_engine, max_mim="", ranges_per_query=500):
         """ Query given query engine to retrieve all relevant candidate molecules,
             store in molecules table and return corresponding molids """
         logger.info('RETRIEVING CANDIDATE MOLECULES FROM: ' + str(query_engine.name))
@@ -1047,38 +2081,26 @@ class AnnotateEngine(object):
                 if not ((not self.use_all_peaks) and peak.childscan is None):
                     mzs.append(peak.mz)
         mzs.sort()
-        # build non-overlapping set of queries around these masses
+        # query non-overlapping mass ranges around these masses, in batches
+        ranges_charges = []
+        for charge, ranges in sorted(self.get_mim_ranges(mzs).iteritems()):
+            for start in range(0, len(ranges), ranges_per_query):
+                ranges_charges.append((ranges[start:start + ranges_per_query], charge))
         candidate = {}
-        for mz in mzs:
-            for charge in range(1, len(self.ions)):
-                for ionmass in self.ions[charge]:
-                    ql = int(1e6 * ((min(mz / self.precision, mz - self.mz_precision_abs) - ionmass) *
-                                    charge + self.ionisation_mode * pars.elmass))
-                    qh = int(1e6 * ((max(mz * self.precision, mz + self.mz_precision_abs) - ionmass) *
-                                    charge + self.ionisation_mode * pars.elmass))
-                    result = query_engine.query_on_mim(ql, qh, 0)
-                    for molecule in result:
-                        # remove duplicates
-                        candidate[molecule.inchikey14] = molecule
-                    logger.debug(str(ql) + ',' + str(qh) + ' --> ' + str(len(candidate)) + ' candidates')
-                # include singly charged candidates from database
-                for ionmass in self.ions[charge - 1]:
-                    ql = int(1e6 * ((min(mz / self.precision, mz - self.mz_precision_abs) - ionmass) *
-                                    charge + self.ionisation_mode * pars.elmass))
-                    qh = int(1e6 * ((max(mz * self.precision, mz + self.mz_precision_abs) - ionmass) *
-                                    charge + self.ionisation_mode * pars.elmass))
-                    result = query_engine.query_on_mim(ql, qh, self.ionisation_mode)
-                    for molecule in result:
-                        # remove duplicates
-                        candidate[molecule.inchikey14] = molecule
-                    logger.debug(str(ql) + ',' + str(qh) + ' --> ' + str(len(candidate)) + ' candidates')
+        for (ranges, charge), result in zip(ranges_charges, query_engine.query_candidates_batch(ranges_charges)):
+            for db_candidate in result:
+                # remove duplicates
+                candidate[db_candidate.inchikey14] = db_candidate
+            logger.debug(str(len(ranges)) + ' mass ranges of charge ' +
+                         str(charge) + ' --> ' + str(len(candidate)) + ' candidates')
         logger.info('Storing ' + str(len(candidate)) + ' candidates')
-        # in case of an empty database, no check for existing duplicates needed
-        check_duplicates = (self.db_session.query(Molecule.molid).count() > 0)
-        logger.debug('check duplicates: ' + str(check_duplicates))
         molids = set([])
-        for molecule in candidate.itervalues():
-            molid = struct_engine.add_molecule(molecule, check_duplicates=check_duplicates, merge=True)
+        known_molids = struct_engine.get_molids()
+        for db_candidate in candidate.itervalues():
+            # only name, reference and refscore are merged into molecules already in the database,
+            # their molblock is not decompressed
+            molecule = query_engine.candidate_molecule(db_candidate, db_candidate.inchikey14 not in known_molids)
+            molid = struct_engine.add_molecule(molecule, merge=True)
             molids.add(molid)
 
         # All candidates are stored in dbsession, resulting molids are returned
@@ -1247,6 +2269,362 @@ class AnnotateEngine(object):
         return score
 
 
+# row of the molecules table of a structure database, with base64 encoded and compressed molblock
+DatabaseCandidate = collections.namedtuple(
+    'DatabaseCandidate', ['cid', 'mim', 'charge', 'natoms', 'molblock', 'inchikey14', 'smiles', 'formula',
+                          'name', 'refs', 'logp'])
+
+
+def mim_ranges_select(ranges, charge, where=''):
+    """ Returns select statement (without SELECT) for molecules with given charge within any
+        of the (low, high) mass limits in ranges. Each range is a separate term of an OR, which sqlite
+        answers with a search of the index on (charge, mim) per term. Every sqlite version supports it,
+        unlike a join against a VALUES table, but sqlite allows at most about 990 ranges in one statement """
+    return '* FROM molecules WHERE ({:s}) {:s}'.format(
+        ' OR '.join('(charge = {:d} AND mim BETWEEN {:d} AND {:d})'.format(charge, low, high) for low, high in ranges),
+        where)
+
+
+class StructureService(object):
+
+    """Client of the MAGMa structure database service (see MAGMa/pubchem/magma_db_service.py),
+       which keeps connections alive between requests and retries failed requests"""
+
+    def __init__(self, url, retries=3, backoff=0.5, max_requests=4, queries_per_request=10):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        # maximum number of requests in flight at the same time
+        self.max_requests = max_requests
+        self.queries_per_request = queries_per_request
+        # services without the batch route are sent one query per request
+        self.batch_route = True
+        # requests sessions are not thread safe, each thread keeps its own
+        self.sessions = threading.local()
+
+    @property
+    def session(self):
+        """ Returns requests session of the current thread """
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.sessions.session = session
+        return session
+
+    @classmethod
+    def from_config(cls, db):
+        """ Returns client of service of database db as configured in the magma job config """
+        options = {}
+        for option, key in [('retries', 'structure_database.retries'),
+                            ('max_requests', 'structure_database.max_requests'),
+                            ('queries_per_request', 'structure_database.queries_per_request')]:
+            try:
+                options[option] = config.getint('magma job', key)
+            except ConfigParser.Error:
+                pass
+        return cls(config.get('magma job', 'structure_database.service') + '/' + db, **options)
+
+    def post(self, url, query):
+        """ Post json encoded query to url and return decoded response,
+            connection errors and server errors are retried with exponential backoff """
+        data = json.dumps(query)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.session.post(url, data=data)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                logger.debug('Retrying request to ' + url)
+                continue
+            if r.status_code < 500 or attempt == self.retries:
+                r.raise_for_status()
+                return r.json()
+            logger.debug('Retrying request to ' + url + ', status ' + str(r.status_code))
+
+    def query(self, query):
+        return self.post(self.url, query)
+
+    def query_batch(self, queries):
+        """ Returns list of results of queries, which are sent in batches of queries_per_request
+            with at most max_requests requests at the same time """
+        batches = [queries[start:start + self.queries_per_request]
+                   for start in range(0, len(queries), self.queries_per_request)]
+        if self.max_requests > 1 and len(batches) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(self.max_requests, len(batches)))
+            try:
+                results = pool.map(self.post_batch, batches)
+            finally:
+                pool.close()
+        else:
+            results = [self.post_batch(batch) for batch in batches]
+        return list(itertools.chain.from_iterable(results))
+
+    def post_batch(self, batch):
+        """ Returns list of results of the queries in batch, which are posted at once to the batch route,
+            or one by one if the service has no batch route """
+        if self.batch_route:
+            try:
+                return self.post(self.url + '/batch', batch)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                logger.info('No batch route at ' + self.url + ', sending queries one by one')
+                self.batch_route = False
+        return [self.post(self.url, query) for query in batch]
+
+
+class CandidateCache(object):
+
+    """Cache of candidate molecules of structure databases, shared between jobs in a sqlite file.
+       Candidates are stored per database in fixed mass buckets of bucket_size (in units of 1e-6 Da),
+       so mass windows of different jobs are answered from the same buckets.
+       Least recently used buckets are evicted when the cache exceeds max_size bytes"""
+
+    def __init__(self, filename, max_size=1e9, bucket_size=10000, ranges_per_query=500):
+        self.max_size = max_size
+        self.bucket_size = bucket_size
+        self.ranges_per_query = ranges_per_query
+        self.conn = sqlite3.connect(filename, timeout=30)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS buckets (db TEXT, charge INTEGER, bucket INTEGER, '
+                          'rows BLOB, size INTEGER, last_used REAL, PRIMARY KEY (db, charge, bucket))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS buckets_last_used ON buckets (last_used)')
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls):
+        """ Returns cache in structure_database.cache_dir of the magma job config, None if not configured """
+        try:
+            cache_dir = config.get('magma job', 'structure_database.cache_dir')
+        except ConfigParser.Error:
+            return None
+        try:
+            max_size = config.getfloat('magma job', 'structure_database.cache_size') * 1e6
+        except ConfigParser.Error:
+            max_size = 1e9
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return cls(os.path.join(cache_dir, 'candidates.db'), max_size)
+
+    def query_rows_batch(self, db, ranges_charges, query_rows_batch):
+        """ Returns list of molecule rows of each (ranges, charge) in ranges_charges, like query_rows_batch
+            of the structure database db, which is only queried for the buckets not in the cache """
+        now = time.time()
+        needed = {}  # {charge: set of buckets}
+        for ranges, charge in ranges_charges:
+            for low, high in ranges:
+                needed.setdefault(charge, set()).update(
+                    range(low // self.bucket_size, high // self.bucket_size + 1))
+        selected = ' OR '.join('(charge = {:d} AND bucket IN ({:s}))'.format(
+            charge, ','.join(str(bucket) for bucket in sorted(buckets))) for charge, buckets in sorted(needed.items()))
+        cached = {}  # {(charge, bucket): rows}
+        if len(needed) > 0:
+            for charge, bucket, rows in self.conn.execute(
+                    'SELECT charge, bucket, rows FROM buckets WHERE db = ? AND (' + selected + ')', (db,)):
+                cached[(charge, bucket)] = pickle.loads(zlib.decompress(rows))
+        logger.debug(str(len(cached)) + ' mass buckets from candidate cache')
+
+        # query missing buckets, with consecutive buckets as one mass range
+        missing = []
+        for charge, buckets in sorted(needed.items()):
+            ranges = []
+            for bucket in sorted(buckets):
+                if (charge, bucket) in cached:
+                    continue
+                if len(ranges) > 0 and ranges[-1][1] == bucket * self.bucket_size - 1:
+                    ranges[-1] = (ranges[-1][0], (bucket + 1) * self.bucket_size - 1)
+                else:
+                    ranges.append((bucket * self.bucket_size, (bucket + 1) * self.bucket_size - 1))
+            for start in range(0, len(ranges), self.ranges_per_query):
+                missing.append((ranges[start:start + self.ranges_per_query], charge))
+        new_buckets = []
+        for (ranges, charge), rows in zip(missing, query_rows_batch(missing)):
+            bucket_rows = {}
+            for low, high in ranges:
+                for bucket in range(low // self.bucket_size, high // self.bucket_size + 1):
+                    bucket_rows[bucket] = []
+            for row in rows:
+                bucket_rows[row[1] // self.bucket_size].append(tuple(row))
+            for bucket, rows in bucket_rows.iteritems():
+                cached[(charge, bucket)] = rows
+                blob = sqlite3.Binary(zlib.compress(pickle.dumps(rows, -1)))
+                new_buckets.append((db, charge, bucket, blob, len(blob), now))
+
+        try:
+            if len(needed) > 0:
+                self.conn.execute('UPDATE buckets SET last_used = ? WHERE db = ? AND (' + selected + ')', (now, db))
+            self.conn.executemany('INSERT OR REPLACE INTO buckets VALUES (?,?,?,?,?,?)', new_buckets)
+            if len(new_buckets) > 0:
+                self.evict()
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            # another job may be writing the cache, which is not required to continue
+            logger.warn('Candidate cache not updated: ' + str(e))
+            self.conn.rollback()
+        return [[row for low, high in ranges
+                 for bucket in range(low // self.bucket_size, high // self.bucket_size + 1)
+                 for row in cached[(charge, bucket)] if low <= row[1] <= high]
+                for ranges, charge in ranges_charges]
+
+    def evict(self):
+        """ Remove least recently used buckets until cache size is below max_size """
+        size = self.conn.execute('SELECT total(size) FROM buckets').fetchone()[0]
+        if size <= self.max_size:
+            return
+        evicted = []
+        for last_used, db, charge, bucket, bucket_size in self.conn.execute(
+                'SELECT last_used, db, charge, bucket, size FROM buckets ORDER BY last_used'):
+            if size <= self.max_size:
+                break
+            evicted.append((db, charge, bucket))
+            size -= bucket_size
+        self.conn.executemany('DELETE FROM buckets WHERE db = ? AND charge = ? AND bucket = ?', evicted)
+        logger.debug('Evicted ' + str(len(evicted)) + ' mass buckets from candidate cache')
+
+
+def database_version(*filenames):
+    """ Returns version string of database files, based on their size and modification time """
+    return ','.join('{:d}:{:f}'.format(os.path.getsize(filename), os.path.getmtime(filename))
+                    for filename in filenames)
+
+
+class MimIndex(object):
+
+    """Memory mapped index of the molecules table of a structure database, written by write_mim_index.
+       For each charge the molecules are sorted on mim and their rows are stored as numpy records
+       of fixed size, with a bit per column which is NULL. Text columns are stored as (offset, length)
+       of their value in a strings file. The layout is described by the numpy file headers,
+       loading the index does not unpickle anything"""
+
+    def __init__(self, dirname):
+        self.mims = {}
+        self.records = {}
+        for filename in os.listdir(dirname):
+            if filename.startswith('mim_'):
+                charge = int(filename[4:-4])
+                self.mims[charge] = numpy.load(os.path.join(dirname, filename), mmap_mode='r', allow_pickle=False)
+                self.records[charge] = numpy.load(os.path.join(dirname, 'rows_' + filename[4:]),
+                                                  mmap_mode='r', allow_pickle=False)
+        with open(os.path.join(dirname, 'strings'), 'rb') as strings_file:
+            if os.fstat(strings_file.fileno()).st_size > 0:
+                self.strings = mmap.mmap(strings_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.strings = ''
+
+    def query_rows(self, ranges, charge, filters=()):
+        """ Returns rows of molecules with given charge within any of the (low, high) mass limits in ranges,
+            for which all filters return True """
+        if charge not in self.mims:
+            return []
+        mims = self.mims[charge]
+        records = self.records[charge]
+        text_columns = [records.dtype[name].names is not None for name in records.dtype.names[1:]]
+        rows = []
+        for low, high in ranges:
+            for record in records[mims.searchsorted(low, 'left'):mims.searchsorted(high, 'right')].tolist():
+                row = self.decode_record(record, text_columns)
+                if all(f(row) for f in filters):
+                    rows.append(row)
+        return rows
+
+    def decode_record(self, record, text_columns):
+        """ Returns row of molecule record, text_columns tells which of its columns are text """
+        nulls = record[0]
+        row = []
+        for column, (value, text) in enumerate(zip(record[1:], text_columns)):
+            if nulls >> column & 1:
+                row.append(None)
+            elif text:
+                offset, length = value
+                row.append(self.strings[offset:offset + length])
+            else:
+                row.append(value)
+        return tuple(row)
+
+
+def mim_index_dtype(columns):
+    """ Returns numpy dtype of MimIndex records of rows with columns, the (name, declared type)
+        of the columns of the molecules table """
+    fields = [('nulls', '<i8')]
+    for name, coltype in columns:
+        coltype = coltype.upper()
+        if 'INT' in coltype:
+            fields.append((name, '<i8'))
+        elif 'REAL' in coltype or 'FLOA' in coltype or 'DOUB' in coltype:
+            fields.append((name, '<f8'))
+        else:
+            fields.append((name, [('offset', '<i8'), ('length', '<i8')]))
+    return numpy.dtype(fields)
+
+
+def write_mim_index(dbfilename, batch_size=10000):
+    """ Write MimIndex of the molecules table of structure database dbfilename to directory dbfilename.index """
+    dirname = dbfilename + '.index'
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for filename in os.listdir(dirname):
+        os.remove(os.path.join(dirname, filename))
+    conn = sqlite3.connect(dbfilename)
+    conn.text_factory = str
+    columns = [(name, coltype) for cid, name, coltype, notnull, default, pk in
+               conn.execute('PRAGMA table_info(molecules)')]
+    dtype = mim_index_dtype(columns)
+    kinds = [dtype[name].kind for name, coltype in columns]
+    charges = [charge for charge, in conn.execute('SELECT DISTINCT charge FROM molecules')]
+    with open(os.path.join(dirname, 'strings'), 'wb') as strings:
+        for charge in charges:
+            nrows = conn.execute('SELECT count(*) FROM molecules WHERE charge = ?', (charge,)).fetchone()[0]
+            mims = numpy.lib.format.open_memmap(os.path.join(dirname, 'mim_{:d}.npy'.format(charge)),
+                                                mode='w+', dtype=numpy.int64, shape=(nrows,))
+            records = numpy.lib.format.open_memmap(os.path.join(dirname, 'rows_{:d}.npy'.format(charge)),
+                                                   mode='w+', dtype=dtype, shape=(nrows,))
+            batch = []
+            start = 0
+            for row in conn.execute('SELECT * FROM molecules WHERE charge = ? ORDER BY mim, rowid', (charge,)):
+                nulls = 0
+                record = [0]
+                for column, (value, kind) in enumerate(zip(row, kinds)):
+                    if value is None:
+                        nulls |= 1 << column
+                        record.append((0, 0) if kind == 'V' else 0)
+                    elif kind == 'V':
+                        value = str(value)
+                        record.append((strings.tell(), len(value)))
+                        strings.write(value)
+                    elif kind == 'i' and not isinstance(value, (int, long)):
+                        raise ValueError('Molecule {}: {} is not an integer'.format(row[0], columns[column][0]))
+                    else:
+                        record.append(value)
+                record[0] = nulls
+                batch.append(tuple(record))
+                if len(batch) == batch_size:
+                    records[start:start + len(batch)] = batch
+                    start += len(batch)
+                    batch = []
+            records[start:start + len(batch)] = batch
+            mims[:] = records['mim']
+            del mims, records
+    conn.close()
+    # the index is only used for the version of the database from which it was written
+    with open(os.path.join(dirname, 'version'), 'w') as version_file:
+        version_file.write(database_version(dbfilename))
+
+
+def open_mim_index(dbfilename):
+    """ Returns MimIndex of structure database dbfilename, None if no index was written for this version of the database """
+    dirname = dbfilename + '.index'
+    try:
+        version = open(os.path.join(dirname, 'version')).read()
+    except IOError:
+        return None
+    if version != database_version(dbfilename):
+        logger.warn('Index ' + dirname + ' is outdated and not used')
+        return None
+    return MimIndex(dirname)
+
+
 class PubChemEngine(object):
 
     """Engine to retrieve candidate molecules from PubChem"""
@@ -1255,9 +2633,15 @@ class PubChemEngine(object):
         self.name = db
         if config.getboolean('magma job', 'structure_database.online') and online and dbfilename == '':
             self.query = self.query_online
-            self.service = config.get('magma job', 'structure_database.service')+'/'+db
+            self.query_batch = self.query_online_batch
+            self.service = StructureService.from_config(db)
+            # the service does not report the version of its databases,
+            # so the candidate cache must be removed when they are updated
+            version = self.service.url
+            self.mim_index = None
         else:
             self.query = self.query_local
+            self.query_batch = self.query_local_batch
             databases = {'pubchem': 'structure_database.pubchem', 'kegg': 'structure_database.kegg'}
             halo_databases = {'pubchem': 'structure_database.pubchem_halo', 'kegg': 'structure_database.kegg_halo'}
             if dbfilename == '':
@@ -1269,25 +2653,37 @@ class PubChemEngine(object):
             self.connh = sqlite3.connect(halo_filename)
             self.connh.text_factory = str
             self.ch = self.connh.cursor()
+            version = database_version(dbfilename, halo_filename)
+            self.mim_index = open_mim_index(dbfilename)
+            self.mim_index_halo = open_mim_index(halo_filename)
         self.incl_halo = False
         if incl_halo != '' and incl_halo != False:
             self.incl_halo = True
+        if self.incl_halo and self.mim_index is not None and self.mim_index_halo is None:
+            self.mim_index = None
         self.where = ''
+        # same conditions as where for rows of the mim index
+        self.filters = []
         if min_refscore != '':
             self.where += ' AND refscore >= ' + min_refscore
+            self.filters.append(lambda row: row[9] >= float(min_refscore))
         if max_64atoms:
             self.where += ' AND natoms <= 64'
+            self.filters.append(lambda row: row[3] <= 64)
         if ids_file:
             ids = ','.join([i.split()[0] for i in open(ids_file, 'r') if i not in ['\n', '\r\n']])
             self.where += ' AND cid IN (' + ids + ')'
+            cids = set(int(cid) for cid in ids.split(','))
+            self.filters.append(lambda row: row[0] in cids)
+        self.cache = CandidateCache.from_config()
+        # filters are part of the key as hash, the cid list of an ids file can be long
+        self.cache_key = '|'.join([db, version, str(self.incl_halo), hashlib.sha1(self.where).hexdigest()])
 
     def query_online(self, select, incl_halo):
-        r = requests.post(self.service, data=json.dumps([select, incl_halo]))
-        try:
-            result = r.json()
-        except:
-            result = r.json # for compatibility with older version of requests
-        return result
+        return self.service.query([select, incl_halo])
+
+    def query_online_batch(self, selects, incl_halo):
+        return self.service.query_batch([[select, incl_halo] for select in selects])
 
     def query_local(self, select, incl_halo):
         """ Return all molecules with given charge from HMDB between low and high mass limits """
@@ -1300,41 +2696,73 @@ class PubChemEngine(object):
             result += self.ch.execute(select_statement).fetchall()
         return result
 
+    def query_local_batch(self, selects, incl_halo):
+        return [self.query_local(select, incl_halo) for select in selects]
+
     def query_on_mim(self, low, high, charge):
         """ Return all molecules with given charge between low and high mass limits """
-        molecules = []
-        select = '* FROM molecules WHERE charge = {:d} AND mim BETWEEN {:d} AND {:d} {:s}'.format(
-            charge, low, high, self.where)
-        result = self.query(select, self.incl_halo)
-        for (cid, mim, charge, natoms, molblock, inchikey, smiles, molform, name, refs, logp) in result:
-            if self.name == 'pubchem':
-                refscore = refs
-                reference = '<a href="http://www.ncbi.nlm.nih.gov/sites/entrez?db=pccompound&cmd=Link&'+\
-                            'LinkName=pccompound_pccompound_sameisotopic_pulldown&from_uid='+str(cid)+'" target="_blank">'+str(cid)+' (PubChem)</a>'
-            elif self.name == 'kegg':
-                refscore = None
-                keggids = refs.split(',')
-                reference = '<a href="http://www.genome.jp/dbget-bin/www_bget?cpd:' + \
-                    keggids[0] + '" target="_blank">' + keggids[0] + ' (Kegg)</a>'
-                for keggid in keggids[1:]:
-                    reference += '<br><a href="http://www.genome.jp/dbget-bin/www_bget?cpd:' + \
-                        keggid + '" target="_blank">' + keggid + ' (Kegg)</a>'
-            else:
-                exit(self.name)
-            molecules.append(get_molecule(
-                           zlib.decompress(base64.decodestring(molblock)),
-                           name+' (' + str(cid) + ')',
-                           refscore,
-                           0,
-                           mim=float(mim / 1e6),
-                           natoms=natoms,
-                           molform=molform,
-                           inchikey14=inchikey,
-                           smiles=smiles,
-                           reference=reference,
-                           logp=float(logp) / 10.0,
-                           ))
-        return molecules
+        return self.query_on_mim_ranges([(low, high)], charge)
+
+    def query_on_mim_ranges(self, ranges, charge):
+        """ Return all molecules with given charge within any of the (low, high) mass limits in ranges """
+        return [self.candidate_molecule(candidate) for candidate in self.query_candidates(ranges, charge)]
+
+    def query_candidates(self, ranges, charge):
+        """ Return all molecules with given charge within any of the (low, high) mass limits in ranges,
+            as DatabaseCandidate records with compressed molblocks """
+        return self.query_candidates_batch([(ranges, charge)])[0]
+
+    def query_candidates_batch(self, ranges_charges):
+        """ Returns list of query_candidates results for each (ranges, charge) in ranges_charges,
+            from the candidate cache if configured, online in as few requests as possible """
+        if self.cache is None:
+            results = self.query_rows_batch(ranges_charges)
+        else:
+            results = self.cache.query_rows_batch(self.cache_key, ranges_charges, self.query_rows_batch)
+        return [[DatabaseCandidate._make(row) for row in result] for result in results]
+
+    def query_rows_batch(self, ranges_charges):
+        if self.mim_index is not None:
+            return [self.query_mim_index(ranges, charge) for ranges, charge in ranges_charges]
+        return self.query_batch([mim_ranges_select(ranges, charge, self.where)
+                                 for ranges, charge in ranges_charges], self.incl_halo)
+
+    def query_mim_index(self, ranges, charge):
+        rows = self.mim_index.query_rows(ranges, charge, self.filters)
+        if self.incl_halo:
+            rows += self.mim_index_halo.query_rows(ranges, charge, self.filters)
+        return rows
+
+    def candidate_molecule(self, candidate, decompress=True):
+        """ Return Molecule of DatabaseCandidate record, without molblock if not decompress """
+        cid, mim, charge, natoms, molblock, inchikey, smiles, molform, name, refs, logp = candidate
+        if self.name == 'pubchem':
+            refscore = refs
+            reference = '<a href="http://www.ncbi.nlm.nih.gov/sites/entrez?db=pccompound&cmd=Link&'+\
+                        'LinkName=pccompound_pccompound_sameisotopic_pulldown&from_uid='+str(cid)+'" target="_blank">'+str(cid)+' (PubChem)</a>'
+        elif self.name == 'kegg':
+            refscore = None
+            keggids = refs.split(',')
+            reference = '<a href="http://www.genome.jp/dbget-bin/www_bget?cpd:' + \
+                keggids[0] + '" target="_blank">' + keggids[0] + ' (Kegg)</a>'
+            for keggid in keggids[1:]:
+                reference += '<br><a href="http://www.genome.jp/dbget-bin/www_bget?cpd:' + \
+                    keggid + '" target="_blank">' + keggid + ' (Kegg)</a>'
+        else:
+            exit(self.name)
+        return get_molecule(
+                       zlib.decompress(base64.decodestring(molblock)) if decompress else '',
+                       name+' (' + str(cid) + ')',
+                       refscore,
+                       0,
+                       mim=float(mim / 1e6),
+                       natoms=natoms,
+                       molform=molform,
+                       inchikey14=inchikey,
+                       smiles=smiles,
+                       reference=reference,
+                       logp=float(logp) / 10.0,
+                       )
 
     def check_inchi(self, mim, inchikey14):
         """ Function to look up uploaded structures in PubChem based on inchikey. Returns refscore and reference.
@@ -1360,25 +2788,35 @@ class HmdbEngine(object):
         self.name = 'Human Metabolite Database'
         if config.getboolean('magma job', 'structure_database.online') and online and dbfilename == "":
             self.query = self.query_online
-            self.service = config.get('magma job', 'structure_database.service')+'/hmdb'
+            self.query_batch = self.query_online_batch
+            self.service = StructureService.from_config('hmdb')
+            # the service does not report the version of its databases,
+            # so the candidate cache must be removed when they are updated
+            version = self.service.url
+            self.mim_index = None
         else:
             self.query = self.query_local
+            self.query_batch = self.query_local_batch
             if dbfilename == '':
                 dbfilename = config.get('magma job', 'structure_database.hmdb')
             self.conn = sqlite3.connect(dbfilename)
             self.conn.text_factory = str
             self.c = self.conn.cursor()
+            version = database_version(dbfilename)
+            self.mim_index = open_mim_index(dbfilename)
         self.where = ''
+        self.filters = []
         if max_64atoms == True:
             self.where += ' AND natoms <= 64'
+            self.filters.append(lambda row: row[3] <= 64)
+        self.cache = CandidateCache.from_config()
+        self.cache_key = '|'.join(['hmdb', version, hashlib.sha1(self.where).hexdigest()])
 
     def query_online(self, select):
-        r = requests.post(self.service, data=json.dumps([select]))
-        try:
-            result = r.json()
-        except:
-            result = r.json # for compatibility with older version of requests
-        return result
+        return self.service.query([select])
+
+    def query_online_batch(self, selects):
+        return self.service.query_batch([[select] for select in selects])
 
     def query_local(self, select):
         """ Return all molecules with given charge from HMDB between low and high mass limits """
@@ -1388,32 +2826,52 @@ class HmdbEngine(object):
         select_statement = "SELECT " + select
         return self.c.execute(select_statement).fetchall()
 
+    def query_local_batch(self, selects):
+        return [self.query_local(select) for select in selects]
+
     def query_on_mim(self, low, high, charge):
-        molecules = []
-        select = '* FROM molecules WHERE charge = {:d} AND mim BETWEEN {:d} AND {:d} {:s}'.format(
-                                charge, low, high, self.where)
-        result = self.query(select)
-        for (cid, mim, charge, natoms, molblock, inchikey, smiles, molform, name, reference, logp) in result:
-            hmdb_ids = reference.split(',')
-            hmdb_refs = '<a href="http://www.hmdb.ca/metabolites/' + \
-                hmdb_ids[0] + '" target="_blank">' + hmdb_ids[0] + ' (HMDB)</a>'
-            for hmdb_id in hmdb_ids[1:]:
-                hmdb_refs += '<br><a href="http://www.hmdb.ca/metabolites/' + \
-                    hmdb_id + '" target="_blank">' + hmdb_id + ' (HMDB)</a>'
-            molecules.append(get_molecule(
-                           zlib.decompress(base64.decodestring(molblock)),
-                           name + ' (' + str(cid) + ')',
-                           None,
-                           0,
-                           mim=float(mim / 1e6),
-                           natoms=natoms,
-                           molform=molform,
-                           inchikey14=inchikey,
-                           smiles=smiles,
-                           reference=hmdb_refs,
-                           logp=float(logp) / 10.0,
-                           ))
-        return molecules
+        return self.query_on_mim_ranges([(low, high)], charge)
+
+    def query_on_mim_ranges(self, ranges, charge):
+        return [self.candidate_molecule(candidate) for candidate in self.query_candidates(ranges, charge)]
+
+    def query_candidates(self, ranges, charge):
+        return self.query_candidates_batch([(ranges, charge)])[0]
+
+    def query_candidates_batch(self, ranges_charges):
+        if self.cache is None:
+            results = self.query_rows_batch(ranges_charges)
+        else:
+            results = self.cache.query_rows_batch(self.cache_key, ranges_charges, self.query_rows_batch)
+        return [[DatabaseCandidate._make(row) for row in result] for result in results]
+
+    def query_rows_batch(self, ranges_charges):
+        if self.mim_index is not None:
+            return [self.mim_index.query_rows(ranges, charge, self.filters) for ranges, charge in ranges_charges]
+        return self.query_batch([mim_ranges_select(ranges, charge, self.where)
+                                 for ranges, charge in ranges_charges])
+
+    def candidate_molecule(self, candidate, decompress=True):
+        cid, mim, charge, natoms, molblock, inchikey, smiles, molform, name, reference, logp = candidate
+        hmdb_ids = reference.split(',')
+        hmdb_refs = '<a href="http://www.hmdb.ca/metabolites/' + \
+            hmdb_ids[0] + '" target="_blank">' + hmdb_ids[0] + ' (HMDB)</a>'
+        for hmdb_id in hmdb_ids[1:]:
+            hmdb_refs += '<br><a href="http://www.hmdb.ca/metabolites/' + \
+                hmdb_id + '" target="_blank">' + hmdb_id + ' (HMDB)</a>'
+        return get_molecule(
+                       zlib.decompress(base64.decodestring(molblock)) if decompress else '',
+                       name + ' (' + str(cid) + ')',
+                       None,
+                       0,
+                       mim=float(mim / 1e6),
+                       natoms=natoms,
+                       molform=molform,
+                       inchikey14=inchikey,
+                       smiles=smiles,
+                       reference=hmdb_refs,
+                       logp=float(logp) / 10.0,
+                       )
 
 
 class ExportMoleculesEngine(object):
@@ -1421,17 +2879,29 @@ class ExportMoleculesEngine(object):
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def export_molecules(self, output_format='sdf', file=sys.stdout, columns=None, sortcolumn='refscore', descend=True):
+    def export_molecules(self, output_format='sdf', file=sys.stdout, columns=None, sortcolumn='refscore', descend=True,
+                         scanid=None):
         """ Write SDFile or smiles with candidate molecules to file (or stdout).
-            If data is for a single percursor ion: also provide candidate scores and sort accordingly """
+            If data is for a single percursor ion: also provide candidate scores and sort accordingly.
+            If scanid is given, only the candidates matched to the precursor ion in this MS1 scan are
+            written, with their scores """
         # If data is for a single percursor ion: also provide candidate scores and sort accordingly
-        nprecursors = self.db_session.query(Fragment.mz, Fragment.scanid).\
-                      filter(Fragment.parentfragid == 0).distinct().count()
+        if scanid is None:
+            nprecursors = self.db_session.query(Fragment.mz, Fragment.scanid).\
+                          filter(Fragment.parentfragid == 0).distinct().count()
+        else:
+            nprecursors = self.db_session.query(Fragment.mz, Fragment.scanid).\
+                          filter(Fragment.parentfragid == 0).\
+                          filter(Fragment.scanid == scanid).distinct().count()
         if nprecursors == 1:
-            result = self.db_session.query(Molecule, Fragment.score).\
-                     filter(Molecule.molid == Fragment.molid).\
-                     filter(Fragment.parentfragid == 0).\
-                     order_by(Fragment.score, desc(Molecule.refscore)).all()
+            query = self.db_session.query(Molecule, Fragment.score).\
+                    filter(Molecule.molid == Fragment.molid).\
+                    filter(Fragment.parentfragid == 0)
+            if scanid is not None:
+                query = query.filter(Fragment.scanid == scanid)
+            result = query.order_by(Fragment.score, desc(Molecule.refscore)).all()
+        elif scanid is not None:
+            return
         else:
             if descend:
                 result = self.db_session.query(Molecule, Molecule.molid).order_by(desc(sortcolumn)).all()
@@ -1442,6 +2912,8 @@ class ExportMoleculesEngine(object):
                 file.write(molecule.mol)
                 if nprecursors == 1:
                     file.write('> <score>\n%.5f\n\n' % value)
+                if scanid is not None:
+                    file.write('> <scanid>\n%i\n\n' % scanid)
                 if columns is None:
                     columns = dir(molecule)
                 for column in columns:
@@ -1452,6 +2924,8 @@ class ExportMoleculesEngine(object):
                 file.write(molecule.smiles)
                 if nprecursors == 1:
                     file.write(' score=%.5f' % value)
+                if scanid is not None:
+                    file.write(' scanid=%i' % scanid)
                 if columns is None:
                     columns = ['name','refscore','formula','mim']
                 for column in columns:
@@ -1565,3 +3039,38 @@ def search_structure(mol, mim, molcharge, peaks, max_broken_bonds, max_water_los
                     add_fragment_data_to_hit(hit)
                     hits.append(hit)
     return (hits, frags)
+
+
+def decode_peak_lists(encoded_peak_lists, abs_peak_cutoff):
+    """ Decode base64 encoded peak lists of mzXML or mzML spectra (also used in parallel processes).
+        Each encoded peak list is a tuple (mz_array, intensity_array), where an array is a tuple of
+        base64 data, zlib compression (boolean) and numpy dtype. In case of mzXML the m/z-intensity
+        pairs are in mz_array and intensity_array is None.
+        Returns a list with for each peak list a tuple of the list of (mz, intensity) tuples above
+        abs_peak_cutoff and (lowest m/z, highest m/z, base peak m/z, base peak intensity),
+        the latter is None for an empty peak list """
+    def decode_array(data, compressed, dtype):
+        decoded = base64.b64decode(data or '')
+        if compressed:
+            decoded = zlib.decompress(decoded)
+        return numpy.frombuffer(decoded, dtype=dtype).astype(numpy.float64)
+
+    decoded_peak_lists = []
+    for mz_array, intensity_array in encoded_peak_lists:
+        if intensity_array is None:
+            pairs = decode_array(*mz_array)
+            npeaks = len(pairs) // 2
+            mzs = pairs[0:2 * npeaks:2]
+            intensities = pairs[1:2 * npeaks:2]
+        else:
+            mzs = decode_array(*mz_array)
+            intensities = decode_array(*intensity_array)
+        if len(mzs) == 0:
+            decoded_peak_lists.append(([], None))
+            continue
+        selected = intensities > abs_peak_cutoff
+        peaks = zip(mzs[selected].tolist(), intensities[selected].tolist())
+        basepeak = intensities.argmax()
+        decoded_peak_lists.append((peaks, (float(mzs.min()), float(mzs.max()),
+                                           float(mzs[basepeak]), float(intensities[basepeak]))))
+    return decoded_peak_lists
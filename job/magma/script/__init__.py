@@ -27,6 +27,7 @@ class MagmaCommand(object):
         sc.add_argument('-t', '--structure_format', help="Structure input type (default: %(default)s)", default="smiles", choices=["smiles", "sdf"])
         sc.add_argument('-g', '--pubchem_names', help="Get references to PubChem (default: %(default)s)", action="store_true")
         sc.add_argument('-m', '--mass_filter', help="Filter input structures on maximum monoisotopic mass (default: %(default)s)", default=9999,type=int)
+        sc.add_argument('-c', '--ncpus', help="Number of parallel cpus to use for reading structures (default: %(default)s)", default=1,type=int)
         sc.add_argument('-l', '--log', help="Set logging level (default: %(default)s)", default='info',choices=['debug','info','warn','error'])
         sc.add_argument('structures', type=str, help="File with structures, or a single smiles string")
         sc.add_argument('db', type=str, help="Sqlite database file with results")
@@ -40,6 +41,9 @@ class MagmaCommand(object):
         sc.add_argument('-m', '--metabolism_types', help="digest,gut,phase1,phase2, (default: %(default)s)", default="phase1,phase2", type=str)
         sc.add_argument('-s', '--scenario', default=None, type=str, help="""Scenario file, each line defines a separate stage:
                                         action(glycosidase/gut/phase1[_selected]/phase2[_selected]/mass_filter),value(nsteps/mass limit)""")
+        sc.add_argument('-c', '--ncpus', help="Number of parallel cpus to use for metabolism (default: %(default)s)", default=1,type=int)
+        sc.add_argument('-w', '--beam_width', help="Keep only this number of most probable new metabolites in each reaction step of a scenario (default: %(default)s)", default=None,type=int)
+        sc.add_argument('--beam_per_parent', help="Apply beam width to the metabolites of each parent molecule (default: %(default)s)", action="store_true")
         sc.add_argument('-t', '--time_limit', help="Maximum allowed time in minutes (default: %(default)s)", default=None,type=float)
         sc.add_argument('-g', '--pubchem_names', help="Get references to PubChem. Only available with local PubChem database (default: %(default)s)", action="store_true")
         sc.add_argument('-l', '--log', help="Set logging level (default: %(default)s)", default='info',choices=['debug','info','warn','error'])
@@ -51,7 +55,7 @@ class MagmaCommand(object):
         sc.add_argument('-z', '--description', help="Description of the job (default: %(default)s)", default="",type=str)
         # read_ms_data arguments
         sc.add_argument('ms_data', type=str, help="file with MS/MS data")
-        sc.add_argument('-f', '--ms_data_format', help="MS data input format (default: %(default)s)", default="mzxml", choices=["mzxml", "mass_tree","form_tree_pos","form_tree_neg","mgf"])
+        sc.add_argument('-f', '--ms_data_format', help="MS data input format (default: %(default)s)", default="mzxml", choices=["mzxml", "mzml", "mass_tree","form_tree_pos","form_tree_neg","mgf"])
         sc.add_argument('-i', '--ionisation_mode', help="Ionisation mode (default: %(default)s)", default="1", choices=["-1", "1"])
         sc.add_argument('-m', '--max_ms_level', help="Maximum MS level to be processsed (default: %(default)s)", default=10,type=int)
         sc.add_argument('-a', '--abs_peak_cutoff', help="Absolute intensity threshold for storing peaks in database (default: %(default)s)", default=1000,type=float)
@@ -59,6 +63,7 @@ class MagmaCommand(object):
         sc.add_argument('-q', '--mz_precision_abs', help="Maximum absolute m/z error (Da) (default: %(default)s)", default=0.001,type=float)
         sc.add_argument('--precursor_mz_precision', help="Maximum absolute error of precursor m/z values (default: %(default)s)", default=0.005,type=float)
         sc.add_argument('-s', '--scan', help="Read only spectral tree specified by MS1 scan number (default: %(default)s)", default=None,type=str)
+        sc.add_argument('-n', '--ncpus', help="Number of parallel cpus to use for decoding mzXML or mzML peaks (default: %(default)s)", default=1,type=int)
         sc.add_argument('-t', '--time_limit', help="Maximum allowed time in minutes (default: %(default)s)", default=None,type=float)
         sc.add_argument('-l', '--log', help="Set logging level (default: %(default)s)", default='info',choices=['debug','info','warn','error'])
         sc.add_argument('--call_back_url', help="Call back url (default: %(default)s)", default=None,type=str)
@@ -135,7 +140,8 @@ class MagmaCommand(object):
     
     def light(self, args, file=sys.stdout):
         """
-        This option runs all MAGMa components in one go to generate a ranked list of compounds (smiles of SDF) for a single spectrum/spectral tree.
+        This option runs all MAGMa components in one go to generate a ranked list of compounds (smiles of SDF) for a single spectrum/spectral tree,
+        or for each spectrum in a MGF file.
         (This will not create a database file for the webapplication)
         """
         try:
@@ -194,7 +200,12 @@ class MagmaCommand(object):
             magma_session.commit()
             # export results
             export_engine = magma_session.get_export_molecules_engine()
-            export_engine.export_molecules(args.output_format, file=file)
+            if len(annotate_engine.scans) > 1:
+                # ranked list of candidates for each spectrum
+                for scan in annotate_engine.scans:
+                    export_engine.export_molecules(args.output_format, file=file, scanid=scan.scanid)
+            else:
+                export_engine.export_molecules(args.output_format, file=file)
 
         except Exception as error:
             if args.log == 'debug':
@@ -208,9 +219,9 @@ class MagmaCommand(object):
                 magma_session = self.get_magma_session(args.db, args.description, args.log)
             struct_engine = magma_session.get_structure_engine(pubchem_names=args.pubchem_names)
             if args.structure_format == 'smiles':
-                struct_engine.read_smiles(args.structures, mass_filter=args.mass_filter)
+                struct_engine.read_smiles(args.structures, mass_filter=args.mass_filter, ncpus=args.ncpus)
             elif args.structure_format == 'sdf':
-                struct_engine.read_sdf(args.structures, args.mass_filter)
+                struct_engine.read_sdf(args.structures, args.mass_filter, args.ncpus)
             magma_session.commit()
         except Exception as error:
             if args.log == 'debug':
@@ -231,9 +242,9 @@ class MagmaCommand(object):
                     step=line.split('#')[0].rstrip().split(',') # Comments indicated by # are allowed
                     if len(step)>1:
                         scenario.append(step)
-                struct_engine.run_scenario(scenario, args.time_limit)
+                struct_engine.run_scenario(scenario, args.time_limit, args.ncpus, args.beam_width, args.beam_per_parent)
             elif args.molids is None:
-                molids=struct_engine.metabolize_all(args.metabolism_types, args.n_reaction_steps)
+                molids=struct_engine.metabolize_all(args.metabolism_types, args.n_reaction_steps, args.ncpus)
                 for molid in molids:
                     print molid
             else:
@@ -242,7 +253,7 @@ class MagmaCommand(object):
                     molids.extend(struct_engine.metabolize(reactantid, args.metabolism_types, args.n_reaction_steps))
                 for molid in set(molids):
                     print molid
-            magma_session.fill_molecules_reactions()
+            magma_session.fill_molecules_reactions(struct_engine.reacted_molids)
         except Exception as error:
             if args.log == 'debug':
                 logging.exception(error)
@@ -261,7 +272,9 @@ class MagmaCommand(object):
                     max_ms_level=args.max_ms_level,
                     call_back_url=args.call_back_url)
             if args.ms_data_format == "mzxml":
-                ms_data_engine.store_mzxml_file(args.ms_data, args.scan, args.time_limit)
+                ms_data_engine.store_mzxml_file(args.ms_data, args.scan, args.time_limit, args.ncpus)
+            elif args.ms_data_format == "mzml":
+                ms_data_engine.store_mzml_file(args.ms_data, args.scan, args.time_limit, args.ncpus)
             elif args.ms_data_format == "mgf":
                 ms_data_engine.store_mgf(args.ms_data)
             else:
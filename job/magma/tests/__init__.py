@@ -1,5 +1,9 @@
 import unittest
 import mock
+import json
+import threading
+import BaseHTTPServer
+import SocketServer
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from rdkit import Chem
@@ -7,7 +11,7 @@ from rdkit.Chem import AllChem
 import pkg_resources
 import magma
 from magma.errors import FileFormatError,DataProcessingError
-from magma.models import Base, Molecule, Scan, Peak, Fragment, Run
+from magma.models import Base, Molecule, Reaction, Scan, Peak, Fragment, Run
 
 class TestMagmaSession(unittest.TestCase):
     def test_construct_with_new_db(self):
@@ -155,6 +159,36 @@ class TestStructureEngine(unittest.TestCase):
                              mol.__dict__
                              )
 
+    def test_calculate_properties(self):
+        mol = Chem.MolFromSmiles('OCC')
+
+        properties = magma.calculate_properties(mol)
+
+        inchikey14, smiles, mim, natoms, formula, logp = properties
+        self.assertEqual(inchikey14, 'LFQSCWFLJHTTHZ')
+        self.assertEqual(smiles, 'CCO')
+        self.assertAlmostEqual(mim, 46.0418648147)
+        self.assertEqual(natoms, 3)
+        self.assertEqual(formula, 'C2H6O')
+        self.assertAlmostEqual(logp, -0.0014)
+        # second call for the same structure is answered from the cache
+        self.assertIs(magma.calculate_properties(Chem.MolFromSmiles('CCO')), properties)
+
+    @mock.patch.object(magma, 'properties_cache_size', 2)
+    @mock.patch.dict(magma.properties_cache, clear=True)
+    def test_calculate_properties_cache_eviction(self):
+        ethanol = magma.calculate_properties(Chem.MolFromSmiles('CCO'))
+        methanol = magma.calculate_properties(Chem.MolFromSmiles('CO'))
+        # using ethanol makes methanol the least recently used
+        self.assertIs(magma.calculate_properties(Chem.MolFromSmiles('CCO')), ethanol)
+
+        propanol = magma.calculate_properties(Chem.MolFromSmiles('CCCO'))
+
+        self.assertEqual(magma.properties_cache.keys(), ['CCO', 'CCCO'])
+        self.assertIs(magma.calculate_properties(Chem.MolFromSmiles('CCCO')), propanol)
+        self.assertIsNot(magma.calculate_properties(Chem.MolFromSmiles('CO')), methanol)
+        self.assertEqual(magma.properties_cache.keys(), ['CCCO', 'CO'])
+
     def test_add_structure_2nd_replace(self):
         se = magma.StructureEngine(self.db_session)
 
@@ -235,6 +269,171 @@ class TestStructureEngine(unittest.TestCase):
 
         se.metabolize.assert_called_with(parent_molid, u'phase1',False)
 
+    def metabolize_all(self, ncpus):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        db_session = sessionmaker(bind=engine)()
+        se = magma.StructureEngine(db_session)
+        se.read_smiles('Oc1cc(CC2OCCC2)cc(O)c1O')
+        se.read_smiles('CC(=O)Nc1ccc(O)cc1')
+        se.metabolize_all(u'phase1', ncpus=ncpus)
+        inchikeys = dict(db_session.query(Molecule.molid, Molecule.inchikey14))
+        molecules = db_session.query(Molecule.inchikey14, Molecule.smiles, Molecule.formula,
+                                     Molecule.predicted).order_by(Molecule.inchikey14).all()
+        reactions = sorted((inchikeys[reactant], inchikeys[product], name)
+                           for reactant, product, name in
+                           db_session.query(Reaction.reactant, Reaction.product, Reaction.name))
+        return molecules, reactions
+
+    def test_metabolize_all_parallel(self):
+        molecules, reactions = self.metabolize_all(1)
+        self.assertGreater(len(reactions), 0)
+        self.assertEqual(self.metabolize_all(2), (molecules, reactions))
+
+    def test_metabolize_molecules_and_store(self):
+        se = magma.StructureEngine(self.db_session)
+        se.read_smiles('Oc1cc(CC2OCCC2)cc(O)c1O')
+        parent = self.db_session.query(Molecule).one()
+        parent_molid = parent.molid
+
+        products = magma.metabolize_molecules([parent.mol], 'phase1')[0][0]
+        self.assertGreater(len(products), 0)
+        molids = se.store_metabolites(parent_molid, products)
+        # storing the same products again does not add molecules or reactions
+        self.assertEqual(se.store_metabolites(parent_molid, products), molids)
+
+        self.assertEqual(self.db_session.query(Reaction).filter(Reaction.reactant==parent_molid).count(), len(products))
+
+    def test_read_structures(self):
+        se = magma.StructureEngine(self.db_session)
+        records = [('CCO', 'ethanol'), ('CCX', 'invalid'), ('OCC', 'duplicate'), ('CCCCCCCCCCCCCCCCCCCCCCCC', 'heavy')]
+
+        molids, errors = se.read_structures(records, 'smiles', mass_filter=300, batch_size=2)
+
+        self.assertEqual(len(molids), 1)
+        self.assertEqual(errors, [(2, 'Failed to read smiles: CCX (invalid)')])
+        mol = self.db_session.query(Molecule).one()
+        self.assertEqual(mol.name, 'ethanol')
+        self.assertEqual(mol.inchikey14, 'LFQSCWFLJHTTHZ')
+        self.assertEqual(mol.reactionsequence, {})
+
+    def read_structures(self, records, ncpus):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        db_session = sessionmaker(bind=engine)()
+        se = magma.StructureEngine(db_session)
+        molids, errors = se.read_structures(records, 'smiles', mass_filter=300, ncpus=ncpus, batch_size=2)
+        molecules = db_session.query(Molecule.molid, Molecule.name, Molecule.inchikey14, Molecule.smiles,
+                                     Molecule.formula, Molecule.mim).order_by(Molecule.molid).all()
+        return molids, errors, molecules
+
+    def test_read_structures_parallel(self):
+        records = [('CCO', 'ethanol'), ('CCX', 'invalid'), ('OCC', 'duplicate'), ('CCCCCCCCCCCCCCCCCCCCCCCC', 'heavy'),
+                   ('CC(=O)Nc1ccc(O)cc1', 'paracetamol'), ('Oc1cc(CC2OCCC2)cc(O)c1O', 'valerolactone'),
+                   ('C1CC', 'unclosed ring')]
+        molids, errors, molecules = self.read_structures(records, 1)
+        self.assertEqual(len(molecules), 3)
+        self.assertEqual(self.read_structures(records, 2), (molids, errors, molecules))
+
+    def test_indexes_end_with_transaction(self):
+        se = magma.StructureEngine(self.db_session)
+        molecule = magma.get_molecule(u'parent', u'parent', 1.0, 0, 16.0, u'C', 1, u'AAAAAAAAAAAAAA', u'CH4', None, 0.0)
+        molid = se.add_molecule(molecule)
+        self.db_session.add(Reaction(reactant=molid, product=molid, name=u'rule1'))
+        self.db_session.flush()
+
+        # indexes are shared by the structure engines of the session
+        other = magma.StructureEngine(self.db_session)
+        self.assertEqual(other.get_molids(), {u'AAAAAAAAAAAAAA': molid})
+        self.assertEqual(other.get_reactions(), {(molid, molid, u'rule1')})
+
+        # rolled back molecules and reactions are no longer known
+        self.db_session.rollback()
+        self.assertEqual(se.get_molids(), {})
+        self.assertEqual(se.get_reactions(), set())
+        molecule = magma.get_molecule(u'parent', u'parent', 1.0, 0, 16.0, u'C', 1, u'AAAAAAAAAAAAAA', u'CH4', None, 0.0)
+        molid = se.add_molecule(molecule)
+        self.assertEqual(se.get_molids(), {u'AAAAAAAAAAAAAA': molid})
+        self.db_session.close()
+        self.assertEqual(se.get_molids(), {})
+
+    def test_metabolize_beam(self):
+        se = magma.StructureEngine(self.db_session)
+        parent_molid = se.add_molecule(magma.get_molecule(
+            u'parent', u'parent', 1.0, 0, 16.0, u'C', 1, u'AAAAAAAAAAAAAA', u'CH4', None, 0.0))
+        products = [(rule, u'molblock', inchikey14, u'CO', 32.0, 2, u'CH4O', 0.0) for rule, inchikey14 in
+                    ((u'rule1', u'BBBBBBBBBBBBBB'), (u'rule2', u'CCCCCCCCCCCCCC'), (u'rule3', u'AAAAAAAAAAAAAA'))]
+        se.generate_metabolites = mock.Mock(return_value=[(parent_molid, products)])
+        se.metabolize_engine = mock.Mock()
+        se.metabolize_engine.get_priors.return_value = {u'rule1': 0.1, u'rule2': 0.5}
+        se.beam_width = 1
+
+        molids = list(se.metabolize_beam([parent_molid], 'phase1'))
+
+        # most probable new metabolite and the reaction to the known molecule are stored
+        self.assertEqual(len(molids[0]), 2)
+        self.assertEqual(self.db_session.query(Molecule.inchikey14).filter(Molecule.molid.in_(molids[0])).order_by(Molecule.molid).all(),
+                         [(u'AAAAAAAAAAAAAA',), (u'CCCCCCCCCCCCCC',)])
+        self.assertEqual(self.db_session.query(Reaction).count(), 2)
+        self.assertEqual(se.probabilities, {se.molids[u'CCCCCCCCCCCCCC']: 0.5})
+
+    def test_metabolize_beam_deadline(self):
+        se = magma.StructureEngine(self.db_session)
+        parent_molids = [se.add_molecule(magma.get_molecule(
+            name, name, 1.0, 0, 16.0, u'C', 1, inchikey14, u'CH4', None, 0.0))
+            for name, inchikey14 in ((u'parent1', u'AAAAAAAAAAAAAA'), (u'parent2', u'DDDDDDDDDDDDDD'))]
+        products = [(u'rule1', u'molblock', u'BBBBBBBBBBBBBB', u'CO', 32.0, 2, u'CH4O', 0.0)]
+        generated = []
+
+        def generate_metabolites(*args):
+            for molid in parent_molids:
+                generated.append(molid)
+                yield molid, products
+        se.generate_metabolites = generate_metabolites
+        se.metabolize_engine = mock.Mock()
+        se.metabolize_engine.get_priors.return_value = {u'rule1': 0.1}
+        se.beam_width = 1
+        se.deadline = 0
+
+        # the caller stops after the first molecule, like run_scenario at its time limit
+        molids = next(se.metabolize_beam(parent_molids, 'phase1'))
+
+        # no metabolites are generated after the deadline, the probabilities of the stored ones are known
+        self.assertEqual(generated, parent_molids[:1])
+        self.assertEqual(molids, {se.molids[u'BBBBBBBBBBBBBB']})
+        self.assertEqual(se.probabilities, {se.molids[u'BBBBBBBBBBBBBB']: 0.1})
+
+    def test_run_scenario_beam_without_priors(self):
+        se = magma.StructureEngine(self.db_session)
+        se.run_scenario_steps = mock.Mock()
+
+        # the shipped rules have no prior likelihoods
+        with self.assertRaises(DataProcessingError):
+            se.run_scenario([['phase1', '1']], beam_width=10)
+
+        se.metabolize_engine.priors['phase1'] = {u'rule1': 0.1}
+        se.run_scenario([['phase1', '1']], beam_width=10, beam_per_parent=True)
+        se.run_scenario_steps.assert_called_once_with([['phase1', '1']], None, None)
+        # beam mode ends with the scenario
+        self.assertIsNone(se.beam_width)
+        self.assertFalse(se.beam_per_parent)
+
+    def test_store_metabolites_existing_db(self):
+        products = [(u'rule', u'molblock', u'AAAAAAAAAAAAAA', u'CO', 32.0, 2, u'CH4O', 0.0)]
+        parent = [u'parent', u'parent', 1.0, 0, 16.0, u'C', 1, u'BBBBBBBBBBBBBB', u'CH4', None, 0.0]
+        se = magma.StructureEngine(self.db_session)
+        parent_molid = se.add_molecule(magma.get_molecule(*parent))
+        molids = se.store_metabolites(parent_molid, products)
+        self.db_session.commit()
+
+        # duplicates of molecules and reactions stored by another engine are recognized
+        se = magma.StructureEngine(self.db_session)
+        self.assertEqual(se.store_metabolites(parent_molid, products), molids)
+        self.assertEqual(se.add_molecule(magma.get_molecule(*parent), merge=True), parent_molid)
+        self.db_session.commit()
+        self.assertEqual(self.db_session.query(Molecule).count(), 2)
+        self.assertEqual(self.db_session.query(Reaction).count(), 1)
+
 class TestMsDataEngine(unittest.TestCase):
     def setUp(self):
         engine = create_engine('sqlite://')
@@ -339,6 +538,77 @@ class TestMsDataEngine(unittest.TestCase):
 
         os.remove(treefile.name)
 
+    def test_store_manual_tree_formula(self):
+        mde = magma.MsDataEngine(self.db_session, -1, 1000, 5, 0.001, 0.005, 3)
+        import tempfile, os
+        treefile = tempfile.NamedTemporaryFile(delete=False)
+        treefile.write("""C7H11O6: 999 (
+    C4H5O2: 50,
+    C6H5O: 1000 (C5H5: 100),
+    C7H9O5: 200
+)""")
+        treefile.close()
+
+        mde.store_manual_tree(treefile.name, -1)
+
+        scans = self.db_session.query(Scan).order_by(Scan.scanid).all()
+        self.assertEqual([(s.scanid, s.mslevel, s.precursorscanid) for s in scans],
+                         [(1, 1, 0), (2, 2, 1), (3, 3, 2)])
+        self.assertAlmostEqual(scans[1].precursormz, 191.056112, 6)
+        self.assertAlmostEqual(scans[1].lowmz, 85.029503, 6)
+        self.assertAlmostEqual(scans[1].highmz, 173.045547, 6)
+        self.assertAlmostEqual(scans[1].basepeakmz, 93.034588, 6)
+        self.assertEqual(scans[1].basepeakintensity, 1000)
+        self.assertEqual(self.db_session.query(Peak).count(), 5)
+
+        os.remove(treefile.name)
+
+    def test_store_mgf_multiple_spectra(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        import tempfile, os
+        mgffile = tempfile.NamedTemporaryFile(delete=False)
+        mgffile.write("""BEGIN IONS
+TITLE=first
+PEPMASS=308.0912 200.0
+RTINSECONDS=120
+162.0219 40.2
+179.0485 100.0
+END IONS
+BEGIN IONS
+TITLE=no precursor mass
+100.0 5.0
+END IONS
+BEGIN IONS
+TITLE=second
+PEPMASS=181.0707
+92.0495 10.0
+136.0757 50.0
+163.0601 5.0
+END IONS
+""")
+        mgffile.close()
+
+        mde.store_mgf(mgffile.name, batch_size=1)
+
+        scans = self.db_session.query(Scan).order_by(Scan.scanid).all()
+        self.assertEqual([(s.scanid, s.mslevel, s.precursorscanid) for s in scans],
+                         [(1, 1, 0), (2, 2, 1), (3, 1, 0), (4, 2, 3)])
+        self.assertEqual(scans[0].rt, 2.0)
+        self.assertEqual(scans[1].precursormz, 308.0912)
+        self.assertEqual(scans[1].precursorintensity, 200.0)
+        self.assertEqual((scans[3].lowmz, scans[3].highmz), (92.0495, 163.0601))
+        self.assertEqual(scans[2].basepeakintensity, 100.0)
+        peaks = self.db_session.query(Peak.scanid, Peak.mz).order_by(Peak.scanid, Peak.mz).all()
+        self.assertEqual(peaks, [(1, 308.0912), (2, 162.0219), (2, 179.0485),
+                                 (3, 181.0707), (4, 92.0495), (4, 136.0757), (4, 163.0601)])
+
+        # spectra of a second MGF file get new scan ids
+        mde.store_mgf(mgffile.name)
+        scanids = [s.scanid for s in self.db_session.query(Scan.scanid).order_by(Scan.scanid)]
+        self.assertEqual(scanids, range(1, 9))
+
+        os.remove(mgffile.name)
+
     def test_read_mzxml(self):
         mde = magma.MsDataEngine(self.db_session, -1, 10000, 5, 0.001, 0.005, 3)
         mzxml_file=pkg_resources.resource_filename('magma', "tests/theogallin.mzXML")
@@ -358,6 +628,122 @@ class TestMsDataEngine(unittest.TestCase):
         scandata = self.db_session.query(Scan).count()
         self.assertEqual(scandata,2)
 
+    def test_read_mzxml_ramped_indexed_scan(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        mzxml_file=pkg_resources.resource_filename('magma', "tests/ramped_collision_data.mzXML")
+        mzxml_scans = mde.read_indexed_mzxml_scans(mzxml_file, '1')
+        self.assertEqual([s.attrib['num'] for s in mzxml_scans], [str(i) for i in range(1, 13)])
+        mde.store_mzxml_file(mzxml_file, '1')
+        scandata = self.db_session.query(Scan).count()
+        self.assertEqual(scandata,2)
+
+    def test_read_mzml_ramped(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        mzml_file=pkg_resources.resource_filename('magma', "tests/ramped_collision_data.mzML")
+        mde.store_mzml_file(mzml_file)
+        with self.assertRaises(DataProcessingError) as cm:
+            mde.store_mzml_file(mzml_file)
+        self.assertEqual(str(cm.exception), 'Attempt to read MS data twice')
+        self.assertEqual(self.db_session.query(Scan).count(), 2)
+        scan = self.db_session.query(Scan).filter(Scan.scanid == 2).one()
+        self.assertEqual(scan.precursorscanid, 1)
+        self.assertAlmostEqual(scan.precursormz, 207.15942383)
+        self.assertAlmostEqual(scan.rt, 1.6859 / 60)
+        self.assertEqual(self.db_session.query(Peak).count(), 538)
+
+    def store_ms_data(self, filename, ncpus, replace=None):
+        """ Returns scans and peaks read from test file filename, in which the (old, new) strings
+            of replace are replaced first """
+        import tempfile, os
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        db_session = sessionmaker(bind=engine)()
+        mde = magma.MsDataEngine(db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        ms_file = pkg_resources.resource_filename('magma', 'tests/' + filename)
+        if replace is not None:
+            ms_data = open(ms_file).read()
+            self.assertIn(replace[0], ms_data)
+            tmp_file = tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1], delete=False)
+            tmp_file.write(ms_data.replace(*replace))
+            tmp_file.close()
+            self.addCleanup(os.remove, tmp_file.name)
+            ms_file = tmp_file.name
+        if filename.endswith('.mzML'):
+            mde.store_mzml_file(ms_file, ncpus=ncpus)
+        else:
+            mde.store_mzxml_file(ms_file, ncpus=ncpus)
+        scans = db_session.query(Scan.scanid, Scan.mslevel, Scan.rt, Scan.lowmz, Scan.highmz, Scan.basepeakmz,
+                                 Scan.basepeakintensity, Scan.precursorscanid, Scan.precursormz).order_by(Scan.scanid).all()
+        peaks = db_session.query(Peak.scanid, Peak.mz, Peak.intensity).order_by(Peak.scanid, Peak.mz).all()
+        return scans, peaks
+
+    def test_decode_spectra_parallel(self):
+        for filename in ['ramped_collision_data.mzML', 'ramped_collision_data.mzXML']:
+            scans, peaks = self.store_ms_data(filename, 1)
+            self.assertGreater(len(peaks), 0)
+            self.assertEqual(self.store_ms_data(filename, 2), (scans, peaks))
+
+    def test_read_mzxml_empty_nested_scan(self):
+        import tempfile, os
+        mde = magma.MsDataEngine(self.db_session, -1, 10000, 5, 0.001, 0.005, 3)
+        mzxml = open(pkg_resources.resource_filename('magma', "tests/theogallin.mzXML")).read()
+        mzxml_file = tempfile.NamedTemporaryFile(suffix='.mzXML', delete=False)
+        # MS2 scan without peaks, with nested MS3 scans
+        mzxml_file.write(mzxml.replace('peaksCount="50"', 'peaksCount="0"'))
+        mzxml_file.close()
+        self.addCleanup(os.remove, mzxml_file.name)
+
+        mde.store_mzxml_file(mzxml_file.name)
+
+        scans = self.db_session.query(Scan.scanid, Scan.mslevel, Scan.precursorscanid).order_by(Scan.scanid).all()
+        self.assertEqual(scans, [(217, 1, 0), (219, 3, 218), (220, 3, 218)])
+
+    def test_read_empty_spectrum(self):
+        # MS1 spectrum without peaks
+        mzml = self.store_ms_data('ramped_collision_data.mzML', 1,
+                                  ('scan=1" defaultArrayLength="1330"', 'scan=1" defaultArrayLength="0"'))
+        mzxml = self.store_ms_data('ramped_collision_data.mzXML', 1, ('peaksCount="1330"', 'peaksCount="0"'))
+
+        # the empty spectrum is not stored, the MS2 spectrum still refers to it as precursor
+        scans, peaks = mzml
+        self.assertEqual([scan[:2] for scan in scans], [(2, 2)])
+        self.assertEqual(scans[0].precursorscanid, 1)
+        self.assertGreater(len(peaks), 0)
+        self.assertEqual(mzxml, mzml)
+
+    def test_read_mzml_ramped_indexed_scan(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        mzml_file=pkg_resources.resource_filename('magma', "tests/ramped_collision_data.mzML")
+        spectra = mde.read_indexed_mzml_spectra(mzml_file, '1', mde.read_mzml_param_groups(mzml_file))
+        self.assertEqual([s[2].scanid for s in spectra], range(1, 13))
+        mde.store_mzml_file(mzml_file, '1')
+        self.assertEqual(self.db_session.query(Scan).count(), 2)
+        self.assertEqual(self.db_session.query(Peak).count(), 538)
+
+    def test_read_mzxml_without_index(self):
+        mde = magma.MsDataEngine(self.db_session, -1, 10000, 5, 0.001, 0.005, 3)
+        mzxml_file=pkg_resources.resource_filename('magma', "tests/theogallin.mzXML")
+        self.assertIsNone(mde.read_indexed_mzxml_scans(mzxml_file, '217'))
+
+    def test_merge_peak_lists(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        existing = [(100.0, 10.0), (150.0, 30.0), (200.0, 20.0)]
+        new = [(100.0005, 20.0), (150.0005, 10.0), (175.0, 5.0)]
+        merged = mde.merge_peak_lists(existing, new)
+        self.assertEqual(merged, [(100.0005, 20.0), (150.0, 30.0), (175.0, 5.0), (200.0, 20.0)])
+
+    def test_find_preceding_scan(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        mde.index_scan(Scan(scanid=1, mslevel=1, rt=1.0))
+        mde.index_scan(Scan(scanid=3, mslevel=1, rt=3.0))
+        mde.index_scan(Scan(scanid=2, mslevel=2, rt=2.0, precursorscanid=1,
+                            precursormz=200.0, precursorintensity=100.0))
+        self.assertEqual(mde.find_preceding_scan(1, 2.5), 1)
+        self.assertEqual(mde.find_preceding_scan(1, 3.5), 3)
+        self.assertEqual(mde.precursor_scans[(1, 200.0, 100.0)].scanid, 2)
+        with self.assertRaises(DataProcessingError):
+            mde.find_preceding_scan(1, 0.5)
+
 
 class TestAnnotateEngine(unittest.TestCase):
     def setUp(self):
@@ -377,8 +763,342 @@ class TestAnnotateEngine(unittest.TestCase):
         self.assertIsInstance(ae, magma.AnnotateEngine)
         self.assertEqual(ae.ions,[{0: '[M]+'}, {1.0078250321: '[M+H]+', 22.9897692809: '[M+Na]+', 38.96370668: '[M+K]+'}])
 
+    def test_get_mim_ranges(self):
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        ae=magma.AnnotateEngine(self.db_session,False,3,1,0,5,True)
+
+        ranges = ae.get_mim_ranges([300.0, 300.0005, 400.0])
+
+        # overlapping windows of the first two masses are merged
+        self.assertEqual(ranges, {0: [(298991223, 298994723), (398990723, 398994723)],
+                                  1: [(299999048, 300002548), (399998548, 400002548)]})
+
+    def test_get_db_candidates(self):
+        import base64, zlib
+        mde = magma.MsDataEngine(self.db_session, 1, 1000, 5, 0.001, 0.005, 3)
+        ae = magma.AnnotateEngine(self.db_session, False, 3, 1, 0, 5, True)
+        ae.scans = []
+        ae.get_mim_ranges = mock.Mock(return_value={0: [(40000000, 50000000)]})
+        se = magma.StructureEngine(self.db_session)
+        known_molid = se.add_molecule(magma.get_molecule(
+            u'ethanol molblock', u'ethanol', 1.0, 0, 46.0418648147, u'CCO', 3, u'LFQSCWFLJHTTHZ', u'C2H6O', None, 0.0))
+        self.db_session.commit()
+        # molblock of the known candidate is not compressed, decompressing it would fail
+        known = magma.DatabaseCandidate(1, 46041864, 0, 3, 'not compressed', 'LFQSCWFLJHTTHZ', 'CCO', 'C2H6O',
+                                        'ethanol', 'HMDB00108', 0)
+        new = magma.DatabaseCandidate(2, 44026215, 0, 3, base64.encodestring(zlib.compress('acetaldehyde molblock')),
+                                      'IKHGUXGNUITLKF', 'CC=O', 'C2H4O', 'acetaldehyde', 'HMDB00990', 2)
+        query_engine = mock.Mock()
+        query_engine.query_candidates_batch.return_value = [[known, new]]
+        query_engine.candidate_molecule.side_effect = \
+            lambda candidate, decompress: magma.HmdbEngine.candidate_molecule.im_func(None, candidate, decompress)
+
+        molids = ae.get_db_candidates(query_engine)
+
+        self.assertEqual(len(molids), 2)
+        self.assertIn(known_molid, molids)
+        query_engine.candidate_molecule.assert_has_calls([mock.call(known, False), mock.call(new, True)],
+                                                         any_order=True)
+        self.assertEqual(self.db_session.query(Molecule.mol).filter(Molecule.molid == known_molid).scalar(),
+                         u'ethanol molblock')
+        self.assertEqual(self.db_session.query(Molecule.mol).filter(Molecule.inchikey14 == u'IKHGUXGNUITLKF').scalar(),
+                         u'acetaldehyde molblock')
+
+    def test_mim_ranges_select(self):
+        select = magma.mim_ranges_select([(1, 2), (5, 6)], 0, ' AND natoms <= 64')
+        self.assertEqual(select, '* FROM molecules WHERE ((charge = 0 AND mim BETWEEN 1 AND 2) OR '
+                                 '(charge = 0 AND mim BETWEEN 5 AND 6))  AND natoms <= 64')
+
+
+class TestStructureService(unittest.TestCase):
+    def setUp(self):
+        # local stand-in of the structure database service, which fails the first request
+        self.requests = []
+        requests = self.requests
+        self.options = {'batch_route': True}
+        options = self.options
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                requests.append((self.path, query))
+                if len(requests) == 1:
+                    body = 'unavailable'
+                    self.send_response(503)
+                elif self.path.endswith('/batch') and not options['batch_route']:
+                    body = 'not found'
+                    self.send_response(404)
+                elif self.path.endswith('/batch'):
+                    body = json.dumps([[[q[0]]] for q in query])
+                    self.send_response(200)
+                else:
+                    body = json.dumps([[query[0]]])
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{:d}/magma/molecules/hmdb'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_query_retries(self):
+        service = magma.StructureService(self.url, backoff=0)
+
+        self.assertEqual(service.query(['a']), [['a']])
+        self.assertEqual(self.requests, [('/magma/molecules/hmdb', ['a']), ('/magma/molecules/hmdb', ['a'])])
+
+    def test_query_batch(self):
+        service = magma.StructureService(self.url, backoff=0, max_requests=2, queries_per_request=2)
+
+        result = service.query_batch([[str(i)] for i in range(5)])
+
+        self.assertEqual(result, [[[str(i)]] for i in range(5)])
+        batches = sorted(query for path, query in self.requests[1:])
+        self.assertEqual(batches, [[['0'], ['1']], [['2'], ['3']], [['4']]])
+        self.assertTrue(all(path == '/magma/molecules/hmdb/batch' for path, query in self.requests))
+
+    def test_query_batch_without_batch_route(self):
+        self.options['batch_route'] = False
+        service = magma.StructureService(self.url, backoff=0, max_requests=1, queries_per_request=2)
+
+        result = service.query_batch([[str(i)] for i in range(5)])
+
+        self.assertEqual(result, [[[str(i)]] for i in range(5)])
+        # after the batch route is not found, the queries are sent one by one
+        self.assertEqual([path for path, query in self.requests],
+                         ['/magma/molecules/hmdb/batch'] * 2 + ['/magma/molecules/hmdb'] * 5)
+        self.assertEqual([query for path, query in self.requests[2:]], [[str(i)] for i in range(5)])
+
+    def test_session_per_thread(self):
+        service = magma.StructureService(self.url)
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(service.session))
+        thread.start()
+        thread.join()
+
+        self.assertIs(service.session, service.session)
+        self.assertIsNot(sessions[0], service.session)
+
+    def test_query_fails(self):
+        service = magma.StructureService(self.url, backoff=0, retries=0)
+
+        with self.assertRaises(magma.requests.HTTPError):
+            service.query(['a'])
+
+
+class TestCandidateCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = magma.CandidateCache(':memory:', bucket_size=100)
+        # rows of (cid, mim)
+        self.rows = [(1, 100), (2, 105), (3, 150), (4, 250), (5, 120)]
+        self.queries = []
+
+    def query_rows_batch(self, ranges_charges):
+        self.queries.append(ranges_charges)
+        return [[row for row in self.rows if any(low <= row[1] <= high for low, high in ranges)]
+                for ranges, charge in ranges_charges]
+
+    def test_query_rows_batch(self):
+        result = self.cache.query_rows_batch('db', [([(90, 110), (140, 160)], 0)], self.query_rows_batch)
+        self.assertEqual(result, [[(1, 100), (2, 105), (3, 150)]])
+
+        result = self.cache.query_rows_batch('db', [([(140, 160), (240, 260)], 0), ([(90, 110)], 1)],
+                                             self.query_rows_batch)
+
+        self.assertEqual(result, [[(3, 150), (4, 250)], [(1, 100), (2, 105)]])
+        # whole buckets are queried, only if they are not in the cache, consecutive buckets as one range
+        self.assertEqual(self.queries, [[([(0, 199)], 0)],
+                                        [([(200, 299)], 0), ([(0, 199)], 1)]])
+
+    def test_query_rows_batch_ranges_per_query(self):
+        self.cache.ranges_per_query = 1
+        self.rows.append((6, 350))
+
+        result = self.cache.query_rows_batch('db', [([(90, 110), (340, 360)], 0)], self.query_rows_batch)
+
+        self.assertEqual(result, [[(1, 100), (2, 105), (6, 350)]])
+        self.assertEqual(self.queries, [[([(0, 199)], 0), ([(300, 399)], 0)]])
+
+    def test_evict(self):
+        # buckets of 50 with one row each, which have the same size
+        self.cache.bucket_size = 50
+        self.rows = [(1, 100), (2, 150), (3, 200), (4, 250)]
+        self.cache.query_rows_batch('db', [([(100, 110)], 0)], self.query_rows_batch)
+        self.cache.query_rows_batch('db', [([(150, 160)], 0)], self.query_rows_batch)
+        size = self.cache.conn.execute('SELECT size FROM buckets WHERE bucket = 3').fetchone()[0]
+        self.cache.max_size = 2 * size
+
+        self.cache.query_rows_batch('db', [([(100, 110)], 0)], self.query_rows_batch)
+        self.cache.query_rows_batch('db', [([(250, 260)], 0)], self.query_rows_batch)
+
+        buckets = self.cache.conn.execute('SELECT bucket FROM buckets ORDER BY bucket').fetchall()
+        self.assertEqual(buckets, [(2,), (5,)])
+
+
+class TestMimIndex(unittest.TestCase):
+    def setUp(self):
+        import tempfile, sqlite3
+        self.dirname = tempfile.mkdtemp()
+        self.dbfilename = self.dirname + '/structures.db'
+        conn = sqlite3.connect(self.dbfilename)
+        conn.execute('CREATE TABLE molecules (cid INTEGER PRIMARY KEY, mim INTEGER NOT NULL, charge INTEGER NOT NULL, '
+                     'natoms INTEGER NOT NULL, molblock TEXT, inchikey TEXT, smiles TEXT, molform TEXT, name TEXT, '
+                     'refscore INTEGER, logp INT)')
+        self.rows = [(1, 300000000, 0, 20, 'mb1', 'KEY1', 'C', 'C', 'a', 5, 10),
+                     (2, 100000000, 0, 70, 'mb2', 'KEY2', 'CC', 'C2', 'b', 1, 20),
+                     (3, 100000000, 0, 10, 'mb3', 'KEY3', 'CCC', 'C3', 'c', 2, 30),
+                     (4, 100000000, 1, 10, 'mb4', 'KEY4', 'CCCC', 'C4', 'd', 3, 40)]
+        conn.executemany('INSERT INTO molecules VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.rows)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dirname)
+
+    def test_query_rows(self):
+        magma.write_mim_index(self.dbfilename)
+        index = magma.open_mim_index(self.dbfilename)
+
+        self.assertEqual(index.query_rows([(99000000, 101000000), (299000000, 301000000)], 0),
+                         [self.rows[1], self.rows[2], self.rows[0]])
+        self.assertEqual(index.query_rows([(99000000, 101000000)], 0, [lambda row: row[3] <= 64]), [self.rows[2]])
+        self.assertEqual(index.query_rows([(99000000, 101000000)], 1), [self.rows[3]])
+        self.assertEqual(index.query_rows([(101000000, 299000000)], 0), [])
+        self.assertEqual(index.query_rows([(99000000, 101000000)], -1), [])
+
+    def test_query_rows_null_and_empty_values(self):
+        import sqlite3
+        row = (5, 200000000, 0, 10, None, 'KEY5', '', 'C5', None, 4, None)
+        conn = sqlite3.connect(self.dbfilename)
+        conn.execute('INSERT INTO molecules VALUES (?,?,?,?,?,?,?,?,?,?,?)', row)
+        conn.commit()
+        conn.close()
+        magma.write_mim_index(self.dbfilename)
+        index = magma.open_mim_index(self.dbfilename)
+
+        self.assertEqual(index.query_rows([(199000000, 201000000)], 0), [row])
+
+    def test_write_non_integer(self):
+        import sqlite3
+        conn = sqlite3.connect(self.dbfilename)
+        conn.execute('UPDATE molecules SET logp = 1.5 WHERE cid = 1')
+        conn.commit()
+        conn.close()
+
+        with self.assertRaises(ValueError):
+            magma.write_mim_index(self.dbfilename)
+
+    def test_open_outdated_index(self):
+        import os
+        magma.write_mim_index(self.dbfilename)
+        os.utime(self.dbfilename, (0, 0))
+
+        self.assertIsNone(magma.open_mim_index(self.dbfilename))
+
+    def test_open_without_index(self):
+        self.assertIsNone(magma.open_mim_index(self.dbfilename))
+
 
 class TestMetabolizeEngine(unittest.TestCase):
+    def test_reaction_cache(self):
+        import tempfile, shutil, os
+        cache_dir = tempfile.mkdtemp()
+        me = magma.MetabolizeEngine()
+        me.cache_dir = cache_dir
+        reactions = me.get_reactions('gut')
+        # only the requested metabolism type is compiled
+        self.assertEqual(me.reactions.keys(), ['gut'])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        me = magma.MetabolizeEngine()
+        me.cache_dir = cache_dir
+        cached_reactions = me.get_reactions('gut')
+        self.assertEqual([name for name, reaction in cached_reactions], [name for name, reaction in reactions])
+        self.assertEqual([reaction.ToBinary() for name, reaction in cached_reactions],
+                         [reaction.ToBinary() for name, reaction in reactions])
+
+        shutil.rmtree(cache_dir)
+
+    def test_get_priors(self):
+        import tempfile, os
+        smirks_file = tempfile.NamedTemporaryFile(delete=False)
+        smirks_file.write('# comment 0.5\n[C:1]>>[C:1]O hydroxylation 0.3\n[C:1]>>[C:1]N amination\n')
+        smirks_file.close()
+        me = magma.MetabolizeEngine()
+        me.metabolism_files['test'] = smirks_file.name
+
+        self.assertEqual(me.get_priors('test'), {'hydroxylation': 0.3})
+        # priors are read once per metabolism type
+        os.remove(smirks_file.name)
+        self.assertEqual(me.get_priors('test'), {'hydroxylation': 0.3})
+
+    def test_prescreen(self):
+        mol = Chem.MolFromSmiles('Clc1cccc(F)c1Nc2ccc(C)cc2CC(=O)O')
+        AllChem.Compute2DCoords(mol)
+        me = magma.MetabolizeEngine()
+        metabolites = me.metabolize(mol, 'phase2', False)
+        self.assertGreater(me.nskipped, 0)
+        self.assertEqual(me.nrules, len(me.get_reactions('phase2')))
+
+        me.prescreen = False
+        unscreened_metabolites = me.metabolize(mol, 'phase2', False)
+        self.assertEqual(sorted(metabolites.keys()), sorted(unscreened_metabolites.keys()))
+
+    def test_metabolize_inchikeys_only(self):
+        mol = Chem.MolFromSmiles('Clc1cccc(F)c1Nc2ccc(C)cc2CC(=O)O')
+        AllChem.Compute2DCoords(mol)
+        me = magma.MetabolizeEngine()
+        with mock.patch.object(magma, 'calculate_properties') as calculate_properties:
+            metabolites = me.metabolize(mol, 'phase1', False)
+
+        # other properties are calculated by metabolize_molecules for the new metabolites only
+        self.assertGreater(len(metabolites), 0)
+        self.assertFalse(calculate_properties.called)
+
+    @mock.patch.dict(magma.properties_cache, {'CCO': ('LFQSCWFLJHTTHZ', 'CCO', 46.0418648147, 3, 'C2H6O', -0.0014)})
+    def test_calculate_inchikey14_cached(self):
+        # the inchikey14 of a molecule with known properties is not calculated again
+        self.assertEqual(magma.calculate_inchikey14(None, 'CCO'), 'LFQSCWFLJHTTHZ')
+
+    def test_prescreen_all_rules(self):
+        # the prescreen skips only rules which can not match, for all rule files and varied structures
+        smiles = ['Clc1cccc(F)c1Nc2ccc(C)cc2CC(=O)O', 'Oc1cc(CC2OCCC2)cc(O)c1O', 'CC(=O)Nc1ccc(O)cc1',
+                  'OC[C@H]1O[C@@H](Oc2ccc(cc2)C=O)[C@H](O)[C@@H](O)[C@@H]1O', 'CN1CCC[C@H]1c1cccnc1',
+                  'CCOC(=O)C(C)OP(=S)(OC)OC', 'NC(CS)C(=O)NCC(=O)O', 'O=C(O)c1ccccc1OC(C)=O', 'C[N+](C)(C)CC([O-])=O',
+                  'CC(C)Cc1ccc(cc1)C(C)C(O)=O', 'OC(=O)CCC(=O)C(O)=O', 'c1ccc2c(c1)[nH]c1ccccc12']
+        screened = magma.MetabolizeEngine()
+        unscreened = magma.MetabolizeEngine()
+        unscreened.prescreen = False
+        for metabolism in sorted(screened.metabolism_files):
+            for endpoints in [False, True]:
+                for s in smiles:
+                    mol = Chem.MolFromSmiles(s)
+                    AllChem.Compute2DCoords(mol)
+                    metabolites = screened.metabolize(mol, metabolism, endpoints)
+                    unscreened_metabolites = unscreened.metabolize(mol, metabolism, endpoints)
+                    self.assertEqual(
+                        sorted((ikey, name) for ikey, (name, product) in metabolites.iteritems()),
+                        sorted((ikey, name) for ikey, (name, product) in unscreened_metabolites.iteritems()),
+                        metabolism + ' ' + s)
+        self.assertGreater(screened.nskipped, 0)
+        self.assertEqual(unscreened.nskipped, 0)
+
     def test_metabolize_lumiracoxib_phase1and2(self):
         me = magma.MetabolizeEngine()
         mol=Chem.MolFromSmiles('Clc1cccc(F)c1Nc2ccc(C)cc2CC(=O)O')
@@ -506,6 +1226,45 @@ M  END
         mol=Chem.MolFromMolBlock(molblock)
         metabolites=me.metabolize(mol,'glycosidase',True)
         self.assertEqual(len(metabolites),3)
+        # intermediates are metabolized once, end products are reused for the next parent
+        self.assertGreater(len(me.endproducts), 0)
+        nrules = me.nrules
+        self.assertEqual(sorted(me.metabolize(mol,'glycosidase',True).keys()), sorted(metabolites.keys()))
+        self.assertLess(me.nrules - nrules, nrules)
+
+
+    def test_metabolize_intermediate_cycle(self):
+        # A -> B, B -> A and C, C is an end product
+        graph = {'A': ['B'], 'B': ['A', 'C'], 'C': []}
+        me = magma.MetabolizeEngine()
+
+        def metabolize(mol, metabolism, endpoints):
+            metabolites = {}
+            for ikey in graph[mol]:
+                endproducts = me.metabolize_intermediate(ikey, ikey, metabolism)
+                if len(endproducts) > 0:
+                    metabolites.update(endproducts)
+                else:
+                    metabolites[ikey] = [metabolism, ikey]
+            return metabolites
+
+        with mock.patch.object(me, 'metabolize', side_effect=metabolize):
+            self.assertEqual(sorted(me.metabolize_intermediate('A', 'A', 'phase2')), ['A', 'C'])
+            # end products of A and B depend on where the cycle was entered and are not reused
+            self.assertEqual(me.endproducts.keys(), [('phase2', 'C')])
+            self.assertEqual(sorted(me.metabolize_intermediate('B', 'B', 'phase2')), ['B', 'C'])
+            self.assertEqual(me.intermediates, set())
+
+    def test_metabolize_intermediate_lru(self):
+        me = magma.MetabolizeEngine()
+        me.endproducts_size = 2
+
+        with mock.patch.object(me, 'metabolize', return_value={}) as metabolize:
+            for ikey in ['A', 'B', 'A', 'C', 'A']:
+                me.metabolize_intermediate(ikey, ikey, 'phase2')
+
+        self.assertEqual(metabolize.call_count, 3)
+        self.assertEqual(me.endproducts.keys(), [('phase2', 'C'), ('phase2', 'A')])
 
 
 class TestSearchStructure(unittest.TestCase):
@@ -32,6 +32,7 @@ class TestMagmaCommand(unittest.TestCase):
         args.log = 'debug'
         args.call_back_url = None
         args.time_limit = None
+        args.ncpus = 1
 
         self.mc.read_ms_data(args)
 
@@ -42,6 +43,7 @@ class TestMagmaCommand(unittest.TestCase):
         args.pubchem_names = False
         args.structure_format = 'sdf'
         args.mass_filter = 9999
+        args.ncpus = 1
         args.structures = sdfile
         self.mc.add_structures(args)
 
@@ -323,6 +325,7 @@ END IONS
         args.pubchem_names = False
         args.structure_format = 'smiles'
         args.mass_filter = 9999
+        args.ncpus = 1
         args.structures = 'c1ccc2ccccc2c1C(=O)c3c4ccccc4n(CCC)c3C'
         self.mc.add_structures(args)
 
@@ -335,6 +338,9 @@ END IONS
         args.call_back_url = None
         args.scenario = scenariofile.name
         args.time_limit = None
+        args.ncpus = 1
+        args.beam_width = None
+        args.beam_per_parent = False
         scenariofile.write('phase1_selected,1\nmass_filter,500\nphase2_selected,2')
         scenariofile.close()
         self.mc.metabolize(args)
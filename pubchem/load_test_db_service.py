@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Load test of a running magma_db_service
+
+Random mass windows are queried by a number of client threads, each with its own
+persistent HTTP connection, first one window per request and then in batches of windows
+per request on the batch endpoint. The throughput is printed in requests and windows per second.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import requests
+from magma import mim_ranges_select
+
+
+def random_windows(nwindows, mz_precision):
+    windows = []
+    for i in range(nwindows):
+        mim = random.uniform(100, 1000)
+        delta = mim * mz_precision / 1e6
+        windows.append((int(1e6 * (mim - delta)), int(1e6 * (mim + delta))))
+    return windows
+
+
+def window_query(window, db):
+    select = mim_ranges_select([window], 0)
+    if db == 'hmdb':
+        return [select]
+    return [select, True]
+
+
+def run(url, payloads, nthreads):
+    """ Post payloads from nthreads threads, returns elapsed time and number of failed requests """
+    failures = []
+    lock = threading.Lock()
+
+    def worker(part):
+        session = requests.Session()
+        for payload in part:
+            r = session.post(url, data=payload)
+            if r.status_code != 200:
+                with lock:
+                    failures.append(r.status_code)
+
+    threads = [threading.Thread(target=worker, args=(payloads[i::nthreads],)) for i in range(nthreads)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start_time, len(failures)
+
+
+def report(description, nrequests, nwindows, elapsed_time, nfailed):
+    print '%s: %d requests in %.2f s, %.1f requests/s, %.1f windows/s, %d failed' % (
+        description, nrequests, elapsed_time, nrequests / elapsed_time, nwindows / elapsed_time, nfailed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--url', help="Url of the service (default: %(default)s)",
+                        default='http://localhost:8080/magma/molecules')
+    parser.add_argument('-d', '--db', help="Database to query (default: %(default)s)", default='hmdb',
+                        choices=['hmdb', 'kegg', 'pubchem'])
+    parser.add_argument('-n', '--windows', help="Number of mass windows (default: %(default)s)", default=2000, type=int)
+    parser.add_argument('-t', '--threads', help="Number of client threads (default: %(default)s)", default=8, type=int)
+    parser.add_argument('-b', '--batch_size', help="Mass windows per batch request (default: %(default)s)",
+                        default=50, type=int)
+    parser.add_argument('-p', '--mz_precision', help="Width of mass windows in ppm (default: %(default)s)",
+                        default=5, type=float)
+    args = parser.parse_args()
+
+    random.seed(1)
+    queries = [window_query(window, args.db) for window in random_windows(args.windows, args.mz_precision)]
+    url = args.url + '/' + args.db
+
+    payloads = [json.dumps(query) for query in queries]
+    elapsed_time, nfailed = run(url, payloads, args.threads)
+    report('single', len(payloads), len(queries), elapsed_time, nfailed)
+
+    payloads = [json.dumps(queries[start:start + args.batch_size])
+                for start in range(0, len(queries), args.batch_size)]
+    elapsed_time, nfailed = run(url + '/batch', payloads, args.threads)
+    report('batch', len(payloads), len(queries), elapsed_time, nfailed)
+
+if __name__ == "__main__":
+    sys.exit(main())
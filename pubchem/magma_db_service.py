@@ -1,26 +1,74 @@
+import argparse
+import logging
+import threading
 from waitress import serve
 from pyramid.config import Configurator
+from pyramid.httpexceptions import HTTPNotFound
 
 from magma import PubChemEngine,HmdbEngine
 
+logger = logging.getLogger(__name__)
+
+# database engines are kept open per worker thread, sqlite connections can not be shared between threads
+engines = threading.local()
+mmap_size = 0
+
+
+def get_engine(dbname):
+    """ Return engine of database dbname for the current thread, connected read-only """
+    db_engine = getattr(engines, dbname, None)
+    if db_engine is None:
+        if dbname == 'hmdb':
+            db_engine = HmdbEngine(online = False)
+            connections = [db_engine.conn]
+        elif dbname == 'kegg':
+            db_engine = PubChemEngine('kegg', incl_halo=True, online = False)
+            connections = [db_engine.conn, db_engine.connh]
+        elif dbname == 'pubchem':
+            db_engine = PubChemEngine('pubchem', incl_halo=True, online = False)
+            connections = [db_engine.conn, db_engine.connh]
+        else:
+            raise HTTPNotFound('Unknown database: ' + dbname)
+        for conn in connections:
+            conn.execute('PRAGMA query_only = ON')
+            if mmap_size > 0:
+                conn.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+        setattr(engines, dbname, db_engine)
+    return db_engine
+
 
 def molecules(request):
     query = request.json_body
-    print query
-    selected_db = request.matchdict['dbname']
-    if selected_db == 'hmdb':
-        db_engine = HmdbEngine(online = False)
-    elif selected_db == 'kegg':
-        db_engine = PubChemEngine('kegg', incl_halo=True, online = False)
-    elif selected_db == 'pubchem':
-        db_engine = PubChemEngine('pubchem', incl_halo=True, online = False)
-    return db_engine.query_local(*query)
+    logger.debug(query)
+    return get_engine(request.matchdict['dbname']).query_local(*query)
 
-if __name__ == '__main__':
+
+def molecules_batch(request):
+    """ Answer a list of queries with the list of their results """
+    queries = request.json_body
+    logger.debug(queries)
+    db_engine = get_engine(request.matchdict['dbname'])
+    return [db_engine.query_local(*query) for query in queries]
+
+
+def main():
+    global mmap_size
+    parser = argparse.ArgumentParser(description='Serve MAGMa structure databases')
+    parser.add_argument('--host', help="Host to listen on (default: %(default)s)", default='0.0.0.0', type=str)
+    parser.add_argument('-p', '--port', help="Port to listen on (default: %(default)s)", default=8080, type=int)
+    parser.add_argument('-t', '--threads', help="Number of worker threads (default: %(default)s)", default=8, type=int)
+    parser.add_argument('-m', '--mmap_size', help="Bytes of each database to access by memory mapping (default: %(default)s)",
+                        default=2 ** 30, type=int)
+    args = parser.parse_args()
+    mmap_size = args.mmap_size
 
     config = Configurator()
+    config.add_route('molecules_batch', '/magma/molecules/{dbname}/batch')
     config.add_route('molecules', '/magma/molecules/{dbname}')
     config.add_view(molecules, route_name='molecules', renderer='json')
+    config.add_view(molecules_batch, route_name='molecules_batch', renderer='json')
     app = config.make_wsgi_app()
-    serve(app, host='0.0.0.0', port=8080)
+    serve(app, host=args.host, port=args.port, threads=args.threads)
 
+if __name__ == '__main__':
+    main()
@@ -187,6 +187,12 @@ def process_hmdb(args):
     c.execute(
         'CREATE INDEX idx_cover ON molecules (charge,mim,natoms,reference,molform,inchikey,smiles,name,molblock,logp)')
     conn.commit()
+    conn.close()
+
+    if args.mim_index:
+        print "Writing mim index ..."
+        from magma import write_mim_index
+        write_mim_index(args.database_dir + '/HMDB_MAGMa.db')
 
 # main
 mainparser = argparse.ArgumentParser(description=__doc__)
@@ -197,6 +203,8 @@ mainparser.add_argument(
                                 (default: %(default)s, attempt to read directly from HMDB server)""", default=None, type=str)
 mainparser.add_argument(
     '-b', '--database_dir', help="Directory where HMDB database is stored (default: %(default)s)", default="./", type=str)
+mainparser.add_argument(
+    '-i', '--mim_index', help="Also write memory mapped mass index of database (default: %(default)s)", action="store_true")
 mainparser.set_defaults(func=process_hmdb)
 
 args = mainparser.parse_args(sys.argv[1:])
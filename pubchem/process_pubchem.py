@@ -10,6 +10,9 @@ import time
 import sys
 import argparse
 import base64
+import itertools
+import multiprocessing
+import shutil
 
 
 def version():
@@ -17,16 +20,16 @@ def version():
 
 
 def process(args):
-    """Update local PubChem database.
-    This has to be run twice, with and without -f option,
-    to generate db's for halogenated and non-halogenated compounds respectively"""
+    """Update local PubChem databases of halogenated and non-halogenated compounds"""
     kegg_info = {}
     if args.kegg != None:
         kegg_info = parse_kegg_file(args.kegg)
         print len(kegg_info), 'kegg compound names read'
     if not args.skip_names:
         create_names_db(args.data_dir, args.database_dir)
-    create_pubchem_dbs(args.data_dir, args.database_dir, kegg_info, args.halogens)
+    create_pubchem_dbs(args.data_dir, args.database_dir, kegg_info, args.ncpus)
+    if args.mim_index:
+        write_mim_indexes(args.database_dir, len(kegg_info) > 0)
 
 
 def create_names_db(data_dir, dbs_dir):
@@ -72,6 +75,17 @@ def create_names_db(data_dir, dbs_dir):
     conn.commit()
 
 
+def write_mim_indexes(dbs_dir, kegg):
+    "Write memory mapped mass indexes of the databases generated by create_pubchem_dbs"
+    from magma import write_mim_index
+    dbfilenames = [dbs_dir + '/Pubchem_MAGMa.db', dbs_dir + '/Pubchem_MAGMa_halo.db']
+    if kegg:
+        dbfilenames += [dbs_dir + '/Pubchem_MAGMa_Kegg.db', dbs_dir + '/Pubchem_MAGMa_Kegg_halo.db']
+    for dbfilename in dbfilenames:
+        print "Writing mim index of", dbfilename
+        write_mim_index(dbfilename)
+
+
 def update(args):
     """Update downloads from PubChem server"""
     command1 = ""
@@ -107,14 +121,12 @@ def parse_kegg_file(kegg_file):
     return kegg_info
 
 
-def create_pubchem_dbs(data_dir, dbs_dir, kegg_info, halogens):
-    """Generate Pubchem_MAGMa.db and Pubchem_MAGMa_kegg.db in dbs_dir from data in data_dir"""
+def create_pubchem_dbs(data_dir, dbs_dir, kegg_info, ncpus=1):
+    """Generate Pubchem_MAGMa.db, Pubchem_MAGMa_halo.db and Pubchem_MAGMa_Kegg(_halo).db in dbs_dir from data in data_dir.
+    The compound SDFs are parsed in parallel into shards, which are merged into the databases"""
 
     pubchem_dir = data_dir + \
         "/ftp.ebi.ac.uk/pub/databases/pubchem/Compound/CURRENT-Full/SDF/"
-    # open database with compound names
-    conn_names = sqlite3.connect(dbs_dir + "/Pubchem_Names.db")
-    curs_names = conn_names.cursor()
 
     # generate a database with a list of all compound SDFs
     try:
@@ -134,244 +146,345 @@ def create_pubchem_dbs(data_dir, dbs_dir, kegg_info, halogens):
     conn_list.commit()
     print ("Pubchem_Listing.db created")
 
+    # parse compound SDFs into shards, shards of a previous interrupted run are reused
+    # if their SDF has not changed since
+    shards_dir = dbs_dir + '/Pubchem_Shards'
+    if not os.path.isdir(shards_dir):
+        os.makedirs(shards_dir)
+    filenames = [filename for filename, in curs_list.execute('SELECT file FROM files ORDER BY file')]
+    tasks = [(pubchem_dir, filename, shards_dir + '/' + filename + '.db', dbs_dir + "/Pubchem_Names.db")
+             for filename in filenames]
+    pool = None
+    if ncpus > 1:
+        pool = multiprocessing.Pool(ncpus)
+    try:
+        if pool is not None:
+            results = pool.imap_unordered(create_shard, tasks)
+        else:
+            results = itertools.imap(create_shard, tasks)
+        for filename, elapsed_time in results:
+            curs_list.execute(
+                'UPDATE files SET processed = 1, time = ? WHERE file = ?', (elapsed_time, filename))
+            conn_list.commit()
+            print filename + ": ", elapsed_time
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # merge shards in order of the SDFs
+    shard_files = [shards_dir + '/' + filename + '.db' for filename in filenames]
+    for halogens in [False, True]:
+        merge_shards(shard_files, dbs_dir, kegg_info, halogens)
+    shutil.rmtree(shards_dir)
+
+
+class NamesReader(object):
+    """Look up names and refscores of compounds in Pubchem_Names.db. As the CIDs in an SDF file are increasing,
+    the names table is read in order of CID alongside the SDF file instead of querying each CID"""
+
+    def __init__(self, conn_names):
+        self.conn_names = conn_names
+        self.rows = None
+        self.row = None
+        self.cid = None
+
+    def get(self, cid):
+        """Returns (name, refscore) of cid, None if cid has no name"""
+        if self.rows is None or cid < self.cid:
+            # (re)start reading names at cid
+            self.rows = self.conn_names.execute('SELECT cid,name,refscore FROM names WHERE cid >= ? ORDER BY cid', (cid,))
+            self.row = next(self.rows, None)
+        self.cid = cid
+        while self.row is not None and self.row[0] < cid:
+            self.row = next(self.rows, None)
+        if self.row is not None and self.row[0] == cid:
+            return self.row[1:]
+        return None
+
+
+def source_version(sdf_file, names_file):
+    """Returns (size, modification time) of sdf_file and of names_file, which are stored in the shard
+    created from them"""
+    sdf_stat = os.stat(sdf_file)
+    names_stat = os.stat(names_file)
+    return sdf_stat.st_size, sdf_stat.st_mtime, names_stat.st_size, names_stat.st_mtime
+
+
+def shard_is_current(shard_file, sdf_file, names_file):
+    "Returns whether shard_file has been created from the current versions of sdf_file and names_file"
+    if not os.path.exists(shard_file):
+        return False
+    conn_shard = sqlite3.connect(shard_file)
+    try:
+        source = conn_shard.execute('SELECT size, mtime, names_size, names_mtime FROM source').fetchone()
+    except sqlite3.DatabaseError:
+        source = None
+    conn_shard.close()
+    return source == source_version(sdf_file, names_file)
+
+
+def create_shard(task):
+    """Parse and filter a compound SDF into a shard database with one record per accepted compound,
+    both halogenated and non-halogenated. A shard created from the same versions of the SDF and the
+    names database is reused.
+    Returns filename and processing time in minutes"""
+    pubchem_dir, filename, shard_file, names_file = task
+    starttime = time.time()
+    if shard_is_current(shard_file, pubchem_dir + filename, names_file):
+        return filename, 0.0
+    conn_shard = sqlite3.connect(shard_file + '.tmp')
+    curs_shard = conn_shard.cursor()
+    curs_shard.execute('DROP TABLE IF EXISTS records')
+    curs_shard.execute('DROP TABLE IF EXISTS source')
+    curs_shard.execute(
+        "CREATE TABLE records (halo INTEGER, cid INTEGER, mim INTEGER, charge INTEGER, natoms INTEGER, molblock TEXT, inchikey TEXT, smiles TEXT, molform TEXT, name TEXT, refscore INTEGER, logp INT, ionized INTEGER)")
+    curs_shard.execute('CREATE TABLE source (size INTEGER, mtime REAL, names_size INTEGER, names_mtime REAL)')
+    curs_shard.execute('INSERT INTO source VALUES (?,?,?,?)', source_version(pubchem_dir + filename, names_file))
+    # open database with compound names
+    names = NamesReader(sqlite3.connect(names_file))
+
+    sdfile = gzip.open(pubchem_dir + filename)
+    line = '$$$$'
+    while line != "":
+        record = []
+        hatoms = []
+        hbonds = 0
+        skip = False
+        halo = False
+        ionized = 0
+        # read heading:
+        for x in range(4):
+            line = sdfile.readline()
+            record.append(line)
+        if line == "":
+            continue
+        natoms = int(line[:3])
+        nbonds = int(line[3:6])
+        for x in range(natoms):
+            line = sdfile.readline()
+            if line[31:33] == 'H ':
+                # remove hydrogens
+                hatoms.append(x + 1)
+                continue
+            if line[31:33] != 'H ' and len(hatoms) > 0:
+                raise ValueError('Error: heavy atoms after hydrogens' + record[0][:-1])
+            if line[31:33] not in ['C ', 'N ', 'O ', 'P ', 'S ', 'F ', 'Cl', 'Br', 'I ']:
+                # filter non-organic compounds
+                skip = True
+            if line[31:33] in ['F ', 'Cl', 'Br', 'I ']:
+                halo = True
+            elif line[50:51] != '0':
+                # this flag has something to do with polymeric structures
+                # and resulted in deviation between calculated and given inchikeys, skip
+                skip = True
+            elif line[38:39] == '4':  # radical
+                # radical, resulted in deviation between calculated and given inchikeys
+                skip = True
+            record.append(line[:42] + '\n')
+        for x in range(nbonds):
+            line = sdfile.readline()
+            if int(line[:3]) in hatoms or int(line[3:6]) in hatoms:
+                # remove bonds involving hydrogens
+                hbonds += 1
+                continue
+            # use bonds with stereoflags set to zero
+            record.append(line[:9] + '  0\n')
+        while line != 'M  END\n' and line != '':
+            line = sdfile.readline()
+            record.append(line)
+            if line[:6] == 'M  ISO':
+                skip = True
+                print 'Skipped isotopically labeled:', record[0][:-1]
+        while line != "$$$$\n" and line != "":
+            line = sdfile.readline()
+            if line == "> <PUBCHEM_MONOISOTOPIC_WEIGHT>\n":
+                mim = float(sdfile.readline()[:-1])
+            elif line == "> <PUBCHEM_COMPONENT_COUNT>\n":
+                comp_count = int(sdfile.readline()[:-1])
+            elif line == "> <PUBCHEM_IUPAC_INCHIKEY>\n":
+                line = sdfile.readline()
+                inchikey = line[:14]
+            elif line == "> <PUBCHEM_OPENEYE_CAN_SMILES>\n":
+                smiles = sdfile.readline()[:-1]
+            elif line == "> <PUBCHEM_MOLECULAR_FORMULA>\n":
+                molform = sdfile.readline()[:-1]
+            elif line == "> <PUBCHEM_TOTAL_CHARGE>\n":
+                charge = int(sdfile.readline()[:-1])
+            elif line == "> <PUBCHEM_IUPAC_NAME>\n":
+                iupac_name = sdfile.readline()[:-1]
+            elif line == "> <PUBCHEM_HEAVY_ATOM_COUNT>\n":
+                heavy_atoms = int(sdfile.readline()[:-1])
+            elif line[:17] == "> <PUBCHEM_XLOGP3":
+                logp = float(sdfile.readline()[:-1])
+        if line != "" and \
+                not skip and \
+                mim <= 1200.0 and \
+                comp_count == 1:
+            charge = 0
+            if '-' in molform:
+                # exclude compounds with charge < -1
+                if molform[-1] == '-':
+                    charge = -1
+                else:
+                    continue
+            elif '+' in molform:
+                # exclude compounds with charge > 1
+                if molform[-1] == '+':
+                    charge = 1
+                else:
+                    continue
+            for x in ['C(=O)[O-]', 'S(=O)(=O)[O-]', '[NH+]', '[NH2+]', '[NH3+]', '[NH4+]']:
+                if smiles.find(x) >= 0:
+                    ionized = 1
+            record[3] = repr(natoms - len(hatoms)).rjust(3) + repr(nbonds - hbonds).rjust(3) + record[3][6:]
+            cid = int(record[0][:-1])
+            try:
+                result = names.get(cid)
+                molname = result[0]
+                refscore = int(result[1])
+            except:
+                molname = iupac_name
+                refscore = 1
+            molblock = base64.encodestring(zlib.compress(''.join(record)))
+            curs_shard.execute('INSERT INTO records VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', (
+                               halo,
+                               cid,
+                               int(mim * 1e6),
+                               charge,
+                               heavy_atoms,
+                               unicode(molblock),
+                               unicode(inchikey),
+                               unicode(smiles),
+                               unicode(molform),
+                               unicode(molname),
+                               refscore,
+                               int(logp * 10),
+                               ionized))
+    conn_shard.commit()
+    conn_shard.close()
+    os.rename(shard_file + '.tmp', shard_file)
+    return filename, (time.time() - starttime) / 60
+
+
+def merge_shards(shard_files, dbs_dir, kegg_info, halogens):
+    """Merge halogenated or non-halogenated records of shards into Pubchem_MAGMa(_halo).db and
+    Pubchem_MAGMa_Kegg(_halo).db, keeping one compound per inchikey"""
+    suffix = '_halo' if halogens else ''
     # make db files
-    if halogens:
-        conn_pubchem = sqlite3.connect(dbs_dir + "/Pubchem_MAGMa_halo.db")
-    else:
-        conn_pubchem = sqlite3.connect(dbs_dir + "/Pubchem_MAGMa.db")
+    conn_pubchem = sqlite3.connect(dbs_dir + "/Pubchem_MAGMa" + suffix + ".db")
     curs_pubchem = conn_pubchem.cursor()
     try:
         curs_pubchem.execute(
             "CREATE TABLE molecules (cid INTEGER PRIMARY KEY, mim INTEGER NOT NULL, charge INTEGER NOT NULL, natoms INTEGER NOT NULL, molblock TEXT, inchikey TEXT, smiles TEXT, molform TEXT, name TEXT, refscore INTEGER, logp INT)")
         conn_pubchem.commit()
-        print ("Pubchem_MAGMa.db created")
+        print ("Pubchem_MAGMa" + suffix + ".db created")
     except:
-        print ("Pubchem_MAGMa.db already exists (or error creating it)")
+        print ("Pubchem_MAGMa" + suffix + ".db already exists (or error creating it)")
 
     if len(kegg_info) > 0:
-        if halogens:
-            conn_kegg = sqlite3.connect(
-                dbs_dir + "/Pubchem_MAGMa_Kegg_halo.db")
-        else:
-            conn_kegg = sqlite3.connect(dbs_dir + "/Pubchem_MAGMa_Kegg.db")
+        conn_kegg = sqlite3.connect(dbs_dir + "/Pubchem_MAGMa_Kegg" + suffix + ".db")
         curs_kegg = conn_kegg.cursor()
         try:
             curs_kegg.execute(
                 "CREATE TABLE molecules (cid INTEGER PRIMARY KEY, mim INTEGER NOT NULL, charge INTEGER NOT NULL, natoms INTEGER NOT NULL, molblock TEXT, inchikey TEXT, smiles TEXT, molform TEXT, name TEXT, reference TEXT, logp INT)")
             conn_kegg.commit()
-            print ("Pubchem_MAGMa_kegg.db created")
+            print ("Pubchem_MAGMa_Kegg" + suffix + ".db created")
         except:
             print (
-                "Pubchem_MAGMa_kegg.db already exists (or error creating it)")
+                "Pubchem_MAGMa_Kegg" + suffix + ".db already exists (or error creating it)")
 
     # fill databases
-    ready = False
-    curr_id = 0
-    curr_id_kegg = 0
     memstore = {}
     memstore_kegg = {}
-    while not ready:
-        curs_list.execute('SELECT file FROM files WHERE processed == 0')
-        try:
-            filename = curs_list.fetchone()[0]
-        except:
-            ready = True
-            continue
-        starttime = time.time()
-        print filename
-        sdfile = gzip.open(pubchem_dir + filename)
-        line = '$$$$'
-        while line != "":
-            record = []
-            hatoms = []
-            hbonds = 0
-            skip = False
-            halo = False
-            ionized = 0
-            # read heading:
-            for x in range(4):
-                line = sdfile.readline()
-                record.append(line)
-            if line == "":
-                continue
-            natoms = int(line[:3])
-            nbonds = int(line[3:6])
-            for x in range(natoms):
-                line = sdfile.readline()
-                if line[31:33] == 'H ':
-                    # remove hydrogens
-                    hatoms.append(x + 1)
-                    continue
-                if line[31:33] != 'H ' and len(hatoms) > 0:
-                    exit('Error: heavy atoms after hydrogens' + record[0][:-1])
-                if line[31:33] not in ['C ', 'N ', 'O ', 'P ', 'S ', 'F ', 'Cl', 'Br', 'I ']:
-                    # filter non-organic compounds
-                    skip = True
-                if line[31:33] in ['F ', 'Cl', 'Br', 'I ']:
-                    halo = True
-                elif line[50:51] != '0':
-                    # this flag has something to do with polymeric structures
-                    # and resulted in deviation between calculated and given inchikeys, skip
-                    skip = True
-                elif line[38:39] == '4':  # radical
-                    # radical, resulted in deviation between calculated and given inchikeys
-                    skip = True
-                record.append(line[:42] + '\n')
-            for x in range(nbonds):
-                line = sdfile.readline()
-                if int(line[:3]) in hatoms or int(line[3:6]) in hatoms:
-                    # remove bonds involving hydrogens
-                    hbonds += 1
-                    continue
-                # use bonds with stereoflags set to zero
-                record.append(line[:9] + '  0\n')
-            while line != 'M  END\n' and line != '':
-                line = sdfile.readline()
-                record.append(line)
-                if line[:6] == 'M  ISO':
-                    skip = True
-                    print 'Skipped isotopically labeled:', record[0][:-1]
-            while line != "$$$$\n" and line != "":
-                line = sdfile.readline()
-                if line == "> <PUBCHEM_MONOISOTOPIC_WEIGHT>\n":
-                    mim = float(sdfile.readline()[:-1])
-                elif line == "> <PUBCHEM_COMPONENT_COUNT>\n":
-                    comp_count = int(sdfile.readline()[:-1])
-                elif line == "> <PUBCHEM_IUPAC_INCHIKEY>\n":
-                    line = sdfile.readline()
-                    inchikey = line[:14]
-                elif line == "> <PUBCHEM_OPENEYE_CAN_SMILES>\n":
-                    smiles = sdfile.readline()[:-1]
-                elif line == "> <PUBCHEM_MOLECULAR_FORMULA>\n":
-                    molform = sdfile.readline()[:-1]
-                elif line == "> <PUBCHEM_TOTAL_CHARGE>\n":
-                    charge = int(sdfile.readline()[:-1])
-                elif line == "> <PUBCHEM_IUPAC_NAME>\n":
-                    iupac_name = sdfile.readline()[:-1]
-                elif line == "> <PUBCHEM_HEAVY_ATOM_COUNT>\n":
-                    heavy_atoms = int(sdfile.readline()[:-1])
-                elif line[:17] == "> <PUBCHEM_XLOGP3":
-                    logp = float(sdfile.readline()[:-1])
-            if line != "" and \
-                    not skip and \
-                    halo == halogens and \
-                    mim <= 1200.0 and \
-                    comp_count == 1:
-                charge = 0
-                if '-' in molform:
-                    # exclude compounds with charge < -1
-                    if molform[-1] == '-':
-                        charge = -1
-                    else:
-                        continue
-                elif '+' in molform:
-                    # exclude compounds with charge > 1
-                    if molform[-1] == '+':
-                        charge = 1
-                    else:
-                        continue
-                for x in ['C(=O)[O-]', 'S(=O)(=O)[O-]', '[NH+]', '[NH2+]', '[NH3+]', '[NH4+]']:
-                    if smiles.find(x) >= 0:
-                        ionized = 1
-                record[3] = repr(natoms - len(hatoms)).rjust(3) + repr(nbonds - hbonds).rjust(3) + record[3][6:]
-                cid = int(record[0][:-1])
-                try:
-                    curs_names.execute(
-                        'SELECT name,refscore FROM names WHERE cid == ?', (cid,))
-                    result = curs_names.fetchone()
-                    molname = result[0]
-                    refscore = int(result[1])
-                except:
-                    molname = iupac_name
-                    refscore = 1
-                molblock = base64.encodestring(zlib.compress(''.join(record)))
-                if inchikey in memstore:
-                    dbcid, dbrefscore, dbionized = memstore[inchikey]
-                    # prefer CID's with higher refscore, then prefer non-ionized CID's
-                    if (refscore > dbrefscore) or \
-                            (refscore == dbrefscore and dbionized > ionized):
-                        curs_pubchem.execute('''UPDATE molecules SET cid=?, mim=?, charge=?,  molblock=?, smiles=?,
-                                                molform=?, name=?, refscore=?, logp=? WHERE cid == ?''', (
+    for shard_file in shard_files:
+        conn_shard = sqlite3.connect(shard_file)
+        for cid, mim, charge, heavy_atoms, molblock, inchikey, smiles, molform, molname, refscore, logp, ionized in \
+                conn_shard.execute('''SELECT cid, mim, charge, natoms, molblock, inchikey, smiles, molform, name,
+                                      refscore, logp, ionized FROM records WHERE halo = ? ORDER BY rowid''', (halogens,)):
+            if inchikey in memstore:
+                dbcid, dbrefscore, dbionized = memstore[inchikey]
+                # prefer CID's with higher refscore, then prefer non-ionized CID's
+                if (refscore > dbrefscore) or \
+                        (refscore == dbrefscore and dbionized > ionized):
+                    curs_pubchem.execute('''UPDATE molecules SET cid=?, mim=?, charge=?,  molblock=?, smiles=?,
+                                            molform=?, name=?, refscore=?, logp=? WHERE cid == ?''', (
+                                            cid,
+                                            mim,
+                                            charge,
+                                            molblock,
+                                            smiles,
+                                            molform,
+                                            molname,
+                                            refscore,
+                                            logp,
+                                            dbcid))
+                    memstore[inchikey] = (cid, refscore, ionized)
+            else:
+                curs_pubchem.execute('''INSERT INTO molecules (cid,mim,charge,natoms,molblock,inchikey,smiles,
+                                        molform,name,refscore,logp) VALUES (?,?,?,?,?,?,?,?,?,?,?)''', (
+                                        cid,
+                                        mim,
+                                        charge,
+                                        heavy_atoms,
+                                        molblock,
+                                        inchikey,
+                                        smiles,
+                                        molform,
+                                        molname,
+                                        refscore,
+                                        logp))
+                memstore[inchikey] = (cid, refscore, ionized)
+            if cid in kegg_info:
+                molname, keggid = kegg_info[cid]
+                if inchikey in memstore_kegg:
+                    dbcid, reference, dbionized = memstore_kegg[inchikey]
+                    reference = reference + ',' + keggid
+                    print 'Duplicates:', reference, molname
+                    # prefer non-ionized CID's
+                    if dbionized > ionized:
+                        curs_kegg.execute('''UPDATE molecules SET cid=?, mim=?, charge=?, molblock=?, smiles=?,
+                                             molform=?, name=?, reference=?, logp=? WHERE cid == ?''', (
                                                 cid,
-                                                int(mim * 1e6),
+                                                mim,
                                                 charge,
-                                                unicode(molblock),
-                                                unicode(smiles),
-                                                unicode(molform),
+                                                molblock,
+                                                smiles,
+                                                molform,
                                                 unicode(molname),
-                                                refscore,
-                                                int(logp * 10),
+                                                unicode(reference),
+                                                logp,
                                                 dbcid))
-                        memstore[inchikey] = (cid, refscore, ionized)
+                        memstore_kegg[inchikey] = (cid, reference, ionized)
+                    else:
+                        curs_kegg.execute('UPDATE molecules SET reference=? WHERE cid == ?', (
+                            unicode(reference),
+                            dbcid)
+                        )
+                        memstore_kegg[inchikey] = (
+                            dbcid, reference, dbionized)
                 else:
-                    curr_id += 1
-                    curs_pubchem.execute('''INSERT INTO molecules (cid,mim,charge,natoms,molblock,inchikey,smiles,
-                                            molform,name,refscore,logp) VALUES (?,?,?,?,?,?,?,?,?,?,?)''', (
+                    curs_kegg.execute('''INSERT INTO molecules (cid, mim, charge, natoms, molblock, inchikey,
+                                         smiles, molform, name, reference, logp) VALUES (?,?,?,?,?,?,?,?,?,?,?)''', (
                                             cid,
-                                            int(mim * 1e6),
+                                            mim,
                                             charge,
                                             heavy_atoms,
-                                            unicode(molblock),
-                                            unicode(inchikey),
-                                            unicode(smiles),
-                                            unicode(molform),
+                                            molblock,
+                                            inchikey,
+                                            smiles,
+                                            molform,
                                             unicode(molname),
-                                            refscore,
-                                            int(logp * 10)))
-                    memstore[inchikey] = (cid, refscore, ionized)
-                if int(cid) in kegg_info:
-                    molname, keggid = kegg_info[cid]
-                    if inchikey in memstore_kegg:
-                        dbcid, reference, dbionized = memstore_kegg[inchikey]
-                        reference = reference + ',' + keggid
-                        print 'Duplicates:', reference, molname
-                        # prefer non-ionized CID's
-                        if dbionized > ionized:
-                            curs_kegg.execute('''UPDATE molecules SET cid=?, mim=?, charge=?, molblock=?, smiles=?,
-                                                 molform=?, name=?, reference=?, logp=? WHERE cid == ?''', (
-                                                    cid,
-                                                    int(mim * 1e6),
-                                                    charge,
-                                                    unicode(molblock),
-                                                    unicode(molform),
-                                                    unicode(smiles),
-                                                    unicode(molname),
-                                                    unicode(reference),
-                                                    int(logp * 10),
-                                                    dbcid))
-                            memstore_kegg[inchikey] = (cid, reference, ionized)
-                        else:
-                            curs_kegg.execute('UPDATE molecules SET reference=? WHERE cid == ?', (
-                                unicode(reference),
-                                dbcid)
-                            )
-                            memstore_kegg[inchikey] = (
-                                dbcid, reference, dbionized)
-                    else:
-                        curr_id += 1
-                        curs_kegg.execute('''INSERT INTO molecules (cid, mim, charge, natoms, molblock, inchikey,
-                                             smiles, molform, name, reference, logp) VALUES (?,?,?,?,?,?,?,?,?,?,?)''', (
-                                                cid,
-                                                int(mim * 1e6),
-                                                charge,
-                                                heavy_atoms,
-                                                unicode(molblock),
-                                                unicode(inchikey),
-                                                unicode(smiles),
-                                                unicode(molform),
-                                                unicode(molname),
-                                                unicode(keggid),
-                                                int(logp * 10)))
-                        memstore_kegg[inchikey] = (cid, keggid, ionized)
-
+                                            unicode(keggid),
+                                            logp))
+                    memstore_kegg[inchikey] = (cid, keggid, ionized)
+        conn_shard.close()
         conn_pubchem.commit()
         if len(kegg_info) > 0:
             conn_kegg.commit()
-        elapsed_time = (time.time() - starttime) / 60
-        curs_list.execute(
-            'UPDATE files SET processed = 1, time = ? WHERE file = ?', (elapsed_time, filename))
-        conn_list.commit()
-        print filename + ": ", elapsed_time
 
     memstore = {}  # free up some memory
     memstore_kegg = {}
@@ -386,36 +499,42 @@ def create_pubchem_dbs(data_dir, dbs_dir, kegg_info, halogens):
             'CREATE INDEX idx_cover ON molecules (charge,mim)')
         conn_kegg.commit()
 
-# main
-mainparser = argparse.ArgumentParser(description=__doc__)
-mainparser.add_argument(
-    '--version', action='version', version='%(prog)s ' + version())
-subparsers = mainparser.add_subparsers(title='Sub-commands')
-
-sc = subparsers.add_parser(
-    "update", help=update.__doc__, description=update.__doc__)
-sc.add_argument('-d', '--data_dir',
-                help="Directory where PubChem data is stored (default: %(default)s)", default="./", type=str)
-sc.set_defaults(func=update)
-
-sc = subparsers.add_parser(
-    "process", help=process.__doc__, description=process.__doc__)
-sc.add_argument('-k', '--kegg', default=None, type=str, help="""File with information of Kegg compounds in PubChem.
-                        Must be downloaded from http://pubchem.ncbi.nlm.nih.gov/ as follows:
-                        Substance => Advanced Search => Source=KEGG => Search;
-                        Display Settings: Format = ID Map => Apply;
-                        Send to: File
-                        (default: %(default)s)""")
-sc.add_argument('-s', '--skip_names',
-                help="Skip update of PubChem names db (default: %(default)s)", action="store_true")
-sc.add_argument('-f', '--halogens',
-                help="Generate database with halogenated compounds (default: %(default)s)", action="store_true")
-sc.add_argument('-d', '--data_dir',
-                help="Directory where PubChem data has been downloaded (default: %(default)s)", default="./", type=str)
-sc.add_argument('-b', '--database_dir',
-                help="Directory where MAGMa databases will be stored (default: %(default)s)", default="./", type=str)
-sc.set_defaults(func=process)
-
-args = mainparser.parse_args(sys.argv[1:])
-args.func(args)
 
+def main():
+    mainparser = argparse.ArgumentParser(description=__doc__)
+    mainparser.add_argument(
+        '--version', action='version', version='%(prog)s ' + version())
+    subparsers = mainparser.add_subparsers(title='Sub-commands')
+
+    sc = subparsers.add_parser(
+        "update", help=update.__doc__, description=update.__doc__)
+    sc.add_argument('-d', '--data_dir',
+                    help="Directory where PubChem data is stored (default: %(default)s)", default="./", type=str)
+    sc.set_defaults(func=update)
+
+    sc = subparsers.add_parser(
+        "process", help=process.__doc__, description=process.__doc__)
+    sc.add_argument('-k', '--kegg', default=None, type=str, help="""File with information of Kegg compounds in PubChem.
+                            Must be downloaded from http://pubchem.ncbi.nlm.nih.gov/ as follows:
+                            Substance => Advanced Search => Source=KEGG => Search;
+                            Display Settings: Format = ID Map => Apply;
+                            Send to: File
+                            (default: %(default)s)""")
+    sc.add_argument('-s', '--skip_names',
+                    help="Skip update of PubChem names db (default: %(default)s)", action="store_true")
+    sc.add_argument('-c', '--ncpus',
+                    help="Number of SDF files processed in parallel (default: %(default)s)", default=1, type=int)
+    sc.add_argument('-d', '--data_dir',
+                    help="Directory where PubChem data has been downloaded (default: %(default)s)", default="./", type=str)
+    sc.add_argument('-b', '--database_dir',
+                    help="Directory where MAGMa databases will be stored (default: %(default)s)", default="./", type=str)
+    sc.add_argument('-i', '--mim_index',
+                    help="Also write memory mapped mass indexes of databases (default: %(default)s)", action="store_true")
+    sc.set_defaults(func=process)
+
+    args = mainparser.parse_args(sys.argv[1:])
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import unittest
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import ConfigParser
+import magma
+import magma_db_service
+
+
+class TestMagmaDbService(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        dbfilename = os.path.join(self.dirname, 'HMDB_MAGMa.db')
+        conn = sqlite3.connect(dbfilename)
+        conn.execute('CREATE TABLE molecules (cid INTEGER PRIMARY KEY, mim INTEGER NOT NULL, charge INTEGER NOT NULL, '
+                     'natoms INTEGER NOT NULL, molblock TEXT, inchikey TEXT, smiles TEXT, molform TEXT, name TEXT, '
+                     'reference TEXT, logp INT)')
+        self.rows = [(1, 100000000, 0, 10, 'mb1', 'KEY1', 'C', 'C1', 'a', 'HMDB1', 10),
+                     (2, 200000000, 0, 20, 'mb2', 'KEY2', 'CC', 'C2', 'b', 'HMDB2', 20),
+                     (3, 300000000, 0, 30, 'mb3', 'KEY3', 'CCC', 'C3', 'c', 'HMDB3', 30)]
+        conn.executemany('INSERT INTO molecules VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.rows)
+        conn.commit()
+        conn.close()
+        config = ConfigParser.ConfigParser()
+        config.add_section('magma job')
+        config.set('magma job', 'structure_database.online', 'False')
+        config.set('magma job', 'structure_database.hmdb', dbfilename)
+        patchers = [mock.patch.object(magma, 'config', config),
+                    mock.patch.object(magma_db_service, 'engines', threading.local())]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def request(self, json_body, dbname='hmdb'):
+        return mock.Mock(json_body=json_body, matchdict={'dbname': dbname})
+
+    def test_molecules(self):
+        select = magma.mim_ranges_select([(150000000, 250000000)], 0)
+
+        self.assertEqual(magma_db_service.molecules(self.request([select])), [self.rows[1]])
+
+    def test_molecules_batch(self):
+        queries = [[magma.mim_ranges_select([(250000000, 350000000)], 0)],
+                   [magma.mim_ranges_select([(50000000, 150000000)], 0) + '; DELETE FROM molecules'],
+                   [magma.mim_ranges_select([(50000000, 150000000), (150000000, 250000000)], 0)],
+                   [magma.mim_ranges_select([(50000000, 350000000)], 1)]]
+
+        results = magma_db_service.molecules_batch(self.request(queries))
+
+        # results are in the order of the queries, a query with more than one statement is not executed
+        self.assertEqual(results, [[self.rows[2]], None, [self.rows[0], self.rows[1]], []])
+        self.assertEqual(magma_db_service.molecules(self.request(queries[1])), None)
+
+    def test_unknown_database(self):
+        with self.assertRaises(magma_db_service.HTTPNotFound):
+            magma_db_service.molecules_batch(self.request([], 'chebi'))
@@ -0,0 +1,141 @@
+import unittest
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import process_pubchem
+
+
+def sdf_record(cid, heavy_atoms, inchikey, smiles, molform, mim, logp):
+    """Returns PubChem SDF record of compound with heavy atoms in a chain, each with one hydrogen"""
+    natoms = 2 * len(heavy_atoms)
+    bonds = [(i, i + 1) for i in range(1, len(heavy_atoms))] + \
+        [(i, len(heavy_atoms) + i) for i in range(1, len(heavy_atoms) + 1)]
+    lines = ['%d\n' % cid, '  -OEChem-\n', '\n', '%3d%3d  0     0  0  0  0  0  0999 V2000\n' % (natoms, len(bonds))]
+    for atom in heavy_atoms + ['H'] * len(heavy_atoms):
+        lines.append('    0.0000    0.0000    0.0000 %-2s  0  0  0  0  0  0  0  0  0  0  0  0\n' % atom)
+    for atom1, atom2 in bonds:
+        lines.append('%3d%3d  1  0  0  0  0\n' % (atom1, atom2))
+    lines.append('M  END\n')
+    for key, value in [('PUBCHEM_COMPONENT_COUNT', '1'), ('PUBCHEM_IUPAC_INCHIKEY', inchikey + '-UHFFFAOYSA-N'),
+                       ('PUBCHEM_MONOISOTOPIC_WEIGHT', '%.6f' % mim), ('PUBCHEM_OPENEYE_CAN_SMILES', smiles),
+                       ('PUBCHEM_MOLECULAR_FORMULA', molform), ('PUBCHEM_TOTAL_CHARGE', '0'),
+                       ('PUBCHEM_IUPAC_NAME', 'iupac%d' % cid), ('PUBCHEM_HEAVY_ATOM_COUNT', str(len(heavy_atoms))),
+                       ('PUBCHEM_XLOGP3_AA', '%.1f' % logp)]:
+        lines += ['> <%s>\n' % key, value + '\n', '\n']
+    lines.append('$$$$\n')
+    return ''.join(lines)
+
+
+class TestNamesReader(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE names (cid INTEGER PRIMARY KEY, name TEXT, refscore INTEGER)')
+        self.conn.executemany('INSERT INTO names VALUES (?,?,?)', [(1, u'a', 3), (2, u'b', 1), (4, u'd', 2), (7, u'g', 5)])
+
+    def select(self, cid):
+        return self.conn.execute('SELECT name, refscore FROM names WHERE cid = ?', (cid,)).fetchone()
+
+    def test_get(self):
+        names = process_pubchem.NamesReader(self.conn)
+
+        for cid in [1, 2, 3, 4, 5, 7, 8]:
+            self.assertEqual(names.get(cid), self.select(cid))
+        self.assertIsNone(names.get(3))
+
+    def test_get_decreasing_cid(self):
+        names = process_pubchem.NamesReader(self.conn)
+
+        for cid in [4, 7, 8, 2, 2, 1, 7, 3, 4]:
+            self.assertEqual(names.get(cid), self.select(cid))
+
+
+class TestCreatePubchemDbs(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.dirname, 'data')
+        self.pubchem_dir = self.data_dir + '/ftp.ebi.ac.uk/pub/databases/pubchem/Compound/CURRENT-Full/SDF/'
+        os.makedirs(self.pubchem_dir)
+        # compound 5 replaces compound 2 with the same inchikey, it has a higher refscore
+        self.write_sdf('Compound_000000001_000000003.sdf.gz',
+                       [sdf_record(1, ['C', 'C', 'O'], 'LFQSCWFLJHTTHZ', 'CCO', 'C2H6O', 46.041865, -0.1),
+                        sdf_record(2, ['C', 'O'], 'OKKJLVBELUTLKV', 'CO', 'CH4O', 32.026215, -0.5),
+                        sdf_record(3, ['C', 'Cl'], 'NEHMKBQYUWJMIP', 'CCl', 'CH3Cl', 49.992328, 0.9)])
+        self.write_sdf('Compound_000000004_000000006.sdf.gz',
+                       [sdf_record(4, ['C', 'N'], 'BAVYZALUXZFZLV', 'CN', 'CH5N', 31.042199, -0.6),
+                        sdf_record(5, ['C', 'O'], 'OKKJLVBELUTLKV', 'CO', 'CH4O', 32.026215, -0.5),
+                        sdf_record(6, ['C', 'Br'], 'GZUXJHMPEANEGY', 'CBr', 'CH3Br', 93.941812, 1.2),
+                        sdf_record(7, ['C', 'Na'], 'XXXXXXXXXXXXXX', 'C[Na]', 'CH3Na', 38.018, 0.0)])
+        self.names_file = os.path.join(self.dirname, 'Pubchem_Names.db')
+        conn = sqlite3.connect(self.names_file)
+        conn.execute('CREATE TABLE names (cid INTEGER PRIMARY KEY, name TEXT, refscore INTEGER)')
+        conn.executemany('INSERT INTO names VALUES (?,?,?)', [(1, u'ethanol', 5), (5, u'methanol', 3)])
+        conn.commit()
+        conn.close()
+        self.kegg_info = {1: ('Ethanol', 'C00469'), 4: ('Methylamine', 'C00218')}
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write_sdf(self, filename, records):
+        sdfile = gzip.open(self.pubchem_dir + filename, 'w')
+        sdfile.write(''.join(records))
+        sdfile.close()
+
+    def create_pubchem_dbs(self, ncpus):
+        """Returns rows of the databases created with ncpus processes"""
+        dbs_dir = os.path.join(self.dirname, 'dbs%d' % ncpus)
+        os.makedirs(dbs_dir)
+        shutil.copy(self.names_file, dbs_dir)
+        process_pubchem.create_pubchem_dbs(self.data_dir, dbs_dir, self.kegg_info, ncpus)
+        self.assertFalse(os.path.exists(dbs_dir + '/Pubchem_Shards'))
+        rows = {}
+        for db in ['Pubchem_MAGMa', 'Pubchem_MAGMa_halo', 'Pubchem_MAGMa_Kegg', 'Pubchem_MAGMa_Kegg_halo']:
+            conn = sqlite3.connect(dbs_dir + '/' + db + '.db')
+            rows[db] = conn.execute('SELECT * FROM molecules ORDER BY rowid').fetchall()
+            conn.close()
+        return rows
+
+    def test_create_pubchem_dbs(self):
+        rows = self.create_pubchem_dbs(1)
+
+        self.assertEqual([row[0] for row in rows['Pubchem_MAGMa']], [1, 4, 5])
+        self.assertEqual([row[0] for row in rows['Pubchem_MAGMa_halo']], [3, 6])
+        self.assertEqual([row[0] for row in rows['Pubchem_MAGMa_Kegg']], [1, 4])
+        self.assertEqual(rows['Pubchem_MAGMa_Kegg_halo'], [])
+        self.assertEqual([row[8:10] for row in rows['Pubchem_MAGMa']],
+                         [(u'ethanol', 5), (u'iupac4', 1), (u'methanol', 3)])
+        self.assertEqual(self.create_pubchem_dbs(2), rows)
+
+    def test_create_shard(self):
+        filename = 'Compound_000000004_000000006.sdf.gz'
+        shard_file = os.path.join(self.dirname, filename + '.db')
+        task = (self.pubchem_dir, filename, shard_file, self.names_file)
+        process_pubchem.create_shard(task)
+        conn = sqlite3.connect(shard_file)
+        self.assertEqual(conn.execute('SELECT cid, halo FROM records ORDER BY rowid').fetchall(),
+                         [(4, 0), (5, 0), (6, 1)])
+        conn.close()
+        mtime = os.path.getmtime(shard_file)
+
+        # shard of unchanged SDF is reused
+        self.assertEqual(process_pubchem.create_shard(task), (filename, 0.0))
+        self.assertEqual(os.path.getmtime(shard_file), mtime)
+
+        # shard of changed SDF is created again
+        self.write_sdf(filename, [sdf_record(4, ['C', 'N'], 'BAVYZALUXZFZLV', 'CN', 'CH5N', 31.042199, -0.6)])
+        process_pubchem.create_shard(task)
+        conn = sqlite3.connect(shard_file)
+        self.assertEqual(conn.execute('SELECT cid FROM records').fetchall(), [(4,)])
+        conn.close()
+
+        # shard is created again when the names database changed
+        conn = sqlite3.connect(self.names_file)
+        conn.execute('INSERT INTO names VALUES (?,?,?)', (4, u'methylamine', 4))
+        conn.commit()
+        conn.close()
+        process_pubchem.create_shard(task)
+        conn = sqlite3.connect(shard_file)
+        self.assertEqual(conn.execute('SELECT cid, name FROM records').fetchall(), [(4, u'methylamine')])
+        conn.close()
@@ -14,7 +14,7 @@ from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.schema import ForeignKeyConstraint
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, bindparam
 
 Base = declarative_base()
 
@@ -112,8 +112,10 @@ class Reaction(Base):
     name = Column(Unicode)
 
 
-def fill_molecules_reactions_reactants(session, reactions):
+def fill_molecules_reactions_reactants(session, reactions, molids=None):
     qrnr = session.query(Reaction.product, Reaction.name, func.count('*'))
+    if molids is not None:
+        qrnr = qrnr.filter(Reaction.product.in_(molids))
     qrnr = qrnr.group_by(Reaction.product, Reaction.name)
     for molid, rname, nr in qrnr:
         if molid not in reactions:
@@ -125,6 +127,8 @@ def fill_molecules_reactions_reactants(session, reactions):
     qrnrp = session.query(Reaction.product, Reaction.name, func.count('*'))
     qrnrp = qrnrp.join(Molecule, Molecule.molid == Reaction.reactant)
     qrnrp = qrnrp.filter(Molecule.nhits > 0)
+    if molids is not None:
+        qrnrp = qrnrp.filter(Reaction.product.in_(molids))
     qrnrp = qrnrp.group_by(Reaction.product, Reaction.name)
     for molid, rname, nrp in qrnrp:
         # dont need checks for keys because query above is always superset of
@@ -132,8 +136,10 @@ def fill_molecules_reactions_reactants(session, reactions):
         reactions[molid]['reactants'][rname]['nrp'] = nrp
 
 
-def fill_molecules_reactions_products(session, reactions):
+def fill_molecules_reactions_products(session, reactions, molids=None):
     qpnr = session.query(Reaction.reactant, Reaction.name, func.count('*'))
+    if molids is not None:
+        qpnr = qpnr.filter(Reaction.reactant.in_(molids))
     qpnr = qpnr.group_by(Reaction.reactant, Reaction.name)
     for molid, rname, nr in qpnr:
         if molid not in reactions:
@@ -145,6 +151,8 @@ def fill_molecules_reactions_products(session, reactions):
     qpnrp = session.query(Reaction.reactant, Reaction.name, func.count('*'))
     qpnrp = qpnrp.join(Molecule, Molecule.molid == Reaction.product)
     qpnrp = qpnrp.filter(Molecule.nhits > 0)
+    if molids is not None:
+        qpnrp = qpnrp.filter(Reaction.reactant.in_(molids))
     qpnrp = qpnrp.group_by(Reaction.reactant, Reaction.name)
     for molid, rname, nrp in qpnrp:
         # dont need checks for keys because query above is always superset of
@@ -152,7 +160,7 @@ def fill_molecules_reactions_products(session, reactions):
         reactions[molid]['products'][rname]['nrp'] = nrp
 
 
-def fill_molecules_reactions(session):
+def fill_molecules_reactions(session, molids=None):
     """Fills the reactionsequence column in the molecules table with
     info from reactions table.
 
@@ -167,18 +175,36 @@ def fill_molecules_reactions(session):
     from magmaweb.models import fill_molecules_reactionsequence
     fill_molecules_reactionsequence(session)
 
-    """
+    When molids is given, only the reaction sequences of those molecules
+    are filled, e.g. the reactants and products of new reactions.
+    When nhits of a molecule changed, the reaction sequences of its
+    reactants and products change as well.
 
-    reactions = {}
-    fill_molecules_reactions_reactants(session, reactions)
-    fill_molecules_reactions_products(session, reactions)
+    """
 
-    for mol in session.query(Molecule):
-        if mol.molid in reactions:
-            reaction = reactions[mol.molid]
-        else:
-            reaction = {}
-        mol.reactionsequence = reaction
+    if molids is None:
+        batches = [None]
+    else:
+        # keep the number of query parameters below the sqlite limit
+        molids = sorted(molids)
+        batches = [molids[start:start + 500] for start in range(0, len(molids), 500)]
+    updates = []
+    for batch in batches:
+        reactions = {}
+        fill_molecules_reactions_reactants(session, reactions, batch)
+        fill_molecules_reactions_products(session, reactions, batch)
+
+        # only update molecules of which the reaction sequence changed
+        query = session.query(Molecule.molid, Molecule.reactionsequence)
+        if batch is not None:
+            query = query.filter(Molecule.molid.in_(batch))
+        for molid, reactionsequence in query:
+            reaction = reactions.get(molid, {})
+            if reactionsequence != reaction:
+                updates.append({'b_molid': molid, 'reactionsequence': reaction})
+    if len(updates) > 0:
+        molecules = Molecule.__table__
+        session.execute(molecules.update().where(molecules.c.molid == bindparam('b_molid')), updates)
     session.commit()
 
 
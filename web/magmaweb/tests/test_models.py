@@ -252,3 +252,59 @@ class TestFillMoleculeReactions(unittest.TestCase):
             u'products': {u'esterase': {u'nr': 1, u'nrp': 1}},
         }
         self.assertDictEqual(self.getReactionSequence(3), expected3)
+
+    def test_refill_after_nhits_changed(self):
+        """
+        1 -1> 2
+        """
+        session = self.Session()
+        session.add(Molecule(molid=1, nhits=0))
+        session.add(Molecule(molid=2, nhits=1))
+        session.add(Reaction(reactid=1, name=u'esterase',
+                             reactant=1, product=2))
+        session.flush()
+        fill_molecules_reactions(session)
+
+        session.query(Molecule).get(1).nhits = 1
+        session.flush()
+        fill_molecules_reactions(session)
+
+        expected1 = {
+            u'products': {u'esterase': {u'nr': 1, u'nrp': 1}},
+        }
+        self.assertDictEqual(self.getReactionSequence(1), expected1)
+        expected2 = {
+            u'reactants': {u'esterase': {u'nr': 1, u'nrp': 1}},
+        }
+        self.assertDictEqual(self.getReactionSequence(2), expected2)
+
+    def test_refill_molids(self):
+        """
+        1 -1> 2 -2> 3
+        """
+        session = self.Session()
+        session.add(Molecule(molid=1, nhits=1))
+        session.add(Molecule(molid=2, nhits=1))
+        session.add(Molecule(molid=3, nhits=1))
+        session.add(Reaction(reactid=1, name=u'esterase',
+                             reactant=1, product=2))
+        session.flush()
+        fill_molecules_reactions(session)
+
+        session.add(Reaction(reactid=2, name=u'sulfation',
+                             reactant=2, product=3))
+        session.query(Molecule).get(1).reactionsequence = {}
+        session.flush()
+        fill_molecules_reactions(session, [2, 3])
+
+        # only the reaction sequences of the given molecules are filled
+        self.assertDictEqual(self.getReactionSequence(1), {})
+        expected2 = {
+            u'reactants': {u'esterase': {u'nr': 1, u'nrp': 1}},
+            u'products': {u'sulfation': {u'nr': 1, u'nrp': 1}},
+        }
+        self.assertDictEqual(self.getReactionSequence(2), expected2)
+        expected3 = {
+            u'reactants': {u'sulfation': {u'nr': 1, u'nrp': 1}},
+        }
+        self.assertDictEqual(self.getReactionSequence(3), expected3)